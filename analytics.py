@@ -0,0 +1,347 @@
+import csv
+import datetime
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import click
+import numpy as np
+import scipy.sparse as sp
+from flask.cli import AppGroup
+from app import app, db
+from jobs import task
+from models import Show, Venue, Artist, display_time
+from sharding import shards
+import clock
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+MANIFEST = 'reports.json'
+
+
+# ----------------------------------------------------------------------------#
+# Loading.
+# ----------------------------------------------------------------------------#
+
+# Shows are read with a server-side cursor a batch at a time into columns
+# of venue id, artist id and start time as a unix timestamp.
+
+def _stream(query):
+    result = db.session.execute(query.execution_options(
+        stream_results=True, yield_per=app.config['ANALYTICS_BATCH']))
+    yield from result.partitions()
+
+
+def _load_shard():
+    columns = {'venue_id': [], 'artist_id': [], 'start': []}
+    for rows in _stream(db.select(
+            Show.venue_id, Show.artist_id, Show.start_time)):
+        columns['venue_id'].append(np.fromiter(
+            (row[0] for row in rows), dtype=np.int64, count=len(rows)))
+        columns['artist_id'].append(np.fromiter(
+            (row[1] for row in rows), dtype=np.int64, count=len(rows)))
+        columns['start'].append(np.fromiter(
+            (row[2].timestamp() for row in rows), dtype=np.float64,
+            count=len(rows)))
+
+    venues = [tuple(row) for rows in _stream(db.select(
+        Venue.id, Venue.name, Venue.city, Venue.state)) for row in rows]
+    artists = [tuple(row) for rows in _stream(db.select(
+        Artist.id, Artist.name, Artist.genres)) for row in rows]
+    return columns, venues, artists
+
+
+def _local_months(starts):
+    # the local month of each timestamp as year * 12 + month - 1, found by
+    # searching the instants each local month starts at rather than
+    # converting every timestamp
+    if not len(starts):
+        return np.zeros(0, dtype=np.int64)
+    zone = clock.timezone()
+    first, last = (datetime.datetime.fromtimestamp(instant, zone)
+                   for instant in (starts.min(), starts.max()))
+    months = np.arange(first.year * 12 + first.month - 1,
+                       last.year * 12 + last.month, dtype=np.int64)
+    month_starts = np.array([datetime.datetime(
+        month // 12, month % 12 + 1, 1, tzinfo=zone).timestamp()
+        for month in months])
+    return months[np.searchsorted(month_starts, starts, side='right') - 1]
+
+
+class Bookings:
+    # every show as numpy columns, with the venue and artist of each show
+    # as dense row numbers into the sorted venue and artist tables
+
+    def __init__(self, venue_ids, artist_ids, starts, venues, artists):
+        self.venues = sorted(venues)
+        self.artists = sorted(artists)
+        self.venue_ids = np.array([venue[0] for venue in self.venues],
+                                  dtype=np.int64)
+        self.artist_ids = np.array([artist[0] for artist in self.artists],
+                                   dtype=np.int64)
+        self.states = sorted({venue[3] or '' for venue in self.venues})
+        self.genres = sorted({genre for artist in self.artists
+                              for genre in artist[2] or []})
+
+        # shows of venues or artists deleted mid-read are dropped
+        venue_rows = np.minimum(np.searchsorted(self.venue_ids, venue_ids),
+                                len(self.venue_ids) - 1)
+        artist_rows = np.minimum(np.searchsorted(self.artist_ids, artist_ids),
+                                 len(self.artist_ids) - 1)
+        known = (self.venue_ids[venue_rows] == venue_ids) & \
+            (self.artist_ids[artist_rows] == artist_ids)
+        self.venue_rows = venue_rows[known]
+        self.artist_rows = artist_rows[known]
+        months = _local_months(starts[known])
+        self.first_month = int(months.min()) if len(months) else 0
+        self.months = months - self.first_month
+        self.month_count = int(self.months.max()) + 1 if len(self.months) \
+            else 0
+
+        state_col = {state: col for col, state in enumerate(self.states)}
+        self.venue_states = np.array(
+            [state_col[venue[3] or ''] for venue in self.venues],
+            dtype=np.int64)
+        genre_col = {genre: col for col, genre in enumerate(self.genres)}
+        rows, cols = [], []
+        for row, artist in enumerate(self.artists):
+            for genre in artist[2] or []:
+                rows.append(row)
+                cols.append(genre_col[genre])
+        self.artist_genres = sp.csr_matrix(
+            (np.ones(len(rows), dtype=np.int64), (rows, cols)),
+            shape=(len(self.artists), len(self.genres)))
+
+    def __len__(self):
+        return len(self.venue_rows)
+
+    @classmethod
+    def load(cls):
+        # artists are copied to every shard, so they are deduplicated
+        columns = {'venue_id': [], 'artist_id': [], 'start': []}
+        venues, artists = [], {}
+        for shard_columns, shard_venues, shard_artists in \
+                shards.each(_load_shard):
+            for name, chunks in shard_columns.items():
+                columns[name].extend(chunks)
+            venues.extend(shard_venues)
+            artists.update((artist[0], artist) for artist in shard_artists)
+        arrays = [np.concatenate(columns[name]) if columns[name]
+                  else np.zeros(0, dtype=np.int64)
+                  for name in ('venue_id', 'artist_id', 'start')]
+        return cls(*arrays, venues, list(artists.values()))
+
+
+# ----------------------------------------------------------------------------#
+# Aggregation.
+# ----------------------------------------------------------------------------#
+
+def _count(venue_rows, artist_rows, months, venue_states, shape):
+    # show counts for one slice of the shows: per venue and month (dense,
+    # flattened), per artist, and per state and artist (sparse)
+    venue_count, artist_count, month_count, state_count = shape
+    per_venue_month = np.bincount(venue_rows * month_count + months,
+                                  minlength=venue_count * month_count)
+    per_artist = np.bincount(artist_rows, minlength=artist_count)
+    per_state_artist = sp.csr_matrix(
+        (np.ones(len(artist_rows), dtype=np.int64),
+         (venue_states[venue_rows], artist_rows)),
+        shape=(state_count, artist_count))
+    return per_venue_month, per_artist, per_state_artist
+
+
+def _count_slice(args):
+    return _count(*args)
+
+
+def aggregate(bookings, processes=None):
+    # counts every show once, splitting the shows across a process pool
+    # when there are more than ANALYTICS_PARALLEL_ROWS of them
+    processes = processes or app.config['ANALYTICS_PROCESSES'] or \
+        os.cpu_count()
+    shape = (len(bookings.venues), len(bookings.artists),
+             bookings.month_count, len(bookings.states))
+    if processes < 2 or len(bookings) <= app.config['ANALYTICS_PARALLEL_ROWS']:
+        return _count(bookings.venue_rows, bookings.artist_rows,
+                      bookings.months, bookings.venue_states, shape)
+
+    bounds = np.linspace(0, len(bookings), processes + 1, dtype=np.int64)
+    slices = [(bookings.venue_rows[start:end],
+               bookings.artist_rows[start:end], bookings.months[start:end],
+               bookings.venue_states, shape)
+              for start, end in zip(bounds, bounds[1:])]
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        partials = list(pool.map(_count_slice, slices))
+    return tuple(sum(counts[1:], counts[0]) for counts in zip(*partials))
+
+
+# ----------------------------------------------------------------------------#
+# Reports.
+# ----------------------------------------------------------------------------#
+
+# Each report turns the counts into a header and rows.
+
+def _month_label(month):
+    return f'{month // 12:04d}-{month % 12 + 1:02d}'
+
+
+def shows_per_venue_month(bookings, counts):
+    per_venue_month = counts[0].reshape(len(bookings.venues),
+                                        bookings.month_count)
+    venue_rows, months = np.nonzero(per_venue_month)
+    rows = [(*bookings.venues[venue_row],
+             _month_label(bookings.first_month + int(month)),
+             int(per_venue_month[venue_row, month]))
+            for venue_row, month in zip(venue_rows, months)]
+    return ('venue_id', 'venue', 'city', 'state', 'month', 'shows'), rows
+
+
+def genre_mix_by_state(bookings, counts):
+    # shows booked per state by artists of each genre; a show by an artist
+    # with several genres counts once for each
+    per_state_genre = (counts[2] @ bookings.artist_genres).toarray()
+    totals = per_state_genre.sum(axis=1)
+    rows = []
+    for state_col, genre_col in zip(*np.nonzero(per_state_genre)):
+        shows = int(per_state_genre[state_col, genre_col])
+        rows.append((bookings.states[state_col], bookings.genres[genre_col],
+                     shows, round(shows / totals[state_col], 4)))
+    rows.sort(key=lambda row: (row[0], -row[2], row[1]))
+    return ('state', 'genre', 'shows', 'share'), rows
+
+
+def busiest_artists(bookings, counts):
+    per_artist = counts[1]
+    top = app.config['ANALYTICS_TOP_ARTISTS']
+    busiest = np.argsort(-per_artist, kind='stable')[:top]
+    rows = [(rank, *bookings.artists[row][:2], int(per_artist[row]))
+            for rank, row in enumerate(busiest, 1) if per_artist[row]]
+    return ('rank', 'artist_id', 'artist', 'shows'), rows
+
+
+reports = {
+    'shows_per_venue_month': ('Shows per venue per month',
+                              shows_per_venue_month),
+    'genre_mix_by_state': ('Genre mix by state', genre_mix_by_state),
+    'busiest_artists': ('Busiest artists', busiest_artists),
+}
+
+
+# ----------------------------------------------------------------------------#
+# Files.
+# ----------------------------------------------------------------------------#
+
+def reports_dir():
+    return os.path.join(app.instance_path, app.config['ANALYTICS_DIR'])
+
+
+def _replace(path, write):
+    # write then rename so the page never reads a half-written file
+    tmp_path = f'{path}.tmp'
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _write_csv(path, header, rows):
+    def write(tmp_path):
+        with open(tmp_path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            writer.writerows(rows)
+
+    _replace(path, write)
+
+
+def _write_parquet(path, header, rows):
+    columns = list(zip(*rows)) if rows else [[] for _ in header]
+    table = pyarrow.table(dict(zip(header, map(list, columns))))
+    _replace(path, lambda tmp_path: pyarrow.parquet.write_table(
+        table, tmp_path))
+
+
+def build(processes=None):
+    # recomputes every report into the reports directory; Parquet copies
+    # are written alongside the CSVs when pyarrow is installed
+    started = time.perf_counter()
+    bookings = Bookings.load()
+    loaded = time.perf_counter()
+    counts = aggregate(bookings, processes)
+
+    directory = reports_dir()
+    os.makedirs(directory, exist_ok=True)
+    manifest = {
+        'generated_at': datetime.datetime.now(
+            datetime.timezone.utc).isoformat(),
+        'shows': len(bookings),
+        'reports': {}
+    }
+    for name, (title, report) in reports.items():
+        header, rows = report(bookings, counts)
+        _write_csv(os.path.join(directory, f'{name}.csv'), header, rows)
+        formats = ['csv']
+        if pyarrow is not None:
+            _write_parquet(os.path.join(directory, f'{name}.parquet'),
+                           header, rows)
+            formats.append('parquet')
+        manifest['reports'][name] = {'title': title, 'rows': len(rows),
+                                     'formats': formats}
+    manifest['load_seconds'] = round(loaded - started, 3)
+    manifest['seconds'] = round(time.perf_counter() - started, 3)
+
+    _replace(os.path.join(directory, MANIFEST),
+             lambda tmp_path: _write_json(tmp_path, manifest))
+    return manifest
+
+
+def _write_json(path, data):
+    with open(path, 'w') as f:
+        json.dump(data, f)
+
+
+def manifest():
+    # the last build's summary, or None before the first build
+    try:
+        with open(os.path.join(reports_dir(), MANIFEST)) as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return None
+    data['generated'] = display_time(
+        datetime.datetime.fromisoformat(data['generated_at']))
+    return data
+
+
+def preview(name, limit):
+    # the header and first rows of a built report
+    with open(os.path.join(reports_dir(), f'{name}.csv'), newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        return header, [row for _, row in zip(range(limit), reader)]
+
+
+@task()
+def build_reports():
+    build()
+
+
+# ----------------------------------------------------------------------------#
+# CLI commands.
+# ----------------------------------------------------------------------------#
+
+reports_cli = AppGroup('reports', help='Build booking analytics reports.')
+
+
+@reports_cli.command('build')
+@click.option('--processes', type=int, default=None,
+              help='Worker processes for large reports.')
+def build_command(processes):
+    summary = build(processes)
+    for name, report in summary['reports'].items():
+        click.echo(f'{name}: {report["rows"]} rows '
+                   f'({", ".join(report["formats"])})')
+    click.echo(f'Reports built from {summary["shows"]} shows in '
+               f'{summary["seconds"]:.2f}s.')
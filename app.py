@@ -3,15 +3,26 @@
 # ----------------------------------------------------------------------------#
 import dateutil.parser
 import babel
+import click
+import functools
+import hashlib
+import io
+import itertools
 import logging
+import math
 
-from flask import Flask, render_template, request, flash, redirect, url_for
+from flask import Flask, render_template, request, flash, redirect, url_for, \
+    jsonify, abort, Response, stream_with_context, send_file, \
+    send_from_directory
 from flask_moment import Moment
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from logging import Formatter, FileHandler
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
+from werkzeug.middleware.proxy_fix import ProxyFix
 from forms import *
+from sharding import RoutingSession, shards, shards_cli
 
 # ----------------------------------------------------------------------------#
 # App Config.
@@ -20,7 +31,11 @@ from forms import *
 app = Flask(__name__)
 moment = Moment(app)
 app.config.from_object('config')
-db = SQLAlchemy(app)
+if app.config['PROXY_HOPS']:
+    # take the client address from X-Forwarded-For, as set by the proxies
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_HOPS'],
+                            x_proto=app.config['PROXY_HOPS'])
+db = SQLAlchemy(app, session_options={'class_': RoutingSession})
 migrate = Migrate(app, db)
 
 # ----------------------------------------------------------------------------#
@@ -29,6 +44,24 @@ migrate = Migrate(app, db)
 
 from models import *
 
+shards.init_app(app, db, Venue, Artist)
+
+from jobs import enqueue, jobs_cli
+from geo import venue_index, geo_cli
+from recommendations import recommendations, recommendations_cli
+from metrics import registry
+import clock
+import show_calendar
+from fragment_cache import fragment_cache
+from throttle import rate_limit, single_flight, rate_limits_cli
+from warmup import warmup_cli
+import images
+import changefeed
+import analytics
+import sessions
+
+fragment_cache.init_app(app)
+
 
 # ----------------------------------------------------------------------------#
 # Filters.
@@ -60,56 +93,125 @@ def index():
 # ----------------------------------------------------------------------------#
 
 @app.route('/venues')
+@rate_limit('listing')
 def venues():
-    locations = Venue.query.with_entities(
-        Venue.city, Venue.state).distinct(Venue.city, Venue.state).all()
-    venues = Venue.query.all()
+    # concurrent requests share one computation of the listing
+    data = single_flight.do(('venues', clock.as_of()), venue_areas)
+    return render_template('pages/venues.html', areas=data)
+
+
+def venue_areas():
+    def venue_rows():
+        upcoming_counts = UpcomingShow.counts_by_venue()
+        return [(state or '', city or '', venue_id, name,
+                 upcoming_counts.get(venue_id, 0))
+                for state, city, venue_id, name in Venue.query.with_entities(
+                    Venue.state, Venue.city, Venue.id, Venue.name).order_by(
+                    Venue.state, Venue.city, Venue.id)]
+
+    venues = shards.scatter(venue_rows, key=lambda venue: venue[:3])
     data = []
-    all_venues = []
-
-    # remove duplicates from venues page without using set()
-    for location in locations:
-        for venue in venues:
-            if venue.city == location[0] and venue.state == location[1]:
-                all_venues.append({
-                    'id': venue.id,
-                    'name': venue.name,
-                    'num_upcoming_shows': venue.venue_upcoming_shows_count()
-                })
+
+    # venues arrive sorted by location so each city/state is one run
+    for (state, city), area in itertools.groupby(
+            venues, key=lambda venue: venue[:2]):
         data.append({
-            'city': location.city,
-            'state': location.state,
-            'venues': all_venues
+            'city': city,
+            'state': state,
+            'venues': [{
+                'id': venue_id,
+                'name': name,
+                'num_upcoming_shows': num_upcoming_shows
+            } for _, _, venue_id, name, num_upcoming_shows in area]
         })
 
-        # empty the list after we're done iterating over it or venues screen
-        # will have duplicates
-        all_venues = []
-
-    return render_template('pages/venues.html', areas=data)
+    return data
 
 
 @app.route('/venues/search', methods=['POST'])
+@rate_limit('search')
 def search_venues():
     search_term = request.form.get('search_term', '')
-    search_results = Venue.query.filter(Venue.name.ilike
-                                        (f'%{search_term}%')).all()
+    # ilike ignores case, so differently cased searches share one query
+    search_results = single_flight.do(
+        ('venues_search', search_term.lower(), clock.as_of()),
+        lambda: shards.scatter(lambda: [{
+            'id': venue.id,
+            'name': venue.name
+        } for venue in Venue.query.filter(
+            Venue.name.ilike(f'%{search_term}%')).order_by(
+            Venue.name, Venue.id)],
+            key=lambda venue: (venue['name'] or '', venue['id'])))
 
     response = {
         "count": len(search_results),
-        "data": [venue for venue in search_results]
+        "data": search_results
     }
 
     return render_template('pages/search_venues.html', results=response,
                            search_term=request.form.get('search_term', ''))
 
 
+@app.route('/venues/near')
+def venues_near():
+    try:
+        latitude = float(request.args['lat'])
+        longitude = float(request.args['lon'])
+    except (KeyError, ValueError):
+        abort(400)
+    # nan fails both comparisons
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        abort(400)
+
+    limit = max(1, min(request.args.get('limit', 10, type=int), 100))
+    radius = request.args.get('radius', type=float)
+    if radius is not None and not 0 <= radius < math.inf:
+        abort(400)
+
+    if radius is None:
+        nearby = venue_index.nearest(latitude, longitude, limit)
+    else:
+        nearby = venue_index.within(latitude, longitude, radius, limit)
+
+    venues = {}
+    for found in shards.each(lambda: {venue.id: {
+        'id': venue.id,
+        'name': venue.name,
+        'city': venue.city,
+        'state': venue.state,
+        'address': venue.address
+    } for venue in Venue.query.filter(
+            Venue.id.in_([venue_id for venue_id, _ in nearby]))}):
+        venues.update(found)
+    data = [dict(venues[venue_id], distance_km=round(distance, 3))
+            for venue_id, distance in nearby if venue_id in venues]
+
+    return jsonify({'count': len(data), 'data': data})
+
+
 @app.route('/venues/<int:venue_id>')
 def show_venue(venue_id):
-    venue = Venue.query.get(venue_id)
-    data = venue.serialize()
-
-    return render_template('pages/show_venue.html', venue=data)
+    venue = Venue.query.get_or_404(venue_id)
+    data = venue.serialize(shows=False)
+    # the show lists are loaded by one query, and only when a cached
+    # fragment has expired or been invalidated
+    past_marker, upcoming_marker = Show.markers(venue_id=venue_id)
+
+    recommended = recommendations.artists_for_venue(venue_id)
+    artists = {artist.id: artist for artist in Artist.query.filter(
+        Artist.id.in_([artist_id for artist_id, _ in recommended]))}
+    recommended_artists = [{
+        'id': artist_id,
+        'name': artists[artist_id].name,
+        'image_link': artists[artist_id].image_link
+    } for artist_id, _ in recommended if artist_id in artists]
+
+    return render_template('pages/show_venue.html', venue=data,
+                           past_marker=past_marker,
+                           upcoming_marker=upcoming_marker,
+                           load_shows=functools.cache(
+                               venue.serialize_shows),
+                           recommended_artists=recommended_artists)
 
 
 # ----------------------------------------------------------------------------#
@@ -126,6 +228,13 @@ def create_venue_form():
 def create_venue_submission():
     venue_form = VenueForm(request.form)
 
+    with shards.use_state(venue_form.state.data):
+        create_venue(venue_form)
+
+    return render_template('pages/home.html')
+
+
+def create_venue(venue_form):
     try:
         new_venue = Venue(
             name=venue_form.name.data,
@@ -146,10 +255,9 @@ def create_venue_submission():
     except:
         db.session.rollback()
         flash("Error! Venue '" + request.form['name'] + "' was NOT listed!")
-    finally:
-        db.session.close()
-
-    return render_template('pages/home.html')
+    else:
+        enqueue('geocode_venue', {'venue_id': new_venue.id},
+                key=f'geocode_venue:{new_venue.id}')
 
 
 @app.route('/venues/<venue_id>', methods=['DELETE'])
@@ -161,8 +269,6 @@ def delete_venue(venue_id):
     except:
         db.session.rollback()
         flash('Error! This venue could not be deleted.')
-    finally:
-        db.session.close()
 
     return redirect(url_for('index'))
 
@@ -171,44 +277,120 @@ def delete_venue(venue_id):
 #  Artists
 # ----------------------------------------------------------------------------#
 @app.route('/artists')
+@rate_limit('listing')
 def artists():
-    artists = Artist.query.all()
-    data = []
-
-    for artist in artists:
-        data.append({
-            'id': artist.id,
-            'name': artist.name
-        })
+    data = single_flight.do(('artists', clock.as_of()), lambda: [{
+        'id': artist.id,
+        'name': artist.name
+    } for artist in Artist.query.all()])
 
     return render_template('pages/artists.html', artists=data)
 
 
 @app.route('/artists/search', methods=['POST'])
+@rate_limit('search')
 def search_artists():
     search_term = request.form.get('search_term', '')
-    search_results = Artist.query.filter(Artist.name.ilike
-                                         (f'%{search_term}%')).all()
+    search_results = single_flight.do(
+        ('artists_search', search_term.lower(), clock.as_of()),
+        lambda: [{
+            'id': artist.id,
+            'name': artist.name
+        } for artist in Artist.query.filter(
+            Artist.name.ilike(f'%{search_term}%'))])
     response = {
         "count": len(search_results),
-        "data": [artist for artist in search_results]
+        "data": search_results
     }
 
     return render_template('pages/search_artists.html', results=response,
                            search_term=request.form.get('search_term', ''))
 
 
+def artist_shows(artist_id):
+    # every shard holds a copy of the artist along with the shows booked
+    # at its own venues
+    def serialize():
+        artist = Artist.query.get(artist_id)
+        return artist.serialize_shows() if artist is not None else None
+
+    copies = [copy for copy in shards.each(serialize) if copy is not None]
+    data = {}
+    for when in ('upcoming', 'past'):
+        data[f'artist_{when}_shows_count'] = sum(
+            copy[f'artist_{when}_shows_count'] for copy in copies)
+        data[f'artist_{when}_shows'] = sorted(
+            (show for copy in copies for show in copy[f'artist_{when}_shows']),
+            key=lambda show: dateutil.parser.parse(show['start_time']))
+    return data
+
+
 @app.route('/artists/<int:artist_id>')
 def show_artist(artist_id):
-    artist = Artist.query.get(artist_id)
-    data = artist.serialize()
-
-    return render_template('pages/show_artist.html', artist=data)
+    artist = Artist.query.get_or_404(artist_id)
+    data = artist.serialize(shows=False)
+    # the show lists are loaded by one query per shard, and only when a
+    # cached fragment has expired or been invalidated
+    markers = shards.each(lambda: Show.markers(artist_id=artist_id))
+
+    recommended = recommendations.venues_for_artist(artist_id)
+    venues = {}
+    for found in shards.each(lambda: {venue.id: {
+        'id': venue.id,
+        'name': venue.name,
+        'image_link': venue.image_link
+    } for venue in Venue.query.filter(
+            Venue.id.in_([venue_id for venue_id, _ in recommended]))}):
+        venues.update(found)
+    recommended_venues = [venues[venue_id] for venue_id, _ in recommended
+                          if venue_id in venues]
+
+    return render_template(
+        'pages/show_artist.html', artist=data,
+        past_marker=[marker for marker, _ in markers],
+        upcoming_marker=[marker for _, marker in markers],
+        load_shows=functools.cache(functools.partial(artist_shows, artist_id)),
+        recommended_venues=recommended_venues)
 
 
 # ----------------------------------------------------------------------------#
 #  Update
 # ----------------------------------------------------------------------------#
+ARTIST_EDITABLE_FIELDS = ('name', 'city', 'state', 'phone', 'genres',
+                          'image_link', 'facebook_link', 'website',
+                          'is_seeking_venue', 'seeking_description')
+VENUE_EDITABLE_FIELDS = ('name', 'city', 'state', 'address', 'phone',
+                         'genres', 'image_link', 'facebook_link', 'website',
+                         'is_seeking_talent', 'seeking_description')
+
+
+def artist_edited(artist_id, changed):
+    shards.replicate_artist(artist_id)
+    if {'name', 'image_link'} & set(changed):
+        enqueue('sync_upcoming_shows', {'artist_id': artist_id},
+                key=f'sync_upcoming_shows:artist:{artist_id}')
+
+
+def venue_edited(venue_id, changed):
+    if {'name', 'image_link'} & set(changed):
+        enqueue('sync_upcoming_shows', {'venue_id': venue_id},
+                key=f'sync_upcoming_shows:venue:{venue_id}')
+    if {'city', 'state'} & set(changed):
+        enqueue('geocode_venue', {'venue_id': venue_id},
+                key=f'geocode_venue:{venue_id}')
+
+
+def edit_conflict(template, form_class, **context):
+    # someone saved the record after this form was loaded; show the form
+    # again with the latest values rather than overwrite their changes
+    entity = next(iter(context.values()))
+    flash("Error! This record was changed by someone else while you were "
+          "editing it. Your changes were not saved, please review the latest "
+          "version and try again.")
+    return render_template(template, form=form_class(obj=entity),
+                           **context), 409
+
+
 @app.route('/artists/<int:artist_id>/edit', methods=['GET'])
 def edit_artist(artist_id):
     data = Artist.query.get(artist_id)
@@ -220,27 +402,33 @@ def edit_artist(artist_id):
 @app.route('/artists/<int:artist_id>/edit', methods=['POST'])
 def edit_artist_submission(artist_id):
     form = ArtistForm(request.form)
+    artist = Artist.query.get_or_404(artist_id)
+
+    if form.version.data is not None and form.version.data != artist.version:
+        return edit_conflict('forms/edit_artist.html', ArtistForm,
+                             artist=artist)
 
     try:
-        artist = Artist.query.filter_by(id=artist_id).first()
-        artist.name = form.name.data
-        artist.city = form.city.data
-        artist.state = form.state.data
-        artist.phone = form.phone.data
-        artist.genres = form.genres.data
-        artist.image_link = form.image_link.data
-        artist.facebook_link = form.facebook_link.data
-        artist.website = form.website.data
-        artist.is_seeking_venue = form.is_seeking_venue.data
-        artist.seeking_description = form.seeking_description.data
+        changed = apply_changes(artist, {
+            field: getattr(form, field).data
+            for field in ARTIST_EDITABLE_FIELDS
+        })
 
-        db.session.commit()
-        flash(f"The artist '{artist.name}' has been successfully updated!")
+        if changed:
+            db.session.commit()
+            flash(f"The artist '{artist.name}' has been successfully "
+                  f"updated!")
+        else:
+            flash(f"No changes were made to the artist '{artist.name}'.")
+    except StaleDataError:
+        db.session.rollback()
+        return edit_conflict('forms/edit_artist.html', ArtistForm,
+                             artist=artist)
     except Exception as e:
         db.session.rollback()
         flash(f"Error! The artist '{artist.name}' was not updated!")
-    finally:
-        db.session.close()
+    else:
+        artist_edited(artist_id, changed)
 
     return redirect(url_for('show_artist', artist_id=artist_id))
 
@@ -256,32 +444,162 @@ def edit_venue(venue_id):
 @app.route('/venues/<int:venue_id>/edit', methods=['POST'])
 def edit_venue_submission(venue_id):
     form = VenueForm(request.form)
+    venue = Venue.query.get_or_404(venue_id)
+
+    if form.version.data is not None and form.version.data != venue.version:
+        return edit_conflict('forms/edit_venue.html', VenueForm, venue=venue)
 
     try:
-        venue = Venue.query.filter_by(id=venue_id).first()
-        venue.name = form.name.data
-        venue.city = form.city.data
-        venue.state = form.state.data
-        venue.address = form.address.data
-        venue.phone = form.phone.data
-        venue.genres = form.genres.data
-        venue.image_link = form.image_link.data
-        venue.facebook_link = form.facebook_link.data
-        venue.website = form.website.data
-        venue.is_seeking_talent = form.is_seeking_talent.data
-        venue.seeking_description = form.seeking_description.data
+        changed = apply_changes(venue, {
+            field: getattr(form, field).data
+            for field in VENUE_EDITABLE_FIELDS
+        })
 
-        db.session.commit()
-        flash(f"The venue '{venue.name}' has been successfully updated!")
+        if changed:
+            db.session.commit()
+            flash(f"The venue '{venue.name}' has been successfully updated!")
+        else:
+            flash(f"No changes were made to the venue '{venue.name}'.")
+    except StaleDataError:
+        db.session.rollback()
+        return edit_conflict('forms/edit_venue.html', VenueForm, venue=venue)
     except Exception as e:
         db.session.rollback()
         flash(f"Error! The venue '{venue.name}' was not updated!")
-    finally:
-        db.session.close()
+    else:
+        venue_edited(venue_id, changed)
 
     return redirect(url_for('show_venue', venue_id=venue_id))
 
 
+@app.route('/batch/edit', methods=['POST'])
+def batch_edit():
+    # applies many artist and venue updates in one transaction, e.g.
+    # {"venues": [{"id": 1, "version": 3, "fields": {"name": "..."}}],
+    #  "artists": [...]}. Nothing is saved if any entity is missing, stale
+    # or given a field that can't be edited.
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict):
+        abort(400)
+    errors = batch_shape_errors(payload)
+    if errors:
+        return jsonify({'success': False, 'errors': errors}), 400
+
+    # a batch is one transaction, so everything in it has to live on the
+    # same shard
+    homes = shards.shards_for_ids(
+        [update.get('id') for kind in ('artists', 'venues')
+         for update in payload.get(kind, [])]) if shards.enabled else set()
+    if len(homes) > 1:
+        return jsonify({'success': False, 'errors': [
+            {'error': 'batch spans shards', 'shards': sorted(homes)}]}), 400
+
+    with shards.use(homes.pop() if homes else None):
+        return apply_batch_edit(payload)
+
+
+def batch_shape_errors(payload):
+    errors = []
+    for kind in ('artists', 'venues'):
+        updates = payload.get(kind, [])
+        if not isinstance(updates, list):
+            errors.append({'type': kind, 'error': 'not a list'})
+            continue
+        for update in updates:
+            if not isinstance(update, dict) \
+                    or not isinstance(update.get('id'), int) \
+                    or not isinstance(update.get('fields', {}), dict):
+                errors.append({'type': kind, 'error': 'malformed update',
+                               'update': update})
+    return errors
+
+
+def batch_field_errors(form_class, entity, editable, fields):
+    # checks the given values with the edit form's validators, filled in
+    # with the entity's other values; the single edit routes get their
+    # values coerced by the form, so here anything of the wrong type is an
+    # error too
+    form = form_class(formdata=None, meta={'csrf': False}, data={
+        **{field: getattr(entity, field) for field in editable}, **fields})
+    form.validate()
+    errors = {}
+    for name, value in fields.items():
+        field = form[name]
+        if isinstance(field, BooleanField):
+            valid = isinstance(value, bool)
+        elif isinstance(field, SelectMultipleField):
+            valid = isinstance(value, list) and all(
+                isinstance(item, str) for item in value)
+        else:
+            valid = isinstance(value, str)
+        if not valid:
+            errors[name] = ['Not a valid value.']
+        elif field.errors:
+            errors[name] = field.errors
+    return errors
+
+
+def apply_batch_edit(payload):
+    kinds = (('artists', Artist, ArtistForm, ARTIST_EDITABLE_FIELDS),
+             ('venues', Venue, VenueForm, VENUE_EDITABLE_FIELDS))
+    edits = []
+    errors = []
+
+    for kind, model, form_class, editable in kinds:
+        updates = payload.get(kind, [])
+        entities = {entity.id: entity for entity in model.query.filter(
+            model.id.in_([update.get('id') for update in updates]))}
+
+        for update in updates:
+            entity = entities.get(update.get('id'))
+            fields = update.get('fields', {})
+            if entity is None:
+                errors.append({'type': kind, 'id': update.get('id'),
+                               'error': 'not found'})
+            elif set(fields) - set(editable):
+                errors.append({'type': kind, 'id': entity.id,
+                               'error': 'fields not editable',
+                               'fields': sorted(set(fields) - set(editable))})
+            elif update.get('version') != entity.version:
+                errors.append({'type': kind, 'id': entity.id,
+                               'error': 'conflict',
+                               'version': entity.version})
+            else:
+                invalid = batch_field_errors(form_class, entity, editable,
+                                             fields)
+                if invalid:
+                    errors.append({'type': kind, 'id': entity.id,
+                                   'error': 'invalid fields',
+                                   'fields': invalid})
+                else:
+                    edits.append((kind, entity, fields))
+
+    if errors:
+        status = 409 if all(error['error'] == 'conflict'
+                            for error in errors) else 400
+        return jsonify({'success': False, 'errors': errors}), status
+
+    try:
+        changes = [(kind, entity, apply_changes(entity, fields))
+                   for kind, entity, fields in edits]
+        db.session.commit()
+    except StaleDataError:
+        db.session.rollback()
+        return jsonify({'success': False, 'errors': [
+            {'error': 'conflict'}]}), 409
+
+    updated = []
+    for kind, entity, changed in changes:
+        if kind == 'artists':
+            artist_edited(entity.id, changed)
+        else:
+            venue_edited(entity.id, changed)
+        updated.append({'type': kind, 'id': entity.id,
+                        'version': entity.version, 'changed': changed})
+
+    return jsonify({'success': True, 'updated': updated})
+
+
 # ----------------------------------------------------------------------------#
 #  Create Artist
 # ----------------------------------------------------------------------------#
@@ -296,6 +614,13 @@ def create_artist_form():
 def create_artist_submission():
     artist_form = ArtistForm(request.form)
 
+    with shards.use_state(artist_form.state.data):
+        create_artist(artist_form)
+
+    return render_template('pages/home.html')
+
+
+def create_artist(artist_form):
     try:
         new_artist = Artist(
             name=artist_form.name.data,
@@ -315,10 +640,8 @@ def create_artist_submission():
     except:
         db.session.rollback()
         flash("Error! Artist '" + request.form['name'] + "' was NOT listed!")
-    finally:
-        db.session.close()
-
-    return render_template('pages/home.html')
+    else:
+        shards.replicate_artist(new_artist.id)
 
 
 @app.route('/artists/<artist_id>', methods=['DELETE'])
@@ -330,8 +653,8 @@ def delete_artist(artist_id):
     except:
         db.session.rollback()
         flash('Error! This artist could not be deleted.')
-    finally:
-        db.session.close()
+    else:
+        shards.replicate_artist(artist_id)
 
     return redirect(url_for('index'))
 
@@ -340,31 +663,93 @@ def delete_artist(artist_id):
 #  Shows
 # ----------------------------------------------------------------------------#
 
+def listed_shows():
+    # past shows need the join; upcoming ones come from the read model
+    now = clock.now()
+    past = db.session.execute(UpcomingShow.source_query().where(
+        Show.start_time < now).order_by(Show.start_time, Show.id)).all()
+    upcoming = db.session.execute(db.select(
+        UpcomingShow.show_id, UpcomingShow.start_time,
+        UpcomingShow.artist_id, UpcomingShow.artist_name,
+        UpcomingShow.artist_image_link, UpcomingShow.venue_id,
+        UpcomingShow.venue_name, UpcomingShow.venue_image_link).where(
+        UpcomingShow.start_time >= now).order_by(
+        UpcomingShow.start_time, UpcomingShow.show_id)).all()
+    return past + upcoming
+
+
 @app.route('/shows')
+@rate_limit('listing')
 def shows():
     # displays list of shows at /shows
     # TODO: replace with real venues data.
     #       num_shows should be aggregated based on number of upcoming shows
     #       per venue.
-    shows = Show.query.all()
+    shows = shards.scatter(listed_shows, key=lambda show: show[1])
     data = []
 
-    for show in shows:
-        artist = Artist.query.get(show.artist_id)
-        venue = Venue.query.get(show.venue_id)
+    for show_id, start_time, artist_id, artist_name, artist_image_link, \
+            venue_id, venue_name, venue_image_link in shows:
         data.append({
-            'show_id': show.id,
-            'artist_id': artist.id,
-            'artist_name': artist.name,
-            'venue_id': venue.id,
-            'venue_name': venue.name,
-            'artist_image_link': artist.image_link,
-            'start_time': show.start_time.strftime("%m-%d-%Y %H:%M")
+            'show_id': show_id,
+            'artist_id': artist_id,
+            'artist_name': artist_name,
+            'venue_id': venue_id,
+            'venue_name': venue_name,
+            'artist_image_link': artist_image_link,
+            'start_time': display_time(start_time)
         })
 
     return render_template('pages/shows.html', shows=data)
 
 
+@app.route('/shows/calendar')
+def shows_calendar():
+    # show counts per day or week for a date range, optionally filtered by
+    # venue city/state, e.g. /shows/calendar?start=2020-01-03&end=2020-01-06
+    # &city=New York&state=NY. include=shows adds each day's shows.
+    bucket = request.args.get('bucket', 'day')
+    city = request.args.get('city')
+    state = request.args.get('state')
+    try:
+        start, end = show_calendar.parse_range(request.args)
+    except ValueError:
+        abort(400)
+    if bucket not in show_calendar.BUCKETS:
+        abort(400)
+
+    counts = show_calendar.bucket_counts(start, end, city, state, bucket)
+    shows_by_day = None
+    if bucket == 'day' and request.args.get('include') == 'shows':
+        shows_by_day = show_calendar.shows_by_day(start, end, city, state)
+
+    data = []
+    for day, count in counts:
+        day_data = {'start': day.isoformat(), 'count': count}
+        if shows_by_day is not None:
+            day_data['shows'] = shows_by_day[day]
+        data.append(day_data)
+
+    return jsonify({'start': start.isoformat(), 'end': end.isoformat(),
+                    'bucket': bucket, 'buckets': data})
+
+
+@app.route('/shows/feed.<any(json, ics):format>')
+def shows_feed(format):
+    try:
+        start, end = show_calendar.parse_range(request.args)
+    except ValueError:
+        abort(400)
+    city = request.args.get('city')
+    state = request.args.get('state')
+
+    if format == 'ics':
+        return Response(stream_with_context(show_calendar.iter_ical(
+            start, end, city, state)), mimetype='text/calendar')
+    return Response(stream_with_context(show_calendar.iter_json(
+        start, end, city, state)), mimetype='application/json')
+
+
 @app.route('/shows/create')
 def create_shows():
     form = ShowForm()
@@ -375,6 +760,14 @@ def create_shows():
 def create_show_submission():
     show_form = ShowForm(request.form)
 
+    # shows live on their venue's shard
+    with shards.use_venue(show_form.venue_id.data):
+        create_show(show_form)
+
+    return render_template('pages/home.html')
+
+
+def create_show(show_form):
     try:
         new_show = Show(
             artist_id=show_form.artist_id.data,
@@ -391,10 +784,94 @@ def create_show_submission():
     except:
         db.session.rollback()
         flash("Error! That show could not be listed!")
-    finally:
-        db.session.close()
+    else:
+        recommendations.add_show(new_show.artist_id, new_show.venue_id)
+        # prune the show from the upcoming read model once it has started
+        start_time = new_show.start_time
+        enqueue('refresh_upcoming_shows', run_at=start_time,
+                key=f'refresh_upcoming_shows:{start_time:%Y%m%d%H%M}')
+
+
+# ----------------------------------------------------------------------------#
+#  Images
+# ----------------------------------------------------------------------------#
+
+@app.route('/images/<int:width>')
+def image_thumbnail(width):
+    url = request.args.get('url', '')
+    if not images.verify(url, width, request.args.get('sig', '')):
+        abort(404)
+
+    try:
+        data = images.thumbnails.thumbnail(url, width)
+    except images.UnsafeSource:
+        abort(404)
+    except images.FetchError:
+        # fall back to the original rather than showing a broken image
+        return redirect(url)
+
+    return send_file(io.BytesIO(data), mimetype='image/webp',
+                     etag=hashlib.sha256(data).hexdigest(),
+                     max_age=app.config['IMAGE_MAX_AGE'])
+
+
+# ----------------------------------------------------------------------------#
+#  Reports
+# ----------------------------------------------------------------------------#
+
+@app.route('/reports')
+def reports():
+    # reports are built offline by 'flask reports build' or the
+    # build_reports job; the page only reads the files, and renders them
+    # once per build
+    summary = analytics.manifest()
+    return render_template(
+        'pages/reports.html', summary=summary,
+        load_previews=functools.cache(lambda: {
+            name: analytics.preview(name, app.config['ANALYTICS_PAGE_ROWS'])
+            for name in summary['reports']}))
 
-    return render_template('pages/home.html')
+
+@app.route('/reports/<name>.<any(csv, parquet):format>')
+def report_file(name, format):
+    if name not in analytics.reports:
+        abort(404)
+    return send_from_directory(analytics.reports_dir(), f'{name}.{format}',
+                               as_attachment=True)
+
+
+# ----------------------------------------------------------------------------#
+#  Changes
+# ----------------------------------------------------------------------------#
+
+@app.route('/changes')
+def changes():
+    # the change feed after ?after=<seq>, a batch at a time; consumers pass
+    # back next until a batch comes back short. Sharded deployments keep a
+    # feed, and a sequence, per shard (?shard=<name>).
+    after = request.args.get('after', 0, type=int)
+    limit = max(1, min(request.args.get(
+        'limit', app.config['CHANGE_LOG_BATCH'], type=int),
+        app.config['CHANGE_LOG_BATCH']))
+    shard = request.args.get('shard')
+    if shard is not None and shard not in shards.names:
+        abort(404)
+
+    with shards.use(shard):
+        entries = changefeed.changes_after(after, limit)
+        data = [entry.serialize() for entry in entries]
+    return jsonify({'count': len(data), 'data': data,
+                    'next': data[-1]['seq'] if data else after})
+
+
+# ----------------------------------------------------------------------------#
+#  Metrics
+# ----------------------------------------------------------------------------#
+
+@app.route('/metrics')
+def metrics():
+    return Response(registry.render(),
+                    mimetype='text/plain; version=0.0.4; charset=utf-8')
 
 
 # ----------------------------------------------------------------------------#
@@ -411,6 +888,29 @@ def server_error(error):
     return render_template('errors/500.html'), 500
 
 
+# ----------------------------------------------------------------------------#
+# CLI commands.
+# ----------------------------------------------------------------------------#
+
+app.cli.add_command(jobs_cli)
+app.cli.add_command(geo_cli)
+app.cli.add_command(recommendations_cli)
+app.cli.add_command(shards_cli)
+app.cli.add_command(rate_limits_cli)
+app.cli.add_command(warmup_cli)
+app.cli.add_command(changefeed.changes_cli)
+app.cli.add_command(analytics.reports_cli)
+app.cli.add_command(sessions.sessions_cli)
+
+
+@app.cli.command('refresh-upcoming-shows')
+@click.option('--full', is_flag=True,
+              help='Rebuild the read model instead of pruning started shows.')
+def refresh_upcoming_shows(full):
+    shards.each(lambda: UpcomingShow.refresh(full=full))
+    click.echo('Upcoming shows read model refreshed.')
+
+
 if not app.debug:
     file_handler = FileHandler('error.log')
     file_handler.setFormatter(
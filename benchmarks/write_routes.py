@@ -0,0 +1,138 @@
+import argparse
+import multiprocessing
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+# Measures write-route throughput with several worker processes sharing one
+# database and one session store, as gunicorn workers on a host do. Each
+# worker edits an artist of its own, follows the redirect and checks the
+# flashed message arrived. Run from the repository root:
+#
+#   python benchmarks/write_routes.py --workers 4 --cycles 200
+#
+# The app database is a fresh SQLite file unless DATABASE_URL is set, in
+# which case it has to be migrated already.
+TEMP_DIR = tempfile.mkdtemp(prefix='fyyur-bench-')
+os.environ.setdefault(
+    'DATABASE_URL', f'sqlite:///{os.path.join(TEMP_DIR, "fyyur.db")}')
+os.environ.setdefault('SECRET_KEY', 'benchmark')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from flask.sessions import SecureCookieSessionInterface
+from flask_migrate import upgrade
+from app import app, db
+from models import Artist
+
+FLASH = b'has been successfully updated!'
+# workers wait on this to start together; inherited through fork
+start = None
+
+
+def setup(workers):
+    app.config.update(
+        RATE_LIMITS={},
+        WARMUP_ON_START=False,
+        SESSION_DB=os.path.join(TEMP_DIR, 'sessions.db'),
+    )
+    with app.app_context():
+        if db.engine.dialect.name == 'sqlite':
+            upgrade(directory=os.path.join(app.root_path, 'migrations'))
+        artists = []
+        for number in range(workers):
+            artist = Artist(name=f'Benchmark Band {number}',
+                            city='San Francisco', state='CA',
+                            phone='326-123-5000', genres=['Jazz'])
+            Artist.add(artist)
+            artists.append((artist.id, artist.version))
+        db.engine.dispose()
+    return artists
+
+
+def form(number, version, cycle):
+    return {
+        'name': f'Benchmark Band {number}',
+        'city': 'Oakland' if cycle % 2 else 'San Francisco',
+        'state': 'CA',
+        'phone': '326-123-5000',
+        'genres': ['Jazz'],
+        'version': version,
+    }
+
+
+def work(backend, number, artist_id, version, cycles):
+    if backend == 'cookie':
+        app.session_interface = SecureCookieSessionInterface()
+    with app.app_context():
+        db.engine.dispose()
+    client = app.test_client()
+    latencies, flashed = [], 0
+
+    start.wait()
+    began = time.perf_counter()
+    for cycle in range(cycles):
+        sent = time.perf_counter()
+        response = client.post(f'/artists/{artist_id}/edit',
+                               data=form(number, version, cycle))
+        page = client.get(response.headers['Location'])
+        latencies.append(time.perf_counter() - sent)
+        if response.status_code == 302:
+            version += 1
+        flashed += FLASH in page.data
+    return latencies, flashed, time.perf_counter() - began
+
+
+def run(backend, artists, cycles):
+    global start
+    context = multiprocessing.get_context('fork')
+    start = context.Barrier(len(artists))
+    with context.Pool(len(artists)) as pool:
+        results = pool.starmap(work, [
+            (backend, number, artist_id, version, cycles)
+            for number, (artist_id, version) in enumerate(artists)
+        ])
+
+    latencies = sorted(latency for result in results
+                       for latency in result[0])
+    flashed = sum(result[1] for result in results)
+    elapsed = max(result[2] for result in results)
+    # each cycle is two requests: the POST and the redirected GET
+    return {
+        'requests': 2 * len(latencies),
+        'per_second': 2 * len(latencies) / elapsed,
+        'p50': 1000 * statistics.median(latencies),
+        'p95': 1000 * latencies[int(0.95 * (len(latencies) - 1))],
+        'flashed': flashed / len(latencies),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark write routes with several workers.')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--cycles', type=int, default=200,
+                        help='edits per worker')
+    parser.add_argument('--backend', choices=['sqlite', 'cookie', 'both'],
+                        default='both')
+    args = parser.parse_args()
+
+    backends = ['sqlite', 'cookie'] if args.backend == 'both' \
+        else [args.backend]
+    print(f'{"backend":<8} {"workers":>7} {"requests":>8} {"req/s":>8} '
+          f'{"p50 ms":>7} {"p95 ms":>7} {"flashed":>7}')
+    try:
+        for backend in backends:
+            result = run(backend, setup(args.workers), args.cycles)
+            print(f'{backend:<8} {args.workers:>7} {result["requests"]:>8} '
+                  f'{result["per_second"]:>8.0f} {result["p50"]:>7.1f} '
+                  f'{result["p95"]:>7.1f} {result["flashed"]:>7.0%}')
+    finally:
+        shutil.rmtree(TEMP_DIR, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,200 @@
+import datetime
+import decimal
+import json
+import time
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import event
+from app import app, db
+from models import Show, Venue, Artist, TZDateTime
+from sharding import shards
+import clock
+
+INSERT = 'insert'
+UPDATE = 'update'
+DELETE = 'delete'
+
+ENTITIES = {
+    Venue: 'venue',
+    Artist: 'artist',
+    Show: 'show',
+}
+
+# Postgres advisory lock held by transactions writing to the log
+CHANGE_LOG_LOCK = 0x6368616e6765
+
+
+# ----------------------------------------------------------------------------#
+# Models.
+# ----------------------------------------------------------------------------#
+
+class ChangeLog(db.Model):
+    # append-only feed of venue, artist and show writes, one row per
+    # insert, update or delete, written in the same transaction as the
+    # write itself. data is the full row after the write (None for
+    # deletes), so any single entry is enough to rebuild the entity.
+    __tablename__ = 'change_log'
+    __table_args__ = (
+        db.Index('ix_change_log_entity_entity_id', 'entity', 'entity_id'),
+        db.Index('ix_change_log_created_at', 'created_at'),
+    )
+
+    seq = db.Column(db.Integer, primary_key=True)
+    entity = db.Column(db.String(20), nullable=False)
+    entity_id = db.Column(db.Integer, nullable=False)
+    op = db.Column(db.String(10), nullable=False)
+    changed = db.Column(db.JSON)
+    data = db.Column(db.JSON)
+    created_at = db.Column(TZDateTime, nullable=False)
+
+    def __repr__(self):
+        return f'<Change {self.seq}: {self.op} {self.entity} ' \
+               f'{self.entity_id}>'
+
+    def serialize(self):
+        return {
+            'seq': self.seq,
+            'entity': self.entity,
+            'id': self.entity_id,
+            'op': self.op,
+            'changed': self.changed,
+            'data': self.data,
+            'created_at': self.created_at.isoformat()
+        }
+
+
+# ----------------------------------------------------------------------------#
+# Recording.
+# ----------------------------------------------------------------------------#
+
+def _jsonable(value):
+    # datetimes go out in UTC whatever zone they were written in
+    if isinstance(value, datetime.datetime):
+        return clock.aware(value).astimezone(datetime.timezone.utc).isoformat()
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    return value
+
+
+def _row(mapper, target):
+    return {attr.key: _jsonable(getattr(target, attr.key))
+            for attr in mapper.column_attrs}
+
+
+def _record(connection, entity, entity_id, op, changed=None, data=None):
+    # sequence numbers have to become visible in order, or a reader could
+    # pass over one whose transaction commits after a later one. SQLite
+    # allows one writer at a time; on Postgres writers take turns from
+    # their first logged write until they commit.
+    if connection.dialect.name == 'postgresql':
+        connection.execute(db.select(
+            db.func.pg_advisory_xact_lock(CHANGE_LOG_LOCK)))
+    connection.execute(ChangeLog.__table__.insert().values(
+        entity=entity, entity_id=entity_id, op=op, changed=changed,
+        data=data, created_at=datetime.datetime.now(datetime.timezone.utc)))
+
+
+def _inserted(mapper, connection, target):
+    _record(connection, ENTITIES[type(target)], target.id, INSERT,
+            data=_row(mapper, target))
+
+
+def _updated(mapper, connection, target):
+    state = db.inspect(target)
+    changed = [attr.key for attr in mapper.column_attrs
+               if state.attrs[attr.key].history.has_changes()]
+    if changed:
+        _record(connection, ENTITIES[type(target)], target.id, UPDATE,
+                changed=changed, data=_row(mapper, target))
+
+
+def _deleted(mapper, connection, target):
+    _record(connection, ENTITIES[type(target)], target.id, DELETE)
+
+
+def _copied(connection, row, changed):
+    # artist copies written to other shards with Core, which the mapper
+    # events above never see; changed is None for a new copy
+    _record(connection, ENTITIES[Artist], row['id'],
+            INSERT if changed is None else UPDATE, changed=changed,
+            data={key: _jsonable(value) for key, value in row.items()})
+
+
+for model in ENTITIES:
+    event.listen(model, 'after_insert', _inserted)
+    event.listen(model, 'after_update', _updated)
+    event.listen(model, 'after_delete', _deleted)
+shards.copy_listeners.append(_copied)
+
+
+# ----------------------------------------------------------------------------#
+# Reading.
+# ----------------------------------------------------------------------------#
+
+def changes_after(seq, limit):
+    # up to limit changes after seq, oldest first. Logged writes commit in
+    # sequence order (see _record), so no transaction still open can hold
+    # a number below one already visible, and skipped numbers are rolled
+    # back or compacted writes.
+    return ChangeLog.query.filter(ChangeLog.seq > seq).order_by(
+        ChangeLog.seq).limit(limit).all()
+
+
+def compact(older_than):
+    # rewrites the log before older_than down to the latest entry per
+    # entity, then drops those that are deletes; a consumer starting from
+    # zero still ends up with every live entity. Returns the number of
+    # entries removed.
+    table = ChangeLog.__table__
+    old = table.c.created_at < older_than
+    latest = db.select(db.func.max(table.c.seq)).where(old).group_by(
+        table.c.entity, table.c.entity_id)
+
+    superseded = db.session.execute(table.delete().where(
+        old, table.c.seq.not_in(latest))).rowcount
+    tombstones = db.session.execute(table.delete().where(
+        old, table.c.op == DELETE)).rowcount
+    db.session.commit()
+    return superseded + tombstones
+
+
+# ----------------------------------------------------------------------------#
+# CLI commands.
+# ----------------------------------------------------------------------------#
+
+changes_cli = AppGroup('changes', help='Read and compact the change log.')
+
+
+@changes_cli.command('tail')
+@click.option('--after', type=int, default=0,
+              help='Sequence number of the last change already seen.')
+@click.option('--batch-size', type=int, default=None)
+@click.option('--follow', is_flag=True, help='Keep waiting for changes.')
+@click.option('--shard', default=None, help='Shard to read when sharded.')
+def tail_command(after, batch_size, follow, shard):
+    # prints one JSON change per line
+    batch_size = batch_size or app.config['CHANGE_LOG_BATCH']
+    with shards.use(shard):
+        while True:
+            changes = changes_after(after, batch_size)
+            for change in changes:
+                click.echo(json.dumps(change.serialize()))
+                after = change.seq
+            db.session.close()
+            if len(changes) < batch_size:
+                if not follow:
+                    break
+                time.sleep(app.config['CHANGE_LOG_POLL_INTERVAL'])
+
+
+@changes_cli.command('compact')
+@click.option('--older-than-days', type=int, default=None,
+              help='Compact entries older than this (CHANGE_LOG_RETENTION).')
+def compact_command(older_than_days):
+    days = older_than_days or app.config['CHANGE_LOG_RETENTION']
+    cutoff = clock.now() - datetime.timedelta(days=days)
+    removed = sum(shards.each(lambda: compact(cutoff)))
+    click.echo(f'{removed} change log entries compacted.')
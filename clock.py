@@ -0,0 +1,87 @@
+import contextlib
+import contextvars
+import datetime
+
+import dateutil.parser
+from dateutil import tz
+from flask import g, request, abort
+from app import app
+
+current_time = contextvars.ContextVar('current_time', default=None)
+
+
+# ----------------------------------------------------------------------------#
+# Clock.
+# ----------------------------------------------------------------------------#
+
+def timezone():
+    # the zone naive datetimes (form input, as_of) are read in and times
+    # are displayed in; the server's own zone unless TIMEZONE is set
+    return tz.gettz(app.config['TIMEZONE']) if app.config['TIMEZONE'] \
+        else tz.tzlocal()
+
+
+def now():
+    # the instant the current request started, or its as_of, so every
+    # past/upcoming split in one request agrees. Outside a request (jobs,
+    # CLI commands) it is the real time unless fixed with use().
+    return current_time.get() or real_now()
+
+
+def real_now():
+    # the actual time, even inside a request rendered as_of another; what
+    # writes and the data derived from them are stamped and classified by
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def as_of():
+    # the instant a request was asked to render as of, or None for live
+    # requests; results shared between requests have to be keyed on it
+    return g.get('as_of')
+
+
+def local(value):
+    return aware(value).astimezone(timezone())
+
+
+def today():
+    return local(now()).date()
+
+
+def aware(value):
+    return value if value.tzinfo is not None else \
+        value.replace(tzinfo=timezone())
+
+
+@contextlib.contextmanager
+def use(instant):
+    token = current_time.set(aware(instant))
+    try:
+        yield current_time.get()
+    finally:
+        current_time.reset(token)
+
+
+@app.before_request
+def start_clock():
+    # ?as_of=2026-12-31T23:59 renders the page as it will look at that
+    # instant, e.g. to preview it or to warm caches before a rollover.
+    # Only reads can be previewed; writes always happen now.
+    instant = real_now()
+    as_of = request.args.get('as_of')
+    if as_of:
+        if request.method not in ('GET', 'HEAD'):
+            abort(400)
+        try:
+            instant = aware(dateutil.parser.isoparse(as_of))
+        except (ValueError, OverflowError):
+            abort(400)
+        g.as_of = instant
+    g.clock_token = current_time.set(instant)
+
+
+@app.teardown_request
+def stop_clock(error=None):
+    token = g.pop('clock_token', None)
+    if token is not None:
+        current_time.reset(token)
@@ -2,6 +2,7 @@ from datetime import datetime
 from flask_wtf import Form
 from wtforms import StringField, SelectField, SelectMultipleField, \
     DateTimeField, BooleanField, IntegerField
+from wtforms.widgets import HiddenInput
 from wtforms.validators import DataRequired, AnyOf, URL, Optional, \
     ValidationError
 
@@ -132,6 +133,9 @@ class VenueForm(Form):
     seeking_description = StringField(
         'seeking_description'
     )
+    version = IntegerField(
+        'version', validators=[Optional()], widget=HiddenInput()
+    )
 
 
 class ArtistForm(Form):
@@ -167,3 +171,6 @@ class ArtistForm(Form):
     seeking_description = StringField(
         'seeking_description'
     )
+    version = IntegerField(
+        'version', validators=[Optional()], widget=HiddenInput()
+    )
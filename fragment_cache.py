@@ -0,0 +1,142 @@
+import threading
+import time
+from collections import OrderedDict
+
+from jinja2 import nodes
+from jinja2.ext import Extension
+from sqlalchemy import event
+from app import app, db
+from models import Show, Venue, Artist
+from metrics import record_cache
+
+
+# ----------------------------------------------------------------------------#
+# Fragment cache.
+# ----------------------------------------------------------------------------#
+
+class FragmentCache:
+    # rendered template fragments, evicted least recently used first or once
+    # their ttl has passed. Each fragment carries tags such as 'venue:1' so
+    # writes can drop every fragment they affect. Invalidation only reaches
+    # this process; the ttl bounds how long other processes serve a stale
+    # fragment.
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.tagged = {}
+        self.lock = threading.Lock()
+
+    def init_app(self, app):
+        # makes the {% cache %} tag available to the app's templates
+        app.jinja_env.add_extension(CacheExtension)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                self._remove(key)
+                entry = None
+            if entry is not None:
+                self.entries.move_to_end(key)
+        record_cache('fragment', entry is not None)
+        return entry[1] if entry is not None else None
+
+    def set(self, key, html, ttl, tags=()):
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (time.monotonic() + ttl, html, tuple(tags))
+            for tag in tags:
+                self.tagged.setdefault(tag, set()).add(key)
+            while len(self.entries) > app.config['FRAGMENT_CACHE_SIZE']:
+                self._remove(next(iter(self.entries)))
+
+    def _remove(self, key):
+        _, _, tags = self.entries.pop(key)
+        for tag in tags:
+            keys = self.tagged.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.tagged[tag]
+
+    def invalidate(self, *tags):
+        with self.lock:
+            for tag in tags:
+                for key in list(self.tagged.get(tag, ())):
+                    self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.tagged.clear()
+
+
+fragment_cache = FragmentCache()
+
+
+# ----------------------------------------------------------------------------#
+# Template tag.
+# ----------------------------------------------------------------------------#
+
+class CacheExtension(Extension):
+    # {% cache key, ttl, tags=[...] %}...{% endcache %} renders the body
+    # once and serves it from fragment_cache until it expires or one of its
+    # tags is invalidated. key is any expression, usually a list such as
+    # ['venue_past_shows', venue.id, marker]; ttl defaults to
+    # FRAGMENT_CACHE_TTL seconds.
+    tags = {'cache'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [parser.parse_expression()]
+        kwargs = []
+        while parser.stream.skip_if('comma'):
+            if parser.stream.current.test('name') and \
+                    parser.stream.look().test('assign'):
+                name = next(parser.stream).value
+                next(parser.stream)
+                kwargs.append(nodes.Keyword(name, parser.parse_expression()))
+            else:
+                args.append(parser.parse_expression())
+        body = parser.parse_statements(('name:endcache',), drop_needle=True)
+        return nodes.CallBlock(self.call_method('_render', args, kwargs),
+                               [], [], body).set_lineno(lineno)
+
+    def _render(self, key, ttl=None, tags=(), caller=None):
+        key = repr(key)
+        html = fragment_cache.get(key)
+        if html is None:
+            html = caller()
+            fragment_cache.set(
+                key, html,
+                app.config['FRAGMENT_CACHE_TTL'] if ttl is None else ttl,
+                tags)
+        return html
+
+
+# ----------------------------------------------------------------------------#
+# Invalidation.
+# ----------------------------------------------------------------------------#
+
+@event.listens_for(Show, 'after_insert')
+@event.listens_for(Show, 'after_update')
+@event.listens_for(Show, 'after_delete')
+def show_changed(mapper, connection, show):
+    # a show moved to another venue or artist also leaves its old pages
+    changes = db.inspect(show).attrs
+    venue_ids = [show.venue_id] + list(changes.venue_id.history.deleted or [])
+    artist_ids = [show.artist_id] + list(
+        changes.artist_id.history.deleted or [])
+    fragment_cache.invalidate(
+        *[f'venue:{venue_id}' for venue_id in venue_ids],
+        *[f'artist:{artist_id}' for artist_id in artist_ids])
+
+
+@event.listens_for(Artist, 'after_update')
+@event.listens_for(Venue, 'after_update')
+@event.listens_for(Venue, 'after_delete')
+@event.listens_for(Artist, 'after_delete')
+def entity_changed(mapper, connection, target):
+    # artist and venue names and images appear in each other's fragments
+    fragment_cache.clear()
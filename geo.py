@@ -0,0 +1,247 @@
+import csv
+import heapq
+import math
+import os
+import threading
+import time
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import event
+from app import app, db
+from models import Venue
+from jobs import task
+from sharding import shards
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+# ----------------------------------------------------------------------------#
+# Gazetteer.
+# ----------------------------------------------------------------------------#
+
+def _normalize(city, state):
+    return ' '.join((city or '').lower().split()), (state or '').upper()
+
+
+def load_gazetteer(path):
+    gazetteer = {}
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            key = _normalize(row['city'], row['state'])
+            gazetteer[key] = (float(row['latitude']), float(row['longitude']))
+    return gazetteer
+
+
+_gazetteer = None
+
+
+def geocode(city, state):
+    # city-level lookup against the bundled gazetteer; returns None for
+    # places it doesn't know about
+    global _gazetteer
+    if _gazetteer is None:
+        _gazetteer = load_gazetteer(
+            os.path.join(app.root_path, app.config['GAZETTEER_PATH']))
+    return _gazetteer.get(_normalize(city, state))
+
+
+def geocode_venues(batch_size=500, regeocode=False):
+    # fills latitude/longitude for venues in batches, committing each batch
+    # so a long run can be interrupted and resumed
+    query = Venue.query.order_by(Venue.id)
+    if not regeocode:
+        query = query.filter(Venue.latitude.is_(None))
+
+    located = missed = 0
+    last_id = 0
+    while True:
+        batch = query.filter(Venue.id > last_id).limit(batch_size).all()
+        if not batch:
+            break
+        for venue in batch:
+            location = geocode(venue.city, venue.state)
+            if location is None:
+                missed += 1
+                continue
+            venue.latitude, venue.longitude = location
+            located += 1
+        last_id = batch[-1].id
+        db.session.commit()
+
+    return located, missed
+
+
+@task()
+def geocode_venue(venue_id):
+    with shards.use_venue(venue_id):
+        venue = Venue.query.get(venue_id)
+        if venue is None:
+            return
+        location = geocode(venue.city, venue.state)
+        venue.latitude, venue.longitude = location or (None, None)
+        db.session.commit()
+
+
+# ----------------------------------------------------------------------------#
+# Spatial index.
+# ----------------------------------------------------------------------------#
+
+def to_unit_vector(latitude, longitude):
+    lat = math.radians(latitude)
+    lon = math.radians(longitude)
+    return (math.cos(lat) * math.cos(lon), math.cos(lat) * math.sin(lon),
+            math.sin(lat))
+
+
+def chord_to_km(chord):
+    return 2 * EARTH_RADIUS_KM * math.asin(min(chord / 2, 1.0))
+
+
+def km_to_chord(km):
+    return 2 * math.sin(min(km / EARTH_RADIUS_KM, math.pi) / 2)
+
+
+class KDTree:
+    # 3-d tree over points on the unit sphere; straight-line (chord) distance
+    # between unit vectors orders points the same way great-circle distance
+    # does, so plain euclidean pruning gives exact geographic answers
+
+    def __init__(self, points):
+        # points is a list of (unit vector, item) pairs
+        self.size = len(points)
+        self.root = self._build(list(points), 0)
+
+    def _build(self, points, depth):
+        if not points:
+            return None
+        axis = depth % 3
+        points.sort(key=lambda point: point[0][axis])
+        median = len(points) // 2
+        return (points[median][0], points[median][1], axis,
+                self._build(points[:median], depth + 1),
+                self._build(points[median + 1:], depth + 1))
+
+    def nearest(self, target, k):
+        # returns up to k (chord distance, item) pairs, closest first
+        if k < 1 or self.root is None:
+            return []
+        best = []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node is None:
+                continue
+            point, item, axis, left, right = node
+            dist2 = (point[0] - target[0]) ** 2 + \
+                (point[1] - target[1]) ** 2 + (point[2] - target[2]) ** 2
+            if len(best) < k:
+                heapq.heappush(best, (-dist2, item))
+            elif dist2 < -best[0][0]:
+                heapq.heapreplace(best, (-dist2, item))
+            diff = target[axis] - point[axis]
+            near, far = (left, right) if diff < 0 else (right, left)
+            if len(best) < k or diff * diff < -best[0][0]:
+                stack.append(far)
+            stack.append(near)
+        return sorted((math.sqrt(-dist2), item) for dist2, item in best)
+
+    def within(self, target, chord):
+        # returns every (chord distance, item) pair within chord, closest
+        # first
+        if chord < 0:
+            return []
+        found = []
+        limit = chord * chord
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node is None:
+                continue
+            point, item, axis, left, right = node
+            dist2 = (point[0] - target[0]) ** 2 + \
+                (point[1] - target[1]) ** 2 + (point[2] - target[2]) ** 2
+            if dist2 <= limit:
+                found.append((math.sqrt(dist2), item))
+            diff = target[axis] - point[axis]
+            if diff < 0 or diff * diff <= limit:
+                stack.append(left)
+            if diff >= 0 or diff * diff <= limit:
+                stack.append(right)
+        return sorted(found)
+
+
+class VenueIndex:
+    # process-wide k-d tree of geocoded venues. Local venue writes mark it
+    # stale straight away; writes made by other processes are picked up
+    # once VENUE_INDEX_TTL has passed.
+
+    def __init__(self):
+        self.tree = None
+        self.built_at = 0.0
+        self.stale = True
+        self.lock = threading.Lock()
+
+    def invalidate(self):
+        self.stale = True
+
+    def get(self):
+        expired = time.monotonic() - self.built_at > \
+            app.config['VENUE_INDEX_TTL']
+        if self.stale or expired:
+            with self.lock:
+                if self.stale or expired:
+                    self.stale = False
+                    self.tree = self.build()
+                    self.built_at = time.monotonic()
+        return self.tree
+
+    def build(self):
+        rows = shards.each(lambda: db.session.query(
+            Venue.id, Venue.latitude, Venue.longitude).filter(
+            Venue.latitude.isnot(None), Venue.longitude.isnot(None)).all())
+        return KDTree([(to_unit_vector(lat, lon), venue_id)
+                       for shard_rows in rows
+                       for venue_id, lat, lon in shard_rows])
+
+    def nearest(self, latitude, longitude, limit):
+        tree = self.get()
+        target = to_unit_vector(latitude, longitude)
+        return [(venue_id, chord_to_km(chord))
+                for chord, venue_id in tree.nearest(target, limit)]
+
+    def within(self, latitude, longitude, radius_km, limit):
+        tree = self.get()
+        target = to_unit_vector(latitude, longitude)
+        return [(venue_id, chord_to_km(chord))
+                for chord, venue_id in tree.within(
+                    target, km_to_chord(radius_km))[:limit]]
+
+
+venue_index = VenueIndex()
+
+
+@event.listens_for(Venue, 'after_insert')
+@event.listens_for(Venue, 'after_update')
+@event.listens_for(Venue, 'after_delete')
+def venue_changed(mapper, connection, venue):
+    venue_index.invalidate()
+
+
+# ----------------------------------------------------------------------------#
+# CLI commands.
+# ----------------------------------------------------------------------------#
+
+geo_cli = AppGroup('geo', help='Geocode venues.')
+
+
+@geo_cli.command('geocode')
+@click.option('--batch-size', type=int, default=500)
+@click.option('--all', 'regeocode', is_flag=True,
+              help='Geocode every venue, not just ones without a location.')
+def geocode_command(batch_size, regeocode):
+    results = shards.each(lambda: geocode_venues(batch_size, regeocode))
+    located = sum(located for located, _ in results)
+    missed = sum(missed for _, missed in results)
+    click.echo(f'{located} venues geocoded, {missed} not found in the '
+               f'gazetteer.')
@@ -0,0 +1,315 @@
+import hashlib
+import hmac
+import http.client
+import io
+import ipaddress
+import os
+import socket
+import threading
+import time
+import urllib.parse
+
+from flask import url_for
+from PIL import Image, ImageOps, UnidentifiedImageError
+from app import app
+from metrics import record_cache
+from throttle import single_flight
+
+
+class FetchError(Exception):
+    pass
+
+
+class UnsafeSource(FetchError):
+    pass
+
+
+# ----------------------------------------------------------------------------#
+# Fetchers.
+# ----------------------------------------------------------------------------#
+
+# A fetcher turns an image link into the original image's bytes, raising
+# FetchError when it can't.
+
+class HTTPFetcher:
+    # downloads http(s) links, refusing hosts that resolve to private,
+    # loopback or link-local addresses so image links can't be used to reach
+    # internal services. Each hop of a redirect is checked the same way, and
+    # the connection goes to the address that was checked, so the name
+    # can't resolve somewhere else in between.
+    redirects = (301, 302, 303, 307, 308)
+
+    def __init__(self, timeout=10, max_bytes=10 * 1024 * 1024,
+                 max_redirects=3):
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.max_redirects = max_redirects
+
+    def _resolve(self, url):
+        # the url's parts and the global address to connect to
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            raise UnsafeSource(url)
+        try:
+            port = parts.port or (443 if parts.scheme == 'https' else 80)
+            addresses = socket.getaddrinfo(parts.hostname, port,
+                                           type=socket.SOCK_STREAM)
+        except (socket.gaierror, UnicodeError, ValueError) as error:
+            raise FetchError(url) from error
+        for *_, sockaddr in addresses:
+            if not ipaddress.ip_address(sockaddr[0]).is_global:
+                raise UnsafeSource(url)
+        if not addresses:
+            raise FetchError(url)
+        return parts, addresses[0][4][0], port
+
+    def _open(self, url):
+        parts, address, port = self._resolve(url)
+        connection_class = http.client.HTTPSConnection \
+            if parts.scheme == 'https' else http.client.HTTPConnection
+        connection = connection_class(parts.hostname, port,
+                                      timeout=self.timeout)
+        # connect to the checked address; https still verifies the
+        # certificate against the host name
+        connection._create_connection = \
+            lambda _, *args: socket.create_connection((address, port),
+                                                      *args)
+        path = urllib.parse.urlunsplit(('', '', parts.path or '/',
+                                        parts.query, ''))
+        connection.request('GET', path, headers={'Host': parts.netloc})
+        return connection, connection.getresponse()
+
+    def __call__(self, url):
+        for _ in range(self.max_redirects + 1):
+            try:
+                connection, response = self._open(url)
+                try:
+                    if response.status in self.redirects:
+                        location = response.getheader('Location')
+                        if not location:
+                            raise FetchError(url)
+                        url = urllib.parse.urljoin(url, location)
+                        continue
+                    if response.status != 200:
+                        raise FetchError(f'{url} returned {response.status}')
+                    data = response.read(self.max_bytes + 1)
+                finally:
+                    connection.close()
+            except (OSError, http.client.HTTPException) as error:
+                raise FetchError(url) from error
+            if len(data) > self.max_bytes:
+                raise FetchError(f'{url} is over {self.max_bytes} bytes')
+            return data
+        raise FetchError(f'{url} redirected too many times')
+
+
+class LocalFileFetcher:
+    # reads links from a directory by their path, so
+    # http://example.com/a/b.jpg is served from <root>/a/b.jpg; for tests
+    # and offline development
+
+    def __init__(self, root):
+        self.root = os.path.realpath(root)
+
+    def __call__(self, url):
+        path = os.path.realpath(os.path.join(
+            self.root, urllib.parse.urlsplit(url).path.lstrip('/')))
+        if os.path.commonpath([self.root, path]) != self.root:
+            raise UnsafeSource(url)
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except OSError as error:
+            raise FetchError(url) from error
+
+
+# ----------------------------------------------------------------------------#
+# Thumbnail cache.
+# ----------------------------------------------------------------------------#
+
+def _digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def make_thumbnail(data, width):
+    # a WebP no wider than width, keeping the aspect ratio and never
+    # upscaling
+    try:
+        image = Image.open(io.BytesIO(data))
+        image.load()
+        image = ImageOps.exif_transpose(image)
+    except (UnidentifiedImageError, Image.DecompressionBombError,
+            OSError) as error:
+        raise FetchError('not a usable image') from error
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+    if image.width > width:
+        image = image.resize(
+            (width, max(1, round(image.height * width / image.width))),
+            Image.LANCZOS)
+    output = io.BytesIO()
+    image.save(output, 'WEBP', quality=app.config['IMAGE_QUALITY'])
+    return output.getvalue()
+
+
+class ThumbnailCache:
+    # thumbnails on disk under the sha256 of the original image, so
+    # entities sharing an image (by any link) share one file per width.
+    # Small link files map each link to the digest of its image, and
+    # failure files remember links that couldn't be fetched for
+    # IMAGE_FAILURE_TTL seconds. Files are touched on use and the least
+    # recently used are removed once the directory grows past
+    # IMAGE_CACHE_MAX_BYTES.
+
+    def __init__(self, fetcher=None):
+        self.fetcher = fetcher
+        self.directory = None
+        self.size = None
+        self.lock = threading.Lock()
+
+    def _path(self, kind, name):
+        if self.directory is None:
+            self.directory = os.path.join(app.instance_path,
+                                          app.config['IMAGE_CACHE_DIR'])
+        return os.path.join(self.directory, kind, name[:2], name)
+
+    def _read(self, path):
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        os.utime(path)
+        return data
+
+    def _write(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temporary, 'wb') as f:
+            f.write(data)
+        os.replace(temporary, path)
+        with self.lock:
+            if self.size is None:
+                self.size = self._disk_usage()[0]
+            self.size += len(data)
+            if self.size > app.config['IMAGE_CACHE_MAX_BYTES']:
+                self._evict()
+
+    def _disk_usage(self):
+        files = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        return sum(size for _, size, _ in files), files
+
+    def _evict(self):
+        # removes the least recently used files until the cache is back
+        # under 90% of its cap, so a full cache isn't rescanned every write
+        self.size, files = self._disk_usage()
+        target = app.config['IMAGE_CACHE_MAX_BYTES'] * 0.9
+        for _, size, path in sorted(files):
+            if self.size <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.size -= size
+
+    def thumbnail(self, url, width):
+        # the WebP thumbnail of the image at url, fetching and resizing it
+        # only when no cached copy exists
+        if self.fetcher is None:
+            self.fetcher = _configured_fetcher()
+        self._check_failure(url)
+        link_path = self._path('links', _digest(url.encode()))
+        digest = self._read(link_path)
+        if digest is not None:
+            data = self._read(self._path(
+                'thumbs', f'{digest.decode()}-{width}.webp'))
+            if data is not None:
+                record_cache('image', True)
+                return data
+
+        record_cache('image', False)
+        # concurrent requests for the same thumbnail share one fetch
+        return single_flight.do(('image', url, width),
+                                lambda: self._generate(url, width, link_path))
+
+    def _check_failure(self, url):
+        # raises the error a recent fetch of url failed with, so a dead or
+        # slow link isn't fetched again on every page view
+        path = self._path('failures', _digest(url.encode()))
+        try:
+            with open(path, 'rb') as f:
+                kind = f.read()
+            failed_at = os.stat(path).st_mtime
+        except FileNotFoundError:
+            return
+        if time.time() - failed_at < app.config['IMAGE_FAILURE_TTL']:
+            record_cache('image', True)
+            raise (UnsafeSource if kind == b'unsafe' else FetchError)(url)
+
+    def _generate(self, url, width, link_path):
+        try:
+            original = self.fetcher(url)
+            digest = _digest(original)
+            thumb_path = self._path('thumbs', f'{digest}-{width}.webp')
+            data = self._read(thumb_path)
+            if data is None:
+                data = make_thumbnail(original, width)
+                self._write(thumb_path, data)
+        except FetchError as error:
+            self._write(self._path('failures', _digest(url.encode())),
+                        b'unsafe' if isinstance(error, UnsafeSource)
+                        else b'failed')
+            raise
+        self._write(link_path, digest.encode())
+        return data
+
+
+thumbnails = ThumbnailCache()
+
+
+def _configured_fetcher():
+    if app.config['IMAGE_LOCAL_ROOT']:
+        return LocalFileFetcher(os.path.join(app.root_path,
+                                             app.config['IMAGE_LOCAL_ROOT']))
+    return HTTPFetcher(app.config['IMAGE_FETCH_TIMEOUT'],
+                       app.config['IMAGE_MAX_SOURCE_BYTES'])
+
+
+# ----------------------------------------------------------------------------#
+# Links.
+# ----------------------------------------------------------------------------#
+
+def sign(url, width):
+    # proxy links are signed so the proxy only fetches links the app has
+    # rendered itself
+    key = app.config['IMAGE_PROXY_KEY'] or app.secret_key
+    if isinstance(key, str):
+        key = key.encode()
+    return hmac.new(key, f'{width}:{url}'.encode(),
+                    hashlib.sha256).hexdigest()[:32]
+
+
+def verify(url, width, signature):
+    return width in app.config['IMAGE_WIDTHS'] and \
+        hmac.compare_digest(signature, sign(url, width))
+
+
+def thumb(url, width=320):
+    # {{ venue.image_link|thumb(640) }} links to the proxied thumbnail;
+    # empty links are left alone
+    if not url or width not in app.config['IMAGE_WIDTHS']:
+        return url
+    return url_for('image_thumbnail', width=width, url=url,
+                   sig=sign(url, width))
+
+
+app.jinja_env.filters['thumb'] = thumb
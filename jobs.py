@@ -0,0 +1,273 @@
+import datetime
+import random
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy.exc import IntegrityError
+from app import app, db
+from models import TZDateTime, UpcomingShow
+from sharding import shards
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+DEAD = 'dead'
+
+
+def _now():
+    # real time even inside a request, whose clock may be fixed by as_of
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+# ----------------------------------------------------------------------------#
+# Models.
+# ----------------------------------------------------------------------------#
+
+class Job(db.Model):
+    __tablename__ = 'job'
+    __table_args__ = (
+        db.Index('ix_job_status_run_at', 'status', 'run_at'),
+        # an idempotency key can only be held by one queued job at a time.
+        # Running jobs don't hold it: they may have read the rows before a
+        # write that enqueues the same work again.
+        db.Index('ix_job_queued_key', 'key', unique=True,
+                 postgresql_where=db.text("status = 'queued'"),
+                 sqlite_where=db.text("status = 'queued'")),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(120), nullable=False)
+    payload = db.Column(db.JSON)
+    key = db.Column(db.String(255))
+    status = db.Column(db.String(20), nullable=False, default=QUEUED)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False)
+    # UTC, so workers and the app agree whatever their zones
+    run_at = db.Column(TZDateTime, nullable=False, default=_now)
+    enqueued_at = db.Column(TZDateTime, nullable=False, default=_now)
+    started_at = db.Column(TZDateTime)
+    finished_at = db.Column(TZDateTime)
+    last_error = db.Column(db.Text)
+
+    def __repr__(self):
+        return f'<Job ID: {self.id}, Name: {self.name}, Status: ' \
+               f'{self.status}, Attempts: {self.attempts}>'
+
+
+# ----------------------------------------------------------------------------#
+# Queue.
+# ----------------------------------------------------------------------------#
+
+tasks = {}
+
+
+def task(name=None):
+    # registers a function the workers can run by name
+    def decorator(fn):
+        tasks[name or fn.__name__] = fn
+        return fn
+
+    return decorator
+
+
+def enqueue(name, payload=None, key=None, run_at=None, max_attempts=None):
+    # call after the request's own commit; returns the already queued job
+    # when one holds the same idempotency key
+    if key is not None:
+        queued = _queued_job(key)
+        if queued is not None:
+            return queued
+
+    job = Job(
+        name=name,
+        payload=payload or {},
+        key=key,
+        run_at=run_at or _now(),
+        max_attempts=max_attempts or app.config['JOBS_MAX_ATTEMPTS']
+    )
+
+    try:
+        db.session.add(job)
+        db.session.commit()
+    except IntegrityError:
+        # lost the race against another enqueue with the same key
+        db.session.rollback()
+        job = _queued_job(key)
+
+    return job
+
+
+def _queued_job(key):
+    return Job.query.filter(Job.key == key, Job.status == QUEUED).first()
+
+
+def _retry(job, run_at):
+    # queues the job again, unless a job queued since with the same key
+    # will do the same work
+    if job.key is not None and _queued_job(job.key) is not None:
+        job.status = DONE
+        job.finished_at = _now()
+    else:
+        job.status = QUEUED
+        job.run_at = run_at
+    db.session.flush()
+
+
+def backoff(attempts):
+    delay = min(app.config['JOBS_BACKOFF_BASE'] * 2 ** (attempts - 1),
+                app.config['JOBS_BACKOFF_MAX'])
+    # jitter so jobs that failed together don't retry together
+    return datetime.timedelta(seconds=delay * random.uniform(0.5, 1.0))
+
+
+def requeue_stale():
+    # jobs left running by a worker that died go back on the queue
+    cutoff = _now() - datetime.timedelta(
+        seconds=app.config['JOBS_VISIBILITY_TIMEOUT'])
+    stale = Job.query.filter(Job.status == RUNNING,
+                             Job.started_at < cutoff).all()
+    for job in stale:
+        _retry(job, job.run_at)
+    db.session.commit()
+
+
+def claim(limit):
+    # the conditional update makes claiming safe across worker processes
+    # without relying on row locks
+    now = _now()
+    candidates = db.session.query(Job.id).filter(
+        Job.status == QUEUED, Job.run_at <= now).order_by(
+        Job.run_at).limit(limit * 2).all()
+    claimed = []
+
+    for (job_id,) in candidates:
+        if len(claimed) == limit:
+            break
+        updated = Job.query.filter(
+            Job.id == job_id, Job.status == QUEUED).update({
+                'status': RUNNING,
+                'attempts': Job.attempts + 1,
+                'started_at': now
+            }, synchronize_session=False)
+        db.session.commit()
+        if updated:
+            claimed.append(job_id)
+
+    return claimed
+
+
+def run_job(job_id):
+    job = db.session.get(Job, job_id)
+    fn = tasks.get(job.name)
+
+    try:
+        if fn is None:
+            raise LookupError(f'No task registered as {job.name!r}')
+        fn(**job.payload)
+    except Exception:
+        db.session.rollback()
+        job = db.session.get(Job, job_id)
+        job.last_error = traceback.format_exc()
+        if job.attempts >= job.max_attempts:
+            job.status = DEAD
+            job.finished_at = _now()
+        else:
+            _retry(job, _now() + backoff(job.attempts))
+        app.logger.warning(f'Job {job.id} ({job.name}) failed on attempt '
+                           f'{job.attempts}')
+    else:
+        job.status = DONE
+        job.finished_at = _now()
+        job.last_error = None
+    finally:
+        db.session.commit()
+        db.session.close()
+
+
+def _run_in_context(job_id):
+    with app.app_context():
+        run_job(job_id)
+
+
+def work(concurrency, burst=False, poll_interval=1.0):
+    in_flight = set()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        while True:
+            requeue_stale()
+            free = concurrency - len(in_flight)
+            claimed = claim(free) if free else []
+
+            for job_id in claimed:
+                in_flight.add(pool.submit(_run_in_context, job_id))
+
+            if burst and not claimed and not in_flight:
+                return
+
+            if in_flight:
+                done, in_flight = wait(in_flight, timeout=poll_interval,
+                                       return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+            elif not claimed:
+                time.sleep(poll_interval)
+
+
+def stats():
+    now = _now()
+    depth = dict(db.session.query(Job.status, db.func.count()).group_by(
+        Job.status).all())
+    oldest = db.session.query(db.func.min(Job.run_at)).filter(
+        Job.status == QUEUED, Job.run_at <= now).scalar()
+
+    return {
+        'depth': {status: depth.get(status, 0)
+                  for status in (QUEUED, RUNNING, DONE, DEAD)},
+        'lag': (now - oldest).total_seconds() if oldest else 0.0
+    }
+
+
+# ----------------------------------------------------------------------------#
+# Tasks.
+# ----------------------------------------------------------------------------#
+
+@task()
+def sync_upcoming_shows(artist_id=None, venue_id=None):
+    if artist_id is not None:
+        # artists are booked by venues on every shard
+        shards.each(lambda: UpcomingShow.sync_artist(artist_id))
+    if venue_id is not None:
+        with shards.use_venue(venue_id):
+            UpcomingShow.sync_venue(venue_id)
+
+
+@task()
+def refresh_upcoming_shows():
+    shards.each(UpcomingShow.refresh)
+
+
+# ----------------------------------------------------------------------------#
+# CLI commands.
+# ----------------------------------------------------------------------------#
+
+jobs_cli = AppGroup('jobs', help='Run and inspect background jobs.')
+
+
+@jobs_cli.command('work')
+@click.option('--concurrency', type=int, default=None,
+              help='Number of jobs to run at once.')
+@click.option('--burst', is_flag=True,
+              help='Exit once the queue is empty.')
+def work_command(concurrency, burst):
+    work(concurrency or app.config['JOBS_CONCURRENCY'], burst=burst)
+
+
+@jobs_cli.command('stats')
+def stats_command():
+    queue = stats()
+    for status, count in queue['depth'].items():
+        click.echo(f'{status}: {count}')
+    click.echo(f"lag: {queue['lag']:.1f}s")
@@ -0,0 +1,336 @@
+import bisect
+import glob
+import json
+import os
+import time
+from collections import defaultdict
+
+from flask import g, request, has_request_context, before_render_template, \
+    template_rendered
+from sqlalchemy import event
+from app import app, db
+from sharding import shards
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+
+# ----------------------------------------------------------------------------#
+# Metric types.
+# ----------------------------------------------------------------------------#
+
+# Observations are plain dict/list updates without locks so they stay well
+# under a microsecond. Each process only ever writes its own values; under
+# gunicorn they are flushed to METRICS_DIR and merged at scrape time.
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.values = defaultdict(float)
+
+    def inc(self, *label_values, amount=1.0):
+        self.values[label_values] += amount
+
+    def snapshot(self):
+        return [[list(key), value] for key, value in self.values.items()]
+
+
+class Gauge(Counter):
+    # gauges are summed over live processes only
+    kind = 'gauge'
+
+    def dec(self, *label_values, amount=1.0):
+        self.values[label_values] -= amount
+
+    def set(self, *label_values, value):
+        self.values[label_values] = value
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(),
+                 buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        # per label set: [count per bucket..., count above the last, sum]
+        self.values = {}
+
+    def observe(self, value, *label_values):
+        try:
+            counts = self.values[label_values]
+        except KeyError:
+            counts = self.values[label_values] = [0] * (len(self.buckets) + 2)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def snapshot(self):
+        return [[list(key), list(value)] for key, value in self.values.items()]
+
+
+# ----------------------------------------------------------------------------#
+# Registry.
+# ----------------------------------------------------------------------------#
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = {}
+        self.collectors = []
+        self.flushed_at = 0.0
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labels=()):
+        return self.register(Counter(name, documentation, labels))
+
+    def gauge(self, name, documentation, labels=()):
+        return self.register(Gauge(name, documentation, labels))
+
+    def histogram(self, name, documentation, labels=(),
+                  buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def collector(self, fn):
+        # fn runs at scrape and flush time to refresh point-in-time gauges
+        self.collectors.append(fn)
+        return fn
+
+    def snapshot(self):
+        for collect in self.collectors:
+            collect()
+        return {name: metric.snapshot()
+                for name, metric in self.metrics.items()}
+
+    def flush(self, force=False):
+        directory = app.config['METRICS_DIR']
+        now = time.monotonic()
+        if directory is None or (
+                not force and
+                now - self.flushed_at < app.config['METRICS_FLUSH_INTERVAL']):
+            return
+        self.flushed_at = now
+
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f'{os.getpid()}.json')
+        with open(f'{path}.tmp', 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(f'{path}.tmp', path)
+
+    def collect(self):
+        # merges this process with every process that has flushed to
+        # METRICS_DIR: counters and histograms from all files, gauges only
+        # from processes that are still running
+        if app.config['METRICS_DIR'] is None:
+            return self.snapshot()
+
+        self.flush(force=True)
+        merged = {name: {} for name in self.metrics}
+        for path in glob.glob(os.path.join(app.config['METRICS_DIR'],
+                                           '*.json')):
+            pid = int(os.path.basename(path).split('.')[0])
+            try:
+                with open(path) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue
+            alive = _is_alive(pid)
+
+            for name, series in snapshot.items():
+                metric = self.metrics.get(name)
+                if metric is None or (metric.kind == 'gauge' and not alive):
+                    continue
+                for key, value in series:
+                    key = tuple(key)
+                    if metric.kind == 'histogram':
+                        total = merged[name].setdefault(
+                            key, [0] * len(value))
+                        for i, count in enumerate(value):
+                            total[i] += count
+                    else:
+                        merged[name][key] = merged[name].get(key, 0) + value
+
+        return {name: list(series.items())
+                for name, series in merged.items()}
+
+    def render(self):
+        lines = []
+        for name, series in self.collect().items():
+            metric = self.metrics[name]
+            lines.append(f'# HELP {name} {metric.documentation}')
+            lines.append(f'# TYPE {name} {metric.kind}')
+            for key, value in sorted(series, key=lambda item: list(item[0])):
+                labels = list(zip(metric.labels, key))
+                if metric.kind != 'histogram':
+                    lines.append(f'{name}{_labels(labels)} {value}')
+                    continue
+                cumulative = 0
+                bounds = [str(bound) for bound in metric.buckets] + ['+Inf']
+                for bound, count in zip(bounds, value[:-1]):
+                    cumulative += count
+                    lines.append(f'{name}_bucket'
+                                 f'{_labels(labels + [("le", bound)])} '
+                                 f'{cumulative}')
+                lines.append(f'{name}_sum{_labels(labels)} {value[-1]}')
+                lines.append(f'{name}_count{_labels(labels)} {cumulative}')
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(pairs):
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{label}="{value}"' for (label, _), value
+                          in zip(pairs, escaped)) + '}'
+
+
+def _is_alive(pid):
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+registry = Registry()
+
+request_duration = registry.histogram(
+    'fyyur_request_duration_seconds', 'Request latency by endpoint.',
+    ('endpoint', 'method'))
+request_db_duration = registry.histogram(
+    'fyyur_request_db_seconds', 'Time spent in database queries per request.',
+    ('endpoint',))
+request_template_duration = registry.histogram(
+    'fyyur_request_template_seconds',
+    'Time spent rendering templates per request.', ('endpoint',))
+requests_total = registry.counter(
+    'fyyur_requests_total', 'Requests by endpoint and status.',
+    ('endpoint', 'method', 'status'))
+requests_in_flight = registry.gauge(
+    'fyyur_requests_in_flight', 'Requests currently being handled.')
+db_query_duration = registry.histogram(
+    'fyyur_db_query_seconds', 'Database query latency.')
+db_pool = registry.gauge(
+    'fyyur_db_pool_connections',
+    'Database pool connections by engine and state.', ('engine', 'state'))
+cache_requests = registry.counter(
+    'fyyur_cache_requests_total', 'Cache lookups by cache and result.',
+    ('cache', 'result'))
+
+
+def record_cache(cache, hit):
+    cache_requests.inc(cache, 'hit' if hit else 'miss')
+
+
+# ----------------------------------------------------------------------------#
+# Instrumentation.
+# ----------------------------------------------------------------------------#
+
+@app.before_request
+def start_request_timer():
+    requests_in_flight.inc()
+    g.metrics_started = time.perf_counter()
+    g.metrics_db_time = 0.0
+    g.metrics_template_time = 0.0
+
+
+@app.after_request
+def record_request(response):
+    endpoint = request.endpoint or 'unmatched'
+    requests_total.inc(endpoint, request.method, str(response.status_code))
+    return response
+
+
+@app.teardown_request
+def finish_request_timer(error=None):
+    started = g.pop('metrics_started', None)
+    if started is None:
+        return
+    requests_in_flight.dec()
+    endpoint = request.endpoint or 'unmatched'
+    request_duration.observe(time.perf_counter() - started, endpoint,
+                             request.method)
+    request_db_duration.observe(g.metrics_db_time, endpoint)
+    request_template_duration.observe(g.metrics_template_time, endpoint)
+    registry.flush()
+
+
+@before_render_template.connect_via(app)
+def start_template_timer(sender, template, context, **extra):
+    g.metrics_template_started = time.perf_counter()
+
+
+@template_rendered.connect_via(app)
+def record_template(sender, template, context, **extra):
+    started = g.pop('metrics_template_started', None)
+    if started is not None and 'metrics_template_time' in g:
+        g.metrics_template_time += time.perf_counter() - started
+
+
+# query timing and pool stats for every engine: the primary database and,
+# when sharding is on, each shard
+engines = {}
+
+
+def instrument(name, engine):
+    engines[name] = engine
+    event.listen(engine, 'before_cursor_execute', start_query_timer)
+    event.listen(engine, 'after_cursor_execute', record_query)
+    event.listen(engine, 'handle_error', record_failed_query)
+
+
+def start_query_timer(conn, cursor, statement, parameters, context,
+                      executemany):
+    # kept on the execution context, which is dropped with the statement
+    # whether it succeeds or fails
+    context.metrics_query_started = time.perf_counter()
+
+
+def record_query(conn, cursor, statement, parameters, context, executemany):
+    _observe_query(context)
+
+
+def record_failed_query(exception_context):
+    if exception_context.execution_context is not None:
+        _observe_query(exception_context.execution_context)
+
+
+def _observe_query(context):
+    started = getattr(context, 'metrics_query_started', None)
+    if started is None:
+        return
+    del context.metrics_query_started
+    elapsed = time.perf_counter() - started
+    db_query_duration.observe(elapsed)
+    if has_request_context() and 'metrics_db_time' in g:
+        g.metrics_db_time += elapsed
+
+
+with app.app_context():
+    instrument('primary', db.engine)
+for name, shard_engine in shards.engines.items():
+    instrument(name, shard_engine)
+
+
+@registry.collector
+def collect_pool_stats():
+    for name, engine in engines.items():
+        pool = engine.pool
+        for state, stat in (('size', 'size'), ('checked_out', 'checkedout'),
+                            ('checked_in', 'checkedin'),
+                            ('overflow', 'overflow')):
+            if hasattr(pool, stat):
+                db_pool.set(name, state, value=getattr(pool, stat)())
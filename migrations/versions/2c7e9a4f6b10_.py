@@ -0,0 +1,39 @@
+"""change log
+
+Revision ID: 2c7e9a4f6b10
+Revises: d41f7b2e8a63
+Create Date: 2026-10-19 22:14:07.318452
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2c7e9a4f6b10'
+down_revision = 'd41f7b2e8a63'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('change_log',
+    sa.Column('seq', sa.Integer(), nullable=False),
+    sa.Column('entity', sa.String(length=20), nullable=False),
+    sa.Column('entity_id', sa.Integer(), nullable=False),
+    sa.Column('op', sa.String(length=10), nullable=False),
+    sa.Column('changed', sa.JSON(), nullable=True),
+    sa.Column('data', sa.JSON(), nullable=True),
+    sa.Column('created_at', sa.DateTime(timezone=True), nullable=False),
+    sa.PrimaryKeyConstraint('seq')
+    )
+    op.create_index('ix_change_log_entity_entity_id', 'change_log',
+                    ['entity', 'entity_id'], unique=False)
+    op.create_index('ix_change_log_created_at', 'change_log',
+                    ['created_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_change_log_created_at', table_name='change_log')
+    op.drop_index('ix_change_log_entity_entity_id', table_name='change_log')
+    op.drop_table('change_log')
@@ -0,0 +1,58 @@
+"""upcoming show read model
+
+Revision ID: 3f1c2a9d7b64
+Revises: afbc40542f50
+Create Date: 2026-10-19 09:12:41.508233
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1c2a9d7b64'
+down_revision = 'afbc40542f50'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('upcoming_show',
+    sa.Column('show_id', sa.Integer(), nullable=False),
+    sa.Column('start_time', sa.DateTime(), nullable=False),
+    sa.Column('artist_id', sa.Integer(), nullable=False),
+    sa.Column('artist_name', sa.String(), nullable=True),
+    sa.Column('artist_image_link', sa.String(length=500), nullable=True),
+    sa.Column('venue_id', sa.Integer(), nullable=False),
+    sa.Column('venue_name', sa.String(), nullable=True),
+    sa.Column('venue_image_link', sa.String(length=500), nullable=True),
+    sa.ForeignKeyConstraint(['show_id'], ['show.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('show_id')
+    )
+    op.create_index('ix_upcoming_show_artist_id_start_time', 'upcoming_show',
+                    ['artist_id', 'start_time'], unique=False)
+    op.create_index('ix_upcoming_show_start_time', 'upcoming_show',
+                    ['start_time'], unique=False)
+    op.create_index('ix_upcoming_show_venue_id_start_time', 'upcoming_show',
+                    ['venue_id', 'start_time'], unique=False)
+
+    # backfill from the existing shows
+    op.execute(
+        'INSERT INTO upcoming_show (show_id, start_time, artist_id, '
+        'artist_name, artist_image_link, venue_id, venue_name, '
+        'venue_image_link) '
+        'SELECT show.id, show.start_time, artist.id, artist.name, '
+        'artist.image_link, venue.id, venue.name, venue.image_link '
+        'FROM show JOIN artist ON show.artist_id = artist.id '
+        'JOIN venue ON show.venue_id = venue.id '
+        'WHERE show.start_time > CURRENT_TIMESTAMP'
+    )
+
+
+def downgrade():
+    op.drop_index('ix_upcoming_show_venue_id_start_time',
+                  table_name='upcoming_show')
+    op.drop_index('ix_upcoming_show_start_time', table_name='upcoming_show')
+    op.drop_index('ix_upcoming_show_artist_id_start_time',
+                  table_name='upcoming_show')
+    op.drop_table('upcoming_show')
@@ -0,0 +1,28 @@
+"""show start time and venue location indexes
+
+Revision ID: 5b8d3c6e1f07
+Revises: e2b9047f6c31
+Create Date: 2026-10-19 18:37:52.290614
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b8d3c6e1f07'
+down_revision = 'e2b9047f6c31'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_show_start_time', 'show', ['start_time'],
+                    unique=False)
+    op.create_index('ix_venue_state_city', 'venue', ['state', 'city'],
+                    unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_venue_state_city', table_name='venue')
+    op.drop_index('ix_show_start_time', table_name='show')
@@ -0,0 +1,29 @@
+"""rate limit buckets
+
+Revision ID: 6f3a8c1d9e25
+Revises: 9d2e5a71c4b8
+Create Date: 2026-10-19 20:58:41.603178
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6f3a8c1d9e25'
+down_revision = '9d2e5a71c4b8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('rate_limit_bucket',
+    sa.Column('key', sa.String(length=255), nullable=False),
+    sa.Column('tokens', sa.Float(), nullable=False),
+    sa.Column('updated_at', sa.Float(), nullable=False),
+    sa.PrimaryKeyConstraint('key')
+    )
+
+
+def downgrade():
+    op.drop_table('rate_limit_bucket')
@@ -0,0 +1,31 @@
+"""jobs only share an idempotency key while queued
+
+Revision ID: 7e1d4b9a3c52
+Revises: 2c7e9a4f6b10
+Create Date: 2026-10-20 10:12:41.502317
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7e1d4b9a3c52'
+down_revision = '2c7e9a4f6b10'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.drop_index('ix_job_pending_key', table_name='job')
+    op.create_index('ix_job_queued_key', 'job', ['key'], unique=True,
+                    postgresql_where=sa.text("status = 'queued'"),
+                    sqlite_where=sa.text("status = 'queued'"))
+
+
+def downgrade():
+    op.drop_index('ix_job_queued_key', table_name='job')
+    op.create_index('ix_job_pending_key', 'job', ['key'], unique=True,
+                    postgresql_where=sa.text(
+                        "status IN ('queued', 'running')"),
+                    sqlite_where=sa.text("status IN ('queued', 'running')"))
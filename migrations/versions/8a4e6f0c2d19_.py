@@ -0,0 +1,46 @@
+"""background job queue
+
+Revision ID: 8a4e6f0c2d19
+Revises: 3f1c2a9d7b64
+Create Date: 2026-10-19 11:03:27.114962
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8a4e6f0c2d19'
+down_revision = '3f1c2a9d7b64'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('job',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(length=120), nullable=False),
+    sa.Column('payload', sa.JSON(), nullable=True),
+    sa.Column('key', sa.String(length=255), nullable=True),
+    sa.Column('status', sa.String(length=20), nullable=False),
+    sa.Column('attempts', sa.Integer(), nullable=False),
+    sa.Column('max_attempts', sa.Integer(), nullable=False),
+    sa.Column('run_at', sa.DateTime(), nullable=False),
+    sa.Column('enqueued_at', sa.DateTime(), nullable=False),
+    sa.Column('started_at', sa.DateTime(), nullable=True),
+    sa.Column('finished_at', sa.DateTime(), nullable=True),
+    sa.Column('last_error', sa.Text(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_job_status_run_at', 'job', ['status', 'run_at'],
+                    unique=False)
+    op.create_index('ix_job_pending_key', 'job', ['key'], unique=True,
+                    postgresql_where=sa.text(
+                        "status IN ('queued', 'running')"),
+                    sqlite_where=sa.text("status IN ('queued', 'running')"))
+
+
+def downgrade():
+    op.drop_index('ix_job_pending_key', table_name='job')
+    op.drop_index('ix_job_status_run_at', table_name='job')
+    op.drop_table('job')
@@ -0,0 +1,28 @@
+"""show venue and artist start time indexes
+
+Revision ID: 9d2e5a71c4b8
+Revises: 5b8d3c6e1f07
+Create Date: 2026-10-19 20:12:08.417352
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9d2e5a71c4b8'
+down_revision = '5b8d3c6e1f07'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_show_venue_id_start_time', 'show',
+                    ['venue_id', 'start_time'], unique=False)
+    op.create_index('ix_show_artist_id_start_time', 'show',
+                    ['artist_id', 'start_time'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_show_artist_id_start_time', table_name='show')
+    op.drop_index('ix_show_venue_id_start_time', table_name='show')
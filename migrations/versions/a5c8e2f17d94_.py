@@ -0,0 +1,49 @@
+"""timezone-aware job times
+
+Revision ID: a5c8e2f17d94
+Revises: 7e1d4b9a3c52
+Create Date: 2026-10-20 10:48:05.913604
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a5c8e2f17d94'
+down_revision = '7e1d4b9a3c52'
+branch_labels = None
+depends_on = None
+
+COLUMNS = (('run_at', False), ('enqueued_at', False),
+           ('started_at', True), ('finished_at', True))
+
+
+def upgrade():
+    if op.get_bind().dialect.name == 'sqlite':
+        # SQLite stores the UTC time without an offset; existing values are
+        # server local time
+        for column, _ in COLUMNS:
+            op.execute(f"UPDATE job SET {column} = strftime("
+                       f"'%Y-%m-%d %H:%M:%S.000000', {column}, 'utc')")
+        return
+    # Postgres reads the existing values in the session's TimeZone
+    for column, nullable in COLUMNS:
+        op.alter_column('job', column,
+                        existing_type=sa.DateTime(),
+                        type_=sa.DateTime(timezone=True),
+                        existing_nullable=nullable)
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'sqlite':
+        for column, _ in COLUMNS:
+            op.execute(f"UPDATE job SET {column} = strftime("
+                       f"'%Y-%m-%d %H:%M:%S.000000', {column}, "
+                       f"'localtime')")
+        return
+    for column, nullable in COLUMNS:
+        op.alter_column('job', column,
+                        existing_type=sa.DateTime(timezone=True),
+                        type_=sa.DateTime(),
+                        existing_nullable=nullable)
@@ -0,0 +1,29 @@
+"""venue coordinates
+
+Revision ID: c57d1e83a0b2
+Revises: 8a4e6f0c2d19
+Create Date: 2026-10-19 13:48:55.603117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c57d1e83a0b2'
+down_revision = '8a4e6f0c2d19'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('venue', sa.Column('latitude', sa.Float(), nullable=True))
+    op.add_column('venue', sa.Column('longitude', sa.Float(), nullable=True))
+    op.create_index('ix_venue_latitude_longitude', 'venue',
+                    ['latitude', 'longitude'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_venue_latitude_longitude', table_name='venue')
+    op.drop_column('venue', 'longitude')
+    op.drop_column('venue', 'latitude')
@@ -0,0 +1,46 @@
+"""timezone-aware show start times
+
+Revision ID: d41f7b2e8a63
+Revises: 6f3a8c1d9e25
+Create Date: 2026-10-19 21:44:15.280931
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd41f7b2e8a63'
+down_revision = '6f3a8c1d9e25'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if op.get_bind().dialect.name == 'sqlite':
+        # SQLite stores the UTC time without an offset; existing values are
+        # server local time
+        for table in ('show', 'upcoming_show'):
+            op.execute(f"UPDATE {table} SET start_time = strftime("
+                       f"'%Y-%m-%d %H:%M:%S.000000', start_time, 'utc')")
+        return
+    # Postgres reads the existing values in the session's TimeZone
+    for table in ('show', 'upcoming_show'):
+        op.alter_column(table, 'start_time',
+                        existing_type=sa.DateTime(),
+                        type_=sa.DateTime(timezone=True),
+                        existing_nullable=False)
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'sqlite':
+        for table in ('show', 'upcoming_show'):
+            op.execute(f"UPDATE {table} SET start_time = strftime("
+                       f"'%Y-%m-%d %H:%M:%S.000000', start_time, "
+                       f"'localtime')")
+        return
+    for table in ('show', 'upcoming_show'):
+        op.alter_column(table, 'start_time',
+                        existing_type=sa.DateTime(timezone=True),
+                        type_=sa.DateTime(),
+                        existing_nullable=False)
@@ -0,0 +1,28 @@
+"""artist and venue versions for optimistic locking
+
+Revision ID: e2b9047f6c31
+Revises: c57d1e83a0b2
+Create Date: 2026-10-19 16:21:09.847310
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e2b9047f6c31'
+down_revision = 'c57d1e83a0b2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('artist', sa.Column('version', sa.Integer(), nullable=False,
+                                      server_default='1'))
+    op.add_column('venue', sa.Column('version', sa.Integer(), nullable=False,
+                                     server_default='1'))
+
+
+def downgrade():
+    op.drop_column('venue', 'version')
+    op.drop_column('artist', 'version')
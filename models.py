@@ -1,5 +1,51 @@
 import datetime
+from sqlalchemy import event
 from app import db
+import clock
+
+
+# ----------------------------------------------------------------------------#
+# Helpers.
+# ----------------------------------------------------------------------------#
+
+def apply_changes(entity, fields):
+    # only assigns values that differ so the flush sends just the changed
+    # columns, and nothing at all when the form was saved unchanged;
+    # returns the names of the changed fields
+    changed = []
+    for name, value in fields.items():
+        if getattr(entity, name) != value:
+            setattr(entity, name, value)
+            changed.append(name)
+    return changed
+
+
+class TZDateTime(db.TypeDecorator):
+    # timezone-aware datetimes on every backend. Naive values are taken to
+    # be in the app's timezone and everything comes back in UTC; SQLite has
+    # no offsets, so UTC is what gets stored there.
+    impl = db.DateTime(timezone=True)
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return value
+        value = clock.aware(value).astimezone(datetime.timezone.utc)
+        return value.replace(tzinfo=None) if dialect.name == 'sqlite' \
+            else value
+
+    def process_result_value(self, value, dialect):
+        if value is None or value.tzinfo is not None:
+            return value
+        return value.replace(tzinfo=datetime.timezone.utc)
+
+
+# genre lists; SQLite has no arrays, so they are stored as JSON there
+Genres = db.ARRAY(db.String).with_variant(db.JSON(), 'sqlite')
+
+
+def display_time(value):
+    return clock.local(value).strftime("%m-%d-%Y %H:%M")
 
 
 # ----------------------------------------------------------------------------#
@@ -22,8 +68,14 @@ class Show(db.Model):
         'Venue', backref=db.backref('venue_shows', cascade='all,delete')
     )
 
-    start_time = db.Column(db.DateTime, nullable=False,
-                           default=datetime.datetime.now)
+    start_time = db.Column(TZDateTime, nullable=False,
+                           default=clock.real_now)
+
+    __table_args__ = (
+        db.Index('ix_show_start_time', 'start_time'),
+        db.Index('ix_show_venue_id_start_time', 'venue_id', 'start_time'),
+        db.Index('ix_show_artist_id_start_time', 'artist_id', 'start_time'),
+    )
 
     def __repr__(self):
         return f'Artist ID: {self.artist_id}, Venue ' \
@@ -47,6 +99,29 @@ class Show(db.Model):
             'start_time': self.start_time
         }
 
+    @classmethod
+    def past(cls, related, **filters):
+        # shows that started before the request clock for e.g. venue_id=1,
+        # with the related artist or venue joined in. Upcoming shows are
+        # read from the UpcomingShow read model instead.
+        return cls.query.filter_by(**filters).filter(
+            cls.start_time < clock.now()).options(
+            db.joinedload(related)).order_by(cls.start_time, cls.id).all()
+
+    @classmethod
+    def markers(cls, **filters):
+        # (id of the latest show to have started, id of the next show to
+        # start) for e.g. venue_id=1, read in one round trip. Both change
+        # whenever a show moves from upcoming to past.
+        now = clock.now()
+        shows = db.select(cls.id).filter_by(**filters).limit(1)
+        last_past = shows.where(cls.start_time < now).order_by(
+            cls.start_time.desc(), cls.id.desc()).scalar_subquery()
+        next_upcoming = shows.where(cls.start_time >= now).order_by(
+            cls.start_time, cls.id).scalar_subquery()
+        return tuple(db.session.execute(
+            db.select(last_past, next_upcoming)).one())
+
 
 class Venue(db.Model):
     __tablename__ = 'venue'
@@ -57,12 +132,22 @@ class Venue(db.Model):
     state = db.Column(db.String(120))
     address = db.Column(db.String(120))
     phone = db.Column(db.String(120))
-    genres = db.Column(db.ARRAY(db.String))
+    genres = db.Column(Genres)
     image_link = db.Column(db.String(500))
     facebook_link = db.Column(db.String(120))
     website = db.Column(db.String(120))
     is_seeking_talent = db.Column(db.Boolean)
     seeking_description = db.Column(db.String(500))
+    latitude = db.Column(db.Float)
+    longitude = db.Column(db.Float)
+    version = db.Column(db.Integer, nullable=False, default=1)
+
+    __table_args__ = (
+        db.Index('ix_venue_latitude_longitude', 'latitude', 'longitude'),
+        db.Index('ix_venue_state_city', 'state', 'city'),
+    )
+    # updates are issued as UPDATE ... WHERE id = ? AND version = ?
+    __mapper_args__ = {'version_id_col': version}
 
     def __repr__(self):
         return f'<Venue ID: {self.id}, Name: {self.name}, Location: ' \
@@ -76,10 +161,8 @@ class Venue(db.Model):
         db.session.delete(self)
         db.session.commit()
 
-    def serialize(self):
-        past_shows = self.venue_past_shows()
-        upcoming_shows = self.venue_upcoming_shows()
-        return {
+    def serialize(self, shows=True):
+        data = {
             'id': self.id,
             'name': self.name,
             'city': self.city,
@@ -92,41 +175,36 @@ class Venue(db.Model):
             'website': self.website,
             'is_seeking_talent': self.is_seeking_talent,
             'seeking_description': self.seeking_description,
-            'venue_upcoming_shows_count': self.venue_upcoming_shows_count(),
+            'latitude': self.latitude,
+            'longitude': self.longitude
+        }
+        if shows:
+            data.update(self.serialize_shows())
+        return data
+
+    def serialize_shows(self):
+        upcoming_shows = UpcomingShow.upcoming(venue_id=self.id)
+        past_shows = Show.past(Show.artist, venue_id=self.id)
+        return {
+            'venue_upcoming_shows_count': len(upcoming_shows),
             'venue_upcoming_shows': [{
-                'artist_id': show.artist.id,
-                'artist_name': show.artist.name,
-                'artist_image_link': show.artist.image_link,
-                'start_time': show.start_time.strftime("%m-%d-%Y %H:%M")
+                'artist_id': show.artist_id,
+                'artist_name': show.artist_name,
+                'artist_image_link': show.artist_image_link,
+                'start_time': display_time(show.start_time)
             } for show in upcoming_shows],
+            'venue_past_shows_count': len(past_shows),
             'venue_past_shows': [{
                 'artist_id': show.artist.id,
                 'artist_name': show.artist.name,
                 'artist_image_link': show.artist.image_link,
-                'start_time': show.start_time.strftime("%m-%d-%Y %H:%M")
-            } for show in past_shows],
-            'venue_past_shows_count': self.venue_past_shows_count()
+                'start_time': display_time(show.start_time)
+            } for show in past_shows]
         }
 
     def venue_shows(self):
         return Show.query.filter_by(venue_id=self.id).all()
 
-    def venue_upcoming_shows(self):
-        return db.session.query(Show).filter(
-            Show.start_time > datetime.datetime.now(),
-            Show.venue_id == self.id).all()
-
-    def venue_upcoming_shows_count(self):
-        return len(self.venue_upcoming_shows())
-
-    def venue_past_shows(self):
-        return db.session.query(Show).filter(
-            Show.start_time < datetime.datetime.now(),
-            Show.venue_id == self.id).all()
-
-    def venue_past_shows_count(self):
-        return len(self.venue_past_shows())
-
 
 class Artist(db.Model):
     __tablename__ = 'artist'
@@ -136,12 +214,16 @@ class Artist(db.Model):
     city = db.Column(db.String(120))
     state = db.Column(db.String(120))
     phone = db.Column(db.String(120))
-    genres = db.Column(db.ARRAY(db.String))
+    genres = db.Column(Genres)
     image_link = db.Column(db.String(500))
     facebook_link = db.Column(db.String(120))
     website = db.Column(db.String(120))
     is_seeking_venue = db.Column(db.Boolean)
     seeking_description = db.Column(db.String(500))
+    version = db.Column(db.Integer, nullable=False, default=1)
+
+    # updates are issued as UPDATE ... WHERE id = ? AND version = ?
+    __mapper_args__ = {'version_id_col': version}
 
     def __repr__(self):
         return f'<Artist ID: {self.id}, Name: {self.name}>'
@@ -154,10 +236,8 @@ class Artist(db.Model):
         db.session.delete(self)
         db.session.commit()
 
-    def serialize(self):
-        past_shows = self.artist_past_shows()
-        upcoming_shows = self.artist_upcoming_shows()
-        return {
+    def serialize(self, shows=True):
+        data = {
             'id': self.id,
             'name': self.name,
             'city': self.city,
@@ -168,35 +248,155 @@ class Artist(db.Model):
             'facebook_link': self.facebook_link,
             'website': self.website,
             'is_seeking_venue': self.is_seeking_venue,
-            'seeking_description': self.seeking_description,
-            'artist_upcoming_shows_count': self.artist_upcoming_shows_count(),
+            'seeking_description': self.seeking_description
+        }
+        if shows:
+            data.update(self.serialize_shows())
+        return data
+
+    def serialize_shows(self):
+        upcoming_shows = UpcomingShow.upcoming(artist_id=self.id)
+        past_shows = Show.past(Show.venue, artist_id=self.id)
+        return {
+            'artist_upcoming_shows_count': len(upcoming_shows),
             'artist_upcoming_shows': [{
-                'venue_id': show.venue.id,
-                'venue_name': show.venue.name,
-                'venue_image_link': show.venue.image_link,
-                'start_time': show.start_time.strftime("%m-%d-%Y %H:%M")
+                'venue_id': show.venue_id,
+                'venue_name': show.venue_name,
+                'venue_image_link': show.venue_image_link,
+                'start_time': display_time(show.start_time)
             } for show in upcoming_shows],
+            'artist_past_shows_count': len(past_shows),
             'artist_past_shows': [{
                 'venue_id': show.venue.id,
                 'venue_name': show.venue.name,
                 'venue_image_link': show.venue.image_link,
-                'start_time': show.start_time.strftime("%m-%d-%Y %H:%M")
-            } for show in past_shows],
-            'artist_past_shows_count': self.artist_past_shows_count()
+                'start_time': display_time(show.start_time)
+            } for show in past_shows]
         }
 
-    def artist_upcoming_shows(self):
-        return db.session.query(Show).filter(
-            Show.start_time > datetime.datetime.now(),
-            Show.artist_id == self.id).all()
 
-    def artist_upcoming_shows_count(self):
-        return len(self.artist_upcoming_shows())
+# ----------------------------------------------------------------------------#
+# Read models.
+# ----------------------------------------------------------------------------#
+
+class UpcomingShow(db.Model):
+    # denormalized copy of every upcoming show with the artist and venue
+    # display fields already joined in, so listing pages can read upcoming
+    # shows with a single index scan. Show rows are kept in sync by
+    # the mapper events below, artist and venue renames are copied over by
+    # the sync_upcoming_shows job and expired rows are pruned by refresh().
+    __tablename__ = 'upcoming_show'
+    __table_args__ = (
+        db.Index('ix_upcoming_show_venue_id_start_time', 'venue_id',
+                 'start_time'),
+        db.Index('ix_upcoming_show_artist_id_start_time', 'artist_id',
+                 'start_time'),
+        db.Index('ix_upcoming_show_start_time', 'start_time'),
+    )
+
+    show_id = db.Column(db.Integer,
+                        db.ForeignKey('show.id', ondelete='CASCADE'),
+                        primary_key=True)
+    start_time = db.Column(TZDateTime, nullable=False)
+    artist_id = db.Column(db.Integer, nullable=False)
+    artist_name = db.Column(db.String)
+    artist_image_link = db.Column(db.String(500))
+    venue_id = db.Column(db.Integer, nullable=False)
+    venue_name = db.Column(db.String)
+    venue_image_link = db.Column(db.String(500))
+
+    def __repr__(self):
+        return f'<Upcoming Show ID: {self.show_id}, Artist: ' \
+               f'{self.artist_name}, Venue: {self.venue_name}, ' \
+               f'Start Time: {self.start_time}>'
+
+    @staticmethod
+    def source_query():
+        # the join the read model denormalizes, one row per show
+        return db.select(
+            Show.id, Show.start_time,
+            Artist.id, Artist.name, Artist.image_link,
+            Venue.id, Venue.name, Venue.image_link
+        ).join(Artist, Show.artist_id == Artist.id).join(
+            Venue, Show.venue_id == Venue.id)
+
+    @classmethod
+    def upcoming(cls, **filters):
+        # upcoming shows at the request clock for e.g. artist_id=1, without
+        # joins
+        return cls.query.filter_by(**filters).filter(
+            cls.start_time >= clock.now()).order_by(
+            cls.start_time, cls.show_id).all()
+
+    @classmethod
+    def counts_by_venue(cls):
+        rows = db.session.query(cls.venue_id, db.func.count()).filter(
+            cls.start_time >= clock.now()).group_by(
+            cls.venue_id).all()
+        return dict(rows)
+
+    @classmethod
+    def sync_artist(cls, artist_id):
+        artist = Artist.query.get(artist_id)
+        if artist is None:
+            return
+        cls.query.filter_by(artist_id=artist_id).update({
+            'artist_name': artist.name,
+            'artist_image_link': artist.image_link
+        }, synchronize_session=False)
+        db.session.commit()
+
+    @classmethod
+    def sync_venue(cls, venue_id):
+        venue = Venue.query.get(venue_id)
+        if venue is None:
+            return
+        cls.query.filter_by(venue_id=venue_id).update({
+            'venue_name': venue.name,
+            'venue_image_link': venue.image_link
+        }, synchronize_session=False)
+        db.session.commit()
+
+    @classmethod
+    def refresh(cls, full=False):
+        # drops rows for shows that have started; a full refresh rebuilds
+        # the whole table from the normalized models
+        now = clock.real_now()
+        table = cls.__table__
+
+        if full:
+            db.session.execute(table.delete())
+            db.session.execute(table.insert().from_select(
+                [c.name for c in table.columns],
+                cls.source_query().where(Show.start_time >= now)))
+        else:
+            db.session.execute(table.delete().where(table.c.start_time < now))
+
+        db.session.commit()
+
+
+# ----------------------------------------------------------------------------#
+# Read model maintenance.
+# ----------------------------------------------------------------------------#
+
+def _sync_upcoming_show(connection, show):
+    table = UpcomingShow.__table__
+    connection.execute(table.delete().where(table.c.show_id == show.id))
+    connection.execute(table.insert().from_select(
+        [c.name for c in table.columns],
+        UpcomingShow.source_query().where(
+            Show.id == show.id,
+            Show.start_time >= clock.real_now())))
+
+
+@event.listens_for(Show, 'after_insert')
+@event.listens_for(Show, 'after_update')
+def show_changed(mapper, connection, show):
+    _sync_upcoming_show(connection, show)
+
 
-    def artist_past_shows(self):
-        return db.session.query(Show).filter(
-            Show.start_time < datetime.datetime.now(),
-            Show.artist_id == self.id).all()
+@event.listens_for(Show, 'after_delete')
+def show_deleted(mapper, connection, show):
+    table = UpcomingShow.__table__
+    connection.execute(table.delete().where(table.c.show_id == show.id))
 
-    def artist_past_shows_count(self):
-        return len(self.artist_past_shows())
@@ -0,0 +1,343 @@
+import os
+import threading
+
+import click
+import numpy as np
+import scipy.sparse as sp
+from flask.cli import AppGroup
+from app import app, db
+from models import Show, Venue, Artist
+from jobs import enqueue, task
+from sharding import shards
+
+# upper bound on the number of dense score cells held in memory at once
+# while ranking, about 64MB of float64s
+CHUNK_CELLS = 8 * 1024 * 1024
+
+
+# ----------------------------------------------------------------------------#
+# Scoring.
+# ----------------------------------------------------------------------------#
+
+def _normalize_rows(matrix):
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1.0
+    return sp.diags(1.0 / norms) @ matrix
+
+
+def _rank(bookings, left_genres, right_genres, rows, top_k, genre_weight):
+    # scores every right-hand entity for each of the given left-hand rows:
+    # the co-booking cosine similarity of the left entity to every other
+    # left entity, spread over what those entities booked, plus the genre
+    # cosine similarity between the two sides. Already booked pairs are
+    # excluded. Returns (indices, scores) arrays of shape len(rows) x top_k,
+    # padded with -1 / 0 where fewer candidates scored above zero.
+    n_right = bookings.shape[1]
+    k = min(top_k, n_right)
+    indices = np.full((len(rows), k), -1, dtype=np.int64)
+    scores = np.zeros((len(rows), k))
+    if k == 0:
+        return indices, scores
+
+    normalized = _normalize_rows(bookings).tocsr()
+    left_genres = _normalize_rows(left_genres).tocsr()
+    right_genres_t = _normalize_rows(right_genres).T.tocsr()
+    chunk = max(1, CHUNK_CELLS // n_right)
+
+    for start in range(0, len(rows), chunk):
+        block = rows[start:start + chunk]
+        similar = normalized[block] @ normalized.T
+        dense = (similar @ bookings).toarray()
+        dense += genre_weight * (left_genres[block] @ right_genres_t).toarray()
+        dense[bookings[block].toarray() > 0] = -np.inf
+
+        top = np.argpartition(-dense, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(dense, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        top = np.take_along_axis(top, order, axis=1)
+        top_scores = np.take_along_axis(top_scores, order, axis=1)
+
+        keep = top_scores > 0
+        indices[start:start + len(block)] = np.where(keep, top, -1)
+        scores[start:start + len(block)] = np.where(keep, top_scores, 0)
+
+    return indices, scores
+
+
+# ----------------------------------------------------------------------------#
+# Index.
+# ----------------------------------------------------------------------------#
+
+class RecommendationIndex:
+    # artist x venue booking matrix, artist and venue genre matrices and the
+    # precomputed top-k neighbours in both directions. Rows are addressed
+    # by position; artist_ids / venue_ids map positions back to ids.
+
+    def __init__(self, artist_ids, venue_ids, genres, bookings,
+                 artist_genres, venue_genres, top_k, genre_weight):
+        self.artist_ids = list(artist_ids)
+        self.venue_ids = list(venue_ids)
+        self.genres = list(genres)
+        self.artist_row = {artist_id: i for i, artist_id
+                           in enumerate(self.artist_ids)}
+        self.venue_row = {venue_id: i for i, venue_id
+                          in enumerate(self.venue_ids)}
+        self.genre_col = {genre: i for i, genre in enumerate(self.genres)}
+        self.bookings = bookings.tocsr()
+        self.artist_genres = artist_genres.tocsr()
+        self.venue_genres = venue_genres.tocsr()
+        self.top_k = top_k
+        self.genre_weight = genre_weight
+        self.venues_for_artist = {}
+        self.artists_for_venue = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def empty(cls, top_k, genre_weight):
+        return cls([], [], [], sp.csr_matrix((0, 0)), sp.csr_matrix((0, 0)),
+                   sp.csr_matrix((0, 0)), top_k, genre_weight)
+
+    @classmethod
+    def build(cls, top_k, genre_weight):
+        # venues and their shows are split between the shards; every shard
+        # holds a copy of every artist
+        artists = sorted({
+            artist_id: (artist_id, genres)
+            for shard_artists in shards.each(lambda: db.session.query(
+                Artist.id, Artist.genres).all())
+            for artist_id, genres in shard_artists}.values())
+        venues = shards.scatter(lambda: db.session.query(
+            Venue.id, Venue.genres).order_by(Venue.id).all(),
+            key=lambda venue: venue[0])
+        pairs = sorted({pair for shard_pairs in shards.each(
+            lambda: db.session.query(
+                Show.artist_id, Show.venue_id).distinct().all())
+            for pair in shard_pairs})
+        genres = sorted({genre for _, entity_genres in artists + venues
+                         for genre in entity_genres or []})
+
+        index = cls([artist_id for artist_id, _ in artists],
+                    [venue_id for venue_id, _ in venues],
+                    genres, sp.csr_matrix((len(artists), len(venues))),
+                    sp.csr_matrix((len(artists), len(genres))),
+                    sp.csr_matrix((len(venues), len(genres))),
+                    top_k, genre_weight)
+        index.artist_genres = index._genre_matrix(artists)
+        index.venue_genres = index._genre_matrix(venues)
+
+        rows = [index.artist_row[artist_id] for artist_id, _ in pairs]
+        cols = [index.venue_row[venue_id] for _, venue_id in pairs]
+        index.bookings = sp.csr_matrix(
+            (np.ones(len(pairs)), (rows, cols)),
+            shape=(len(artists), len(venues)))
+
+        index.rank()
+        return index
+
+    def _genre_matrix(self, entities):
+        rows, cols = [], []
+        for row, (_, entity_genres) in enumerate(entities):
+            for genre in entity_genres or []:
+                if genre in self.genre_col:
+                    rows.append(row)
+                    cols.append(self.genre_col[genre])
+        return sp.csr_matrix((np.ones(len(rows)), (rows, cols)),
+                             shape=(len(entities), len(self.genres)))
+
+    def rank(self, artist_rows=None, venue_rows=None):
+        # recomputes the neighbour lists for the given rows, or all of them
+        if artist_rows is None:
+            artist_rows = np.arange(len(self.artist_ids))
+        if venue_rows is None:
+            venue_rows = np.arange(len(self.venue_ids))
+
+        indices, scores = _rank(
+            self.bookings, self.artist_genres, self.venue_genres,
+            np.asarray(artist_rows), self.top_k, self.genre_weight)
+        for row, cols, values in zip(artist_rows, indices, scores):
+            self.venues_for_artist[self.artist_ids[row]] = [
+                (self.venue_ids[col], float(value))
+                for col, value in zip(cols, values) if col >= 0]
+
+        indices, scores = _rank(
+            self.bookings.T.tocsr(), self.venue_genres, self.artist_genres,
+            np.asarray(venue_rows), self.top_k, self.genre_weight)
+        for row, cols, values in zip(venue_rows, indices, scores):
+            self.artists_for_venue[self.venue_ids[row]] = [
+                (self.artist_ids[col], float(value))
+                for col, value in zip(cols, values) if col >= 0]
+
+    def add_show(self, artist_id, venue_id):
+        # folds a new booking into the matrices and re-ranks only the two
+        # entities it touches; other rows catch up on the next full build
+        with self.lock:
+            if artist_id not in self.artist_row:
+                self._add_artist(artist_id)
+            if venue_id not in self.venue_row:
+                self._add_venue(venue_id)
+
+            row = self.artist_row[artist_id]
+            col = self.venue_row[venue_id]
+            if self.bookings[row, col]:
+                return
+            self.bookings = (self.bookings + sp.csr_matrix(
+                ([1.0], ([row], [col])), shape=self.bookings.shape)).tocsr()
+            self.rank(artist_rows=[row], venue_rows=[col])
+
+    def _add_artist(self, artist_id):
+        artist = Artist.query.get(artist_id)
+        self.artist_row[artist_id] = len(self.artist_ids)
+        self.artist_ids.append(artist_id)
+        self.artist_genres = sp.vstack([
+            self.artist_genres,
+            self._genre_matrix([(artist_id, artist.genres)])]).tocsr()
+        self.bookings = sp.vstack([
+            self.bookings,
+            sp.csr_matrix((1, len(self.venue_ids)))]).tocsr()
+
+    def _add_venue(self, venue_id):
+        venue = Venue.query.get(venue_id)
+        self.venue_row[venue_id] = len(self.venue_ids)
+        self.venue_ids.append(venue_id)
+        self.venue_genres = sp.vstack([
+            self.venue_genres,
+            self._genre_matrix([(venue_id, venue.genres)])]).tocsr()
+        self.bookings = sp.hstack([
+            self.bookings,
+            sp.csr_matrix((len(self.artist_ids), 1))]).tocsr()
+
+    def save(self, path):
+        arrays = {
+            'artist_ids': np.asarray(self.artist_ids, dtype=np.int64),
+            'venue_ids': np.asarray(self.venue_ids, dtype=np.int64),
+            'genres': np.asarray(self.genres, dtype=str),
+            'settings': np.asarray([self.top_k, self.genre_weight]),
+        }
+        for name in ('bookings', 'artist_genres', 'venue_genres'):
+            matrix = getattr(self, name)
+            arrays[f'{name}_data'] = matrix.data
+            arrays[f'{name}_indices'] = matrix.indices
+            arrays[f'{name}_indptr'] = matrix.indptr
+            arrays[f'{name}_shape'] = np.asarray(matrix.shape)
+        arrays.update(self._neighbour_arrays(
+            'venues_for_artist', self.artist_ids, self.venues_for_artist))
+        arrays.update(self._neighbour_arrays(
+            'artists_for_venue', self.venue_ids, self.artists_for_venue))
+
+        # write then rename so readers never load a half-written file
+        tmp_path = f'{path}.tmp.npz'
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, path)
+
+    def _neighbour_arrays(self, name, ids, neighbours):
+        indices = np.full((len(ids), self.top_k), -1, dtype=np.int64)
+        scores = np.zeros((len(ids), self.top_k))
+        for row, entity_id in enumerate(ids):
+            for col, (neighbour_id, score) in enumerate(
+                    neighbours.get(entity_id, [])):
+                indices[row, col] = neighbour_id
+                scores[row, col] = score
+        return {f'{name}_ids': indices, f'{name}_scores': scores}
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            matrices = [sp.csr_matrix(
+                (arrays[f'{name}_data'], arrays[f'{name}_indices'],
+                 arrays[f'{name}_indptr']),
+                shape=tuple(arrays[f'{name}_shape']))
+                for name in ('bookings', 'artist_genres', 'venue_genres')]
+            top_k, genre_weight = arrays['settings']
+            index = cls(arrays['artist_ids'].tolist(),
+                        arrays['venue_ids'].tolist(),
+                        arrays['genres'].tolist(), *matrices,
+                        int(top_k), float(genre_weight))
+            for name, ids in (('venues_for_artist', index.artist_ids),
+                              ('artists_for_venue', index.venue_ids)):
+                neighbours = getattr(index, name)
+                for entity_id, row_ids, row_scores in zip(
+                        ids, arrays[f'{name}_ids'], arrays[f'{name}_scores']):
+                    neighbours[entity_id] = [
+                        (int(neighbour_id), float(score))
+                        for neighbour_id, score in zip(row_ids, row_scores)
+                        if neighbour_id >= 0]
+        return index
+
+
+# ----------------------------------------------------------------------------#
+# Serving.
+# ----------------------------------------------------------------------------#
+
+class Recommendations:
+    # per-process holder for the index. Loads the file written by
+    # 'flask recommendations build' and reloads it when a newer build
+    # lands; without a file it serves no recommendations and has a worker
+    # build one, which takes too long for a request.
+
+    def __init__(self):
+        self.index = None
+        self.loaded_mtime = None
+        self.lock = threading.Lock()
+
+    @property
+    def path(self):
+        return os.path.join(app.instance_path,
+                            app.config['RECOMMENDATIONS_FILE'])
+
+    def get(self):
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            mtime = None
+
+        if self.index is None or mtime != self.loaded_mtime:
+            with self.lock:
+                if self.index is None or mtime != self.loaded_mtime:
+                    if mtime is None:
+                        enqueue('build_recommendations',
+                                key='build_recommendations')
+                        self.index = RecommendationIndex.empty(
+                            app.config['RECOMMENDATIONS_TOP_K'],
+                            app.config['RECOMMENDATIONS_GENRE_WEIGHT'])
+                    else:
+                        self.index = RecommendationIndex.load(self.path)
+                    self.loaded_mtime = mtime
+        return self.index
+
+    def venues_for_artist(self, artist_id):
+        return self.get().venues_for_artist.get(artist_id, [])
+
+    def artists_for_venue(self, venue_id):
+        return self.get().artists_for_venue.get(venue_id, [])
+
+    def add_show(self, artist_id, venue_id):
+        if self.index is not None:
+            self.index.add_show(artist_id, venue_id)
+
+
+recommendations = Recommendations()
+
+
+@task()
+def build_recommendations():
+    index = RecommendationIndex.build(
+        app.config['RECOMMENDATIONS_TOP_K'],
+        app.config['RECOMMENDATIONS_GENRE_WEIGHT'])
+    os.makedirs(app.instance_path, exist_ok=True)
+    index.save(recommendations.path)
+    return index
+
+
+# ----------------------------------------------------------------------------#
+# CLI commands.
+# ----------------------------------------------------------------------------#
+
+recommendations_cli = AppGroup(
+    'recommendations', help='Build the artist/venue recommendation index.')
+
+
+@recommendations_cli.command('build')
+def build_command():
+    index = build_recommendations()
+    click.echo(f'Recommendations built for {len(index.artist_ids)} artists '
+               f'and {len(index.venue_ids)} venues.')
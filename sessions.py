@@ -0,0 +1,191 @@
+import hashlib
+import os
+import secrets
+import sqlite3
+import threading
+import time
+
+import click
+from flask.cli import AppGroup
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from itsdangerous import BadSignature, Signer
+from werkzeug.datastructures import CallbackDict
+from app import app
+
+
+# ----------------------------------------------------------------------------#
+# Secret key.
+# ----------------------------------------------------------------------------#
+
+def load_secret_key(path):
+    # the key stored at path, generating it on first use. The new key is
+    # written aside and hard linked into place, which fails if another
+    # worker got there first, so workers starting together agree on one
+    # key and never read a half-written file.
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        pass
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary = f'{path}.{os.getpid()}.tmp'
+    fd = os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(secrets.token_bytes(32))
+    try:
+        os.link(temporary, path)
+    except FileExistsError:
+        pass
+    finally:
+        os.remove(temporary)
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+if not app.secret_key:
+    app.secret_key = load_secret_key(os.path.join(
+        app.instance_path, app.config['SECRET_KEY_FILE']))
+
+
+# ----------------------------------------------------------------------------#
+# Session store.
+# ----------------------------------------------------------------------------#
+
+class SqliteSessionStore:
+    # session data by session id in a SQLite file, shared by every worker
+    # process on the host. Each thread keeps its own connection.
+
+    def __init__(self, path=None):
+        self.path = path
+        self.local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None or self.local.pid != os.getpid():
+            path = self.path or os.path.join(app.instance_path,
+                                             app.config['SESSION_DB'])
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            connection = sqlite3.connect(path, timeout=10,
+                                         isolation_level=None)
+            # readers don't wait for writers in WAL mode
+            connection.execute('PRAGMA journal_mode = WAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS session ('
+                'id TEXT PRIMARY KEY, data TEXT NOT NULL, '
+                'expires_at REAL NOT NULL)')
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return connection
+
+    def load(self, session_id, now):
+        row = self._connection().execute(
+            'SELECT data FROM session WHERE id = ? AND expires_at > ?',
+            (session_id, now)).fetchone()
+        return row[0] if row is not None else None
+
+    def save(self, session_id, data, expires_at):
+        self._connection().execute(
+            'INSERT OR REPLACE INTO session (id, data, expires_at) '
+            'VALUES (?, ?, ?)', (session_id, data, expires_at))
+
+    def delete(self, session_id):
+        self._connection().execute('DELETE FROM session WHERE id = ?',
+                                   (session_id,))
+
+    def prune(self, now):
+        return self._connection().execute(
+            'DELETE FROM session WHERE expires_at <= ?', (now,)).rowcount
+
+
+# ----------------------------------------------------------------------------#
+# Session interface.
+# ----------------------------------------------------------------------------#
+
+class ServerSession(CallbackDict, SessionMixin):
+
+    def __init__(self, initial=None, session_id=None, new=False):
+        def on_update(session):
+            session.modified = True
+            session.accessed = True
+
+        super().__init__(initial, on_update)
+        self.session_id = session_id or secrets.token_urlsafe(32)
+        self.new = new
+        self.modified = False
+        self.accessed = False
+
+
+class ServerSessionInterface(SessionInterface):
+    # keeps the session (flashed messages, the CSRF token) in a store and
+    # only a signed session id in the cookie, so any worker can read it.
+    # Requests that don't touch the session neither read nor write the
+    # store beyond the initial load.
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, store):
+        self.store = store
+
+    def _signer(self, app):
+        return Signer(app.secret_key, salt='fyyur-session',
+                      key_derivation='hmac', digest_method=hashlib.sha256)
+
+    def open_session(self, app, request):
+        cookie = request.cookies.get(self.get_cookie_name(app))
+        if cookie:
+            try:
+                session_id = self._signer(app).unsign(cookie).decode()
+            except BadSignature:
+                session_id = None
+            data = session_id and self.store.load(session_id, time.time())
+            if data is not None:
+                return ServerSession(self.serializer.loads(data),
+                                     session_id)
+        return ServerSession(new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if not session:
+            # the last flashed message was read, or the session cleared
+            if session.modified and not session.new:
+                self.store.delete(session.session_id)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        if session.accessed:
+            response.vary.add('Cookie')
+        if not self.should_set_cookie(app, session):
+            return
+
+        self.store.save(
+            session.session_id, self.serializer.dumps(dict(session)),
+            time.time() + app.permanent_session_lifetime.total_seconds())
+        response.set_cookie(
+            name, self._signer(app).sign(session.session_id).decode(),
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app), domain=domain,
+            path=path, secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app))
+
+
+session_store = SqliteSessionStore()
+
+if app.config['SESSION_BACKEND'] == 'sqlite':
+    app.session_interface = ServerSessionInterface(session_store)
+
+
+# ----------------------------------------------------------------------------#
+# CLI commands.
+# ----------------------------------------------------------------------------#
+
+sessions_cli = AppGroup('sessions', help='Manage stored sessions.')
+
+
+@sessions_cli.command('prune')
+def prune_command():
+    pruned = session_store.prune(time.time())
+    click.echo(f'{pruned} expired sessions pruned.')
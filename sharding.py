@@ -0,0 +1,271 @@
+import contextlib
+import contextvars
+import heapq
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+import sqlalchemy as sa
+from flask import g, request
+from flask.cli import AppGroup
+from flask_sqlalchemy.session import Session
+
+# tables that stay in SQLALCHEMY_DATABASE_URI when sharding is on; every
+# other table lives in the shards
+PRIMARY_TABLES = {'job', 'rate_limit_bucket'}
+
+current_shard = contextvars.ContextVar('current_shard', default=None)
+
+
+# ----------------------------------------------------------------------------#
+# Routing session.
+# ----------------------------------------------------------------------------#
+
+class RoutingSession(Session):
+    # sends queries on sharded tables to the shard selected for the current
+    # request, job or scatter-gather branch, and falls back to the default
+    # shard when none is selected
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and shards.enabled and \
+                not _is_primary(mapper, clause):
+            return shards.engines[current_shard.get() or shards.default]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind,
+                                **kwargs)
+
+
+def _is_primary(mapper, clause):
+    if mapper is not None:
+        return mapper.local_table.name in PRIMARY_TABLES
+    table = getattr(clause, 'table', None)
+    return table is not None and table.name in PRIMARY_TABLES
+
+
+# ----------------------------------------------------------------------------#
+# Router.
+# ----------------------------------------------------------------------------#
+
+class ShardRouter:
+    # Venues live in the shard their state maps to, and shows (with the
+    # upcoming show read model) live alongside their venue. Artists are
+    # booked by venues in every region, so each artist is copied to every
+    # shard to keep show foreign keys local. Venue and artist ids are
+    # allocated so that id % number of shards is the index of their home
+    # shard, which lets id-based routes find the shard without a lookup.
+
+    def __init__(self):
+        self.app = None
+        self.names = []
+        self.engines = {}
+        self.engine_names = {}
+        self.regions = {}
+        self.default = None
+        # called with (connection, row, changed) for each artist copy
+        # written, inside its transaction
+        self.copy_listeners = []
+
+    @property
+    def enabled(self):
+        return bool(self.names)
+
+    def init_app(self, app, db, venue_model, artist_model):
+        self.app = app
+        self.db = db
+        self.names = sorted(app.config['SHARDS'])
+        self.regions = {state.upper(): name for state, name
+                        in app.config['SHARD_REGIONS'].items()}
+        self.default = app.config['SHARD_DEFAULT'] or \
+            (self.names[0] if self.names else None)
+        self.venue_model = venue_model
+        self.artist_model = artist_model
+
+        for name in self.names:
+            engine = sa.create_engine(app.config['SHARDS'][name])
+            self.engines[name] = engine
+            self.engine_names[engine] = name
+
+        if self.enabled:
+            app.before_request(self._route_request)
+            app.teardown_request(self._unroute_request)
+            for model in (venue_model, artist_model):
+                sa.event.listen(model, 'before_insert', self._allocate_id)
+
+    # routing
+
+    def shard_for_state(self, state):
+        return self.regions.get((state or '').upper(), self.default)
+
+    def shard_for_id(self, entity_id):
+        return self.names[int(entity_id) % len(self.names)]
+
+    @contextlib.contextmanager
+    def use(self, name):
+        token = current_shard.set(name)
+        try:
+            yield name
+        finally:
+            current_shard.reset(token)
+
+    def use_state(self, state):
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return self.use(self.shard_for_state(state))
+
+    def use_venue(self, venue_id):
+        # also used for artists, which are written on their home shard
+        try:
+            name = self.shard_for_id(venue_id) if self.enabled else None
+        except (TypeError, ValueError):
+            name = None
+        if name is None:
+            return contextlib.nullcontext()
+        return self.use(name)
+
+    use_artist = use_venue
+
+    def shards_for_ids(self, entity_ids):
+        names = set()
+        for entity_id in entity_ids:
+            try:
+                names.add(self.shard_for_id(entity_id))
+            except (TypeError, ValueError):
+                pass
+        return names
+
+    def _route_request(self):
+        # single-entity routes go straight to the entity's home shard
+        view_args = request.view_args or {}
+        names = self.shards_for_ids(
+            [view_args.get('venue_id', view_args.get('artist_id'))])
+        if names:
+            g.shard_token = current_shard.set(names.pop())
+
+    def _unroute_request(self, error=None):
+        token = g.pop('shard_token', None)
+        if token is not None:
+            current_shard.reset(token)
+
+    # scatter-gather
+
+    def _run_on(self, name, fn):
+        # each branch gets its own app context and so its own session
+        with self.app.app_context(), self.use(name):
+            return fn()
+
+    def each(self, fn):
+        # runs fn once per shard in parallel; returns the results in shard
+        # order. Without sharding fn runs once against the database. Each
+        # branch starts from a copy of the caller's context variables, so
+        # e.g. the request clock carries over.
+        if not self.enabled:
+            return [fn()]
+        branches = [(name, contextvars.copy_context()) for name in self.names]
+        with ThreadPoolExecutor(max_workers=len(self.names)) as pool:
+            return list(pool.map(
+                lambda branch: branch[1].run(self._run_on, branch[0], fn),
+                branches))
+
+    def scatter(self, fn, key=None, reverse=False):
+        # fn returns a list sorted by key on every shard; the lists are
+        # merged into one sorted list
+        return list(heapq.merge(*self.each(fn), key=key, reverse=reverse))
+
+    def stream(self, make_statement, key=None, **execution_options):
+        # like scatter for results too large to load: make_statement returns
+        # a select sorted by key, which is executed on every shard from the
+        # caller's session and merged lazily as the rows are read
+        if not self.enabled:
+            return iter(self.db.session.execute(
+                make_statement(), execution_options=execution_options))
+        results = []
+        for name in self.names:
+            with self.use(name):
+                results.append(iter(self.db.session.execute(
+                    make_statement(), execution_options=execution_options)))
+        return heapq.merge(*results, key=key)
+
+    # writes
+
+    def _allocate_id(self, mapper, connection, target):
+        if target.id is not None:
+            return
+        if connection.dialect.name == 'postgresql':
+            # sequences are stepped per shard by 'flask shards init'
+            return
+        count = len(self.names)
+        index = self.names.index(self.engine_names[connection.engine])
+        table = mapper.local_table
+        max_id = connection.execute(
+            sa.select(sa.func.max(table.c.id))).scalar() or 0
+        next_id = max_id - max_id % count + index
+        target.id = next_id if next_id > max_id else next_id + count
+
+    def replicate_artist(self, artist_id):
+        # copies the artist row from its home shard to every other shard,
+        # or removes the copies when it has been deleted
+        if not self.enabled:
+            return
+        table = self.artist_model.__table__
+        home = self.shard_for_id(artist_id)
+
+        with self.engines[home].connect() as connection:
+            row = connection.execute(table.select().where(
+                table.c.id == artist_id)).mappings().first()
+
+        for name in self.names:
+            if name == home:
+                continue
+            if row is None:
+                self._run_on(name, lambda: self._delete_artist(artist_id))
+                continue
+            with self.engines[name].begin() as connection:
+                copy = connection.execute(table.select().where(
+                    table.c.id == artist_id)).mappings().first()
+                if copy is None:
+                    changed = None
+                    connection.execute(table.insert().values(**row))
+                else:
+                    changed = [key for key in row if row[key] != copy[key]]
+                    if not changed:
+                        continue
+                    connection.execute(table.update().where(
+                        table.c.id == artist_id).values(**row))
+                for listener in self.copy_listeners:
+                    listener(connection, row, changed)
+
+    def _delete_artist(self, artist_id):
+        artist = self.db.session.get(self.artist_model, artist_id)
+        if artist is not None:
+            self.db.session.delete(artist)
+            self.db.session.commit()
+
+
+shards = ShardRouter()
+
+
+# ----------------------------------------------------------------------------#
+# CLI commands.
+# ----------------------------------------------------------------------------#
+
+shards_cli = AppGroup('shards', help='Manage region shards.')
+
+
+@shards_cli.command('init')
+def init_command():
+    db = shards.db
+    if not shards.enabled:
+        raise click.ClickException('No SHARDS are configured.')
+
+    tables = [table for table in db.metadata.sorted_tables
+              if table.name not in PRIMARY_TABLES]
+    for index, name in enumerate(shards.names):
+        engine = shards.engines[name]
+        db.metadata.create_all(engine, tables=tables)
+        if engine.dialect.name == 'postgresql':
+            with engine.begin() as connection:
+                for table in ('venue', 'artist'):
+                    connection.execute(sa.text(
+                        f'ALTER SEQUENCE {table}_id_seq '
+                        f'INCREMENT BY {len(shards.names)} '
+                        f'MINVALUE {index or len(shards.names)} '
+                        f'RESTART WITH {index or len(shards.names)}'))
+        click.echo(f'Shard {name} ready.')
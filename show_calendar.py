@@ -0,0 +1,246 @@
+import datetime
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import event
+from app import app, db
+from models import Show, Venue, Artist
+from metrics import record_cache
+from sharding import shards
+import clock
+
+BUCKETS = ('day', 'week')
+
+
+# ----------------------------------------------------------------------------#
+# Queries.
+# ----------------------------------------------------------------------------#
+
+def parse_range(args):
+    # start/end dates from the query string, end exclusive; defaults to the
+    # coming week. Raises ValueError for bad or oversized ranges.
+    start = datetime.date.fromisoformat(args['start']) if args.get('start') \
+        else clock.today()
+    end = datetime.date.fromisoformat(args['end']) if args.get('end') \
+        else start + datetime.timedelta(days=7)
+    if not start < end or \
+            (end - start).days > app.config['CALENDAR_MAX_DAYS']:
+        raise ValueError('invalid date range')
+    return start, end
+
+
+def _bucket_expression(bucket):
+    # truncates start_time to the start of its local day or (Monday) week
+    # in SQL. SQLite only knows the server's zone, so TIMEZONE is ignored
+    # there.
+    if db.engine.dialect.name == 'postgresql':
+        start_time = Show.start_time
+        if app.config['TIMEZONE']:
+            start_time = db.func.timezone(app.config['TIMEZONE'], start_time)
+        return db.func.date_trunc(bucket, start_time)
+    if bucket == 'week':
+        return db.func.date(Show.start_time, 'localtime', 'weekday 0',
+                            '-6 days')
+    return db.func.date(Show.start_time, 'localtime')
+
+
+def _as_date(value):
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    if isinstance(value, str):
+        return datetime.date.fromisoformat(value)
+    return value
+
+
+def _filtered(query, start, end, city, state):
+    query = query.join(Venue, Show.venue_id == Venue.id).filter(
+        Show.start_time >= datetime.datetime.combine(start, datetime.time()),
+        Show.start_time < datetime.datetime.combine(end, datetime.time()))
+    if city:
+        query = query.filter(db.func.lower(Venue.city) == city.lower())
+    if state:
+        query = query.filter(Venue.state == state.upper())
+    return query
+
+
+def bucket_counts(start, end, city=None, state=None, bucket='day'):
+    # [(bucket start date, number of shows)] for shows starting in
+    # [start, end), counted by the database of every shard
+    def count():
+        truncated = _bucket_expression(bucket).label('bucket')
+        return _filtered(
+            db.session.query(truncated, db.func.count(Show.id)),
+            start, end, city, state).group_by(truncated).all()
+
+    counts = {}
+    for rows in shards.each(count):
+        for day, shows in rows:
+            counts[_as_date(day)] = counts.get(_as_date(day), 0) + shows
+    return sorted(counts.items())
+
+
+def shows_query(start, end, city=None, state=None):
+    return _filtered(db.session.query(
+        Show.id, Show.start_time, Artist.id, Artist.name, Artist.image_link,
+        Venue.id, Venue.name, Venue.city, Venue.state
+    ).join(Artist, Show.artist_id == Artist.id), start, end, city,
+        state).order_by(Show.start_time, Show.id)
+
+
+def _serialize(row):
+    show_id, start_time, artist_id, artist_name, artist_image_link, \
+        venue_id, venue_name, venue_city, venue_state = row
+    return {
+        'show_id': show_id,
+        'start_time': clock.local(start_time).isoformat(),
+        'artist_id': artist_id,
+        'artist_name': artist_name,
+        'artist_image_link': artist_image_link,
+        'venue_id': venue_id,
+        'venue_name': venue_name,
+        'city': venue_city,
+        'state': venue_state
+    }
+
+
+def _by_start_time(row):
+    return row[1], row[0]
+
+
+def iter_shows(start, end, city=None, state=None):
+    # streams rows through a server-side cursor per shard instead of
+    # loading them all
+    rows = shards.stream(
+        lambda: shows_query(start, end, city, state).statement,
+        key=_by_start_time, stream_results=True,
+        yield_per=app.config['CALENDAR_STREAM_BATCH'])
+    for row in rows:
+        yield _serialize(row)
+
+
+# ----------------------------------------------------------------------------#
+# Day cache.
+# ----------------------------------------------------------------------------#
+
+class DayCache:
+    # shows per (day, city, state), evicted least recently used first or
+    # once CALENDAR_CACHE_TTL has passed. Entries for a day are dropped
+    # when a show on that day changes; that only reaches this process, so
+    # the ttl bounds how long other processes serve a stale day.
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                del self.entries[key]
+                entry = None
+            if entry is not None:
+                self.entries.move_to_end(key)
+        record_cache('show_calendar', entry is not None)
+        return entry[1] if entry is not None else None
+
+    def set(self, key, shows):
+        with self.lock:
+            self.entries[key] = (
+                time.monotonic() + app.config['CALENDAR_CACHE_TTL'], shows)
+            self.entries.move_to_end(key)
+            while len(self.entries) > app.config['CALENDAR_CACHE_SIZE']:
+                self.entries.popitem(last=False)
+
+    def invalidate_day(self, day):
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == day]:
+                del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+day_cache = DayCache()
+
+
+def shows_by_day(start, end, city=None, state=None):
+    # {day: [show, ...]} for every day in [start, end); days missing from
+    # the cache are loaded with a single query per shard
+    location = ((city or '').lower(), (state or '').upper())
+    days = [start + datetime.timedelta(days=n)
+            for n in range((end - start).days)]
+    result = {day: day_cache.get((day,) + location) for day in days}
+    missing = [day for day, shows in result.items() if shows is None]
+
+    if missing:
+        loaded = {day: [] for day in missing}
+        for show in map(_serialize, shards.stream(lambda: shows_query(
+                missing[0], missing[-1] + datetime.timedelta(days=1),
+                city, state).statement, key=_by_start_time)):
+            day = datetime.datetime.fromisoformat(show['start_time']).date()
+            if day in loaded:
+                loaded[day].append(show)
+        for day, shows in loaded.items():
+            day_cache.set((day,) + location, shows)
+        result.update(loaded)
+
+    return result
+
+
+@event.listens_for(Show, 'after_insert')
+@event.listens_for(Show, 'after_update')
+@event.listens_for(Show, 'after_delete')
+def show_changed(mapper, connection, show):
+    history = db.inspect(show).attrs.start_time.history
+    for start_time in [show.start_time] + list(history.deleted or []):
+        if start_time is not None:
+            day_cache.invalidate_day(clock.local(start_time).date())
+
+
+@event.listens_for(Artist, 'after_update')
+@event.listens_for(Venue, 'after_update')
+@event.listens_for(Venue, 'after_delete')
+@event.listens_for(Artist, 'after_delete')
+def entity_changed(mapper, connection, target):
+    # names, images and locations are copied into the cached shows
+    day_cache.clear()
+
+
+# ----------------------------------------------------------------------------#
+# Feeds.
+# ----------------------------------------------------------------------------#
+
+def _ical_text(value):
+    return str(value or '').replace('\\', '\\\\').replace(';', '\\;').replace(
+        ',', '\\,').replace('\n', '\\n')
+
+
+def iter_ical(start, end, city=None, state=None):
+    yield 'BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:-//Fyyur//Shows//EN\r\n'
+    stamp = datetime.datetime.now(datetime.timezone.utc).strftime(
+        '%Y%m%dT%H%M%SZ')
+    for show in iter_shows(start, end, city, state):
+        start_time = datetime.datetime.fromisoformat(
+            show['start_time']).astimezone(datetime.timezone.utc)
+        yield (
+            'BEGIN:VEVENT\r\n'
+            f"UID:show-{show['show_id']}@fyyur\r\n"
+            f'DTSTAMP:{stamp}\r\n'
+            f"DTSTART:{start_time.strftime('%Y%m%dT%H%M%SZ')}\r\n"
+            f"SUMMARY:{_ical_text(show['artist_name'])} at "
+            f"{_ical_text(show['venue_name'])}\r\n"
+            f"LOCATION:{_ical_text(show['city'])}\\, "
+            f"{_ical_text(show['state'])}\r\n"
+            'END:VEVENT\r\n'
+        )
+    yield 'END:VCALENDAR\r\n'
+
+
+def iter_json(start, end, city=None, state=None):
+    yield '['
+    for i, show in enumerate(iter_shows(start, end, city, state)):
+        yield (',' if i else '') + json.dumps(show)
+    yield ']'
@@ -0,0 +1,75 @@
+import os
+
+import numpy as np
+import pytest
+
+import analytics
+import clock
+
+
+@pytest.fixture
+def bookings(make_venue, make_artist, make_show):
+    hop = make_venue(name='The Musical Hop', state='CA')
+    park = make_venue(name='Park Square Live', city='New York', state='NY')
+    petals = make_artist(name='Guns N Petals', genres=['Rock n Roll'])
+    sax = make_artist(name='The Wild Sax Band', genres=['Jazz', 'Classical'])
+    for venue, artist, days in ((hop, petals, 1), (hop, petals, 2),
+                                (hop, sax, 3), (park, sax, 4),
+                                (park, sax, -40)):
+        make_show(venue, artist, days)
+    return analytics.Bookings.load()
+
+
+def report(name, bookings, processes=1):
+    counts = analytics.aggregate(bookings, processes)
+    return analytics.reports[name][1](bookings, counts)[1]
+
+
+def test_busiest_artists(bookings):
+    assert [row[1:] for row in report('busiest_artists', bookings)] == [
+        (2, 'The Wild Sax Band', 3), (1, 'Guns N Petals', 2)]
+
+
+def test_genre_mix_by_state(bookings):
+    assert report('genre_mix_by_state', bookings) == [
+        ('CA', 'Rock n Roll', 2, 0.5),
+        ('CA', 'Classical', 1, 0.25),
+        ('CA', 'Jazz', 1, 0.25),
+        ('NY', 'Classical', 2, 0.5),
+        ('NY', 'Jazz', 2, 0.5),
+    ]
+
+
+def test_shows_per_venue_month(bookings):
+    rows = report('shows_per_venue_month', bookings)
+
+    assert sum(row[-1] for row in rows) == 5
+    assert {row[1] for row in rows} == {'The Musical Hop', 'Park Square Live'}
+    assert f'{clock.today():%Y-%m}' <= max(row[4] for row in rows)
+
+
+def test_process_pool_matches_one_process(app, bookings, monkeypatch):
+    monkeypatch.setitem(app.config, 'ANALYTICS_PARALLEL_ROWS', 0)
+
+    serial = analytics.aggregate(bookings, 1)
+    parallel = analytics.aggregate(bookings, 2)
+
+    assert np.array_equal(serial[0], parallel[0])
+    assert np.array_equal(serial[1], parallel[1])
+    assert (serial[2] != parallel[2]).nnz == 0
+
+
+def test_reports_page_reads_built_reports(client, bookings):
+    summary = analytics.build(processes=1)
+
+    assert summary['shows'] == 5
+    assert os.path.exists(os.path.join(analytics.reports_dir(),
+                                       'busiest_artists.csv'))
+    page = client.get('/reports').get_data(as_text=True)
+    assert 'The Wild Sax Band' in page
+    assert 'Genre mix by state' in page
+
+    response = client.get('/reports/busiest_artists.csv')
+    assert response.get_data(as_text=True).splitlines()[0] == \
+        'rank,artist_id,artist,shows'
+    assert client.get('/reports/passwords.csv').status_code == 404
@@ -0,0 +1,144 @@
+import pytest
+
+from app import db
+from models import Artist
+
+
+def artist_form(artist, **fields):
+    data = {
+        'name': artist.name,
+        'city': artist.city,
+        'state': artist.state,
+        'phone': artist.phone,
+        'genres': artist.genres,
+        'image_link': artist.image_link or '',
+        'facebook_link': artist.facebook_link or '',
+        'website': artist.website or '',
+        'seeking_description': artist.seeking_description or '',
+        'version': artist.version,
+    }
+    if artist.is_seeking_venue:
+        data['is_seeking_venue'] = 'y'
+    data.update(fields)
+    return data
+
+
+def test_show_artist_splits_upcoming_and_past_shows(client, booked):
+    venue, artist, _ = booked
+
+    response = client.get(f'/artists/{artist.id}')
+
+    assert response.status_code == 200
+    assert b'2 Upcoming Shows' in response.data
+    assert b'1 Past Show<' in response.data
+    assert venue.name.encode() in response.data
+
+
+def test_show_artist_not_found(client):
+    assert client.get('/artists/404').status_code == 404
+
+
+def test_artists_are_listed(client, make_artist):
+    make_artist(name='Guns N Petals')
+    make_artist(name='Matt Quevedo')
+
+    response = client.get('/artists')
+
+    assert b'Guns N Petals' in response.data
+    assert b'Matt Quevedo' in response.data
+
+
+def test_search_artists(client, make_artist):
+    make_artist(name='Guns N Petals')
+    make_artist(name='Matt Quevedo')
+
+    response = client.post('/artists/search', data={'search_term': 'guns'})
+
+    assert b'Number of search results for "guns": 1' in response.data
+    assert b'Guns N Petals' in response.data
+
+
+def test_create_artist(client):
+    response = client.post('/artists/create', data={
+        'name': 'The Wild Sax Band',
+        'city': 'San Francisco',
+        'state': 'CA',
+        'genres': ['Jazz', 'Classical'],
+        'facebook_link': 'https://www.facebook.com/thewildsaxband',
+        'website': 'https://www.thewildsaxband.com',
+    })
+
+    assert b'was successfully listed' in response.data
+    artist = Artist.query.filter_by(name='The Wild Sax Band').one()
+    assert artist.genres == ['Jazz', 'Classical']
+
+
+def test_edit_artist(client, make_artist):
+    artist = make_artist()
+    artist_id = artist.id
+
+    response = client.post(f'/artists/{artist_id}/edit',
+                           data=artist_form(artist, city='Oakland'))
+
+    assert response.status_code == 302
+    artist = db.session.get(Artist, artist_id)
+    assert artist.city == 'Oakland'
+    assert artist.version == 2
+
+
+def test_batch_edit_is_all_or_nothing(client, make_artist):
+    artist = make_artist()
+    artist_id, version = artist.id, artist.version
+
+    response = client.post('/batch/edit', json={'artists': [
+        {'id': artist_id, 'version': version, 'fields': {'name': 'GNP'}},
+        {'id': 404, 'version': 1, 'fields': {'name': 'Missing'}},
+    ]})
+
+    assert response.status_code == 400
+    assert db.session.get(Artist, artist_id).name == 'Guns N Petals'
+
+    response = client.post('/batch/edit', json={'artists': [
+        {'id': artist_id, 'version': version, 'fields': {'name': 'GNP'}},
+    ]})
+
+    assert response.json['updated'] == [{'type': 'artists', 'id': artist_id,
+                                         'version': version + 1,
+                                         'changed': ['name']}]
+
+
+@pytest.mark.parametrize('payload', [
+    {'artists': {'id': 1}},
+    {'artists': ['GNP']},
+    {'artists': [{'id': '1', 'version': 1, 'fields': {'name': 'GNP'}}]},
+    {'artists': [{'id': 1, 'version': 1, 'fields': ['name']}]},
+])
+def test_batch_edit_rejects_malformed_payloads(client, payload):
+    response = client.post('/batch/edit', json=payload)
+
+    assert response.status_code == 400
+    assert response.json['errors'][0]['error'] in ('not a list',
+                                                   'malformed update')
+
+
+@pytest.mark.parametrize('fields, invalid', [
+    ({'name': ''}, 'name'),
+    ({'name': 42}, 'name'),
+    ({'state': 'XX'}, 'state'),
+    ({'genres': 'Jazz'}, 'genres'),
+    ({'genres': ['Polka']}, 'genres'),
+    ({'website': 'not a url'}, 'website'),
+    ({'is_seeking_venue': 'yes'}, 'is_seeking_venue'),
+])
+def test_batch_edit_validates_values_like_the_edit_form(client, make_artist,
+                                                        fields, invalid):
+    artist = make_artist()
+    artist_id, version = artist.id, artist.version
+
+    response = client.post('/batch/edit', json={'artists': [
+        {'id': artist_id, 'version': version, 'fields': fields},
+    ]})
+
+    assert response.status_code == 400
+    assert list(response.json['errors'][0]['fields']) == [invalid]
+    assert db.session.get(Artist, artist_id).version == version
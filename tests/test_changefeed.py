@@ -0,0 +1,118 @@
+import datetime
+import threading
+
+import pytest
+
+from app import db
+from changefeed import INSERT, ChangeLog, _record, compact
+from models import Venue
+
+
+def test_writes_are_logged_with_the_full_row(make_venue):
+    venue = make_venue()
+    venue.name = 'The Musical Hip'
+    db.session.commit()
+
+    inserted, updated = ChangeLog.query.order_by(ChangeLog.seq).all()
+    assert (inserted.entity, inserted.entity_id, inserted.op) == \
+        ('venue', venue.id, 'insert')
+    assert updated.op == 'update'
+    assert updated.changed == ['name']
+    assert updated.data['version'] == 2
+    assert updated.data['name'] == 'The Musical Hip'
+    assert updated.data['genres'] == ['Jazz', 'Reggae']
+
+
+def test_rolled_back_writes_are_not_logged(make_venue):
+    venue = make_venue()
+    venue.name = 'The Musical Hip'
+    db.session.flush()
+    db.session.rollback()
+
+    assert [change.op for change in ChangeLog.query] == ['insert']
+
+
+def test_changes_are_read_in_batches(client, booked):
+    # a venue, an artist and three shows
+    response = client.get('/changes?after=0&limit=3')
+    assert [change['entity'] for change in response.json['data']] == \
+        ['venue', 'artist', 'show']
+
+    response = client.get(f'/changes?after={response.json["next"]}')
+    assert [change['entity'] for change in response.json['data']] == \
+        ['show', 'show']
+
+    response = client.get(f'/changes?after={response.json["next"]}')
+    assert response.json['count'] == 0
+
+
+@pytest.mark.parametrize('limit, count', [
+    ('-1', 1), ('0', 1), ('2', 2), ('100', 3),
+])
+def test_change_batches_are_clamped(app, client, make_venue, monkeypatch,
+                                    limit, count):
+    monkeypatch.setitem(app.config, 'CHANGE_LOG_BATCH', 3)
+    for _ in range(4):
+        make_venue()
+
+    response = client.get(f'/changes?after=0&limit={limit}')
+
+    assert response.status_code == 200
+    assert response.json['count'] == count
+
+
+def test_changes_are_read_as_soon_as_they_commit(client, make_venue):
+    make_venue()
+
+    assert client.get('/changes?after=0').json['count'] == 1
+
+
+def test_logged_writes_commit_in_sequence_order(engine):
+    # a transaction taking a sequence number waits for the one that took
+    # the number before it to commit, so readers never pass over it
+    if engine.dialect.name != 'postgresql':
+        pytest.skip('SQLite allows one writer at a time')
+    table = ChangeLog.__table__
+    done = threading.Event()
+
+    def second():
+        with engine.begin() as connection:
+            _record(connection, 'venue', -2, INSERT)
+        done.set()
+
+    try:
+        with engine.begin() as connection:
+            _record(connection, 'venue', -1, INSERT)
+            thread = threading.Thread(target=second)
+            thread.start()
+            assert not done.wait(0.2)
+        assert done.wait(5)
+        thread.join()
+    finally:
+        with engine.begin() as connection:
+            connection.execute(table.delete().where(table.c.entity_id < 0))
+
+
+def test_changes_from_unknown_shard(client):
+    assert client.get('/changes?shard=moon').status_code == 404
+
+
+@pytest.mark.parametrize('deleted', [False, True])
+def test_compaction_keeps_the_latest_entry(make_venue, deleted):
+    venue = make_venue()
+    venue.name = 'The Musical Hip'
+    db.session.commit()
+    if deleted:
+        Venue.delete(venue)
+
+    removed = compact(datetime.datetime.now(datetime.timezone.utc) +
+                      datetime.timedelta(seconds=1))
+
+    remaining = ChangeLog.query.all()
+    if deleted:
+        assert removed == 3
+        assert remaining == []
+    else:
+        assert removed == 1
+        assert [(change.op, change.data['name']) for change in remaining] \
+            == [('update', 'The Musical Hip')]
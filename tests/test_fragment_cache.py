@@ -0,0 +1,98 @@
+import time
+
+import pytest
+
+from app import app as flask_app, db
+from fragment_cache import FragmentCache, fragment_cache
+from models import UpcomingShow
+
+
+@pytest.fixture
+def cache(app, monkeypatch):
+    monkeypatch.setitem(app.config, 'FRAGMENT_CACHE_SIZE', 2)
+    return FragmentCache()
+
+
+def test_least_recently_used_fragments_are_evicted(cache):
+    cache.set('a', 'A', 60)
+    cache.set('b', 'B', 60)
+    cache.get('a')
+
+    cache.set('c', 'C', 60)
+
+    assert (cache.get('a'), cache.get('b'), cache.get('c')) == \
+        ('A', None, 'C')
+
+
+def test_fragments_expire(cache, monkeypatch):
+    cache.set('a', 'A', 60)
+    later = time.monotonic() + 61
+    monkeypatch.setattr(time, 'monotonic', lambda: later)
+
+    assert cache.get('a') is None
+    assert cache.entries == {}
+
+
+def test_invalidation_drops_tagged_fragments(cache):
+    cache.set('a', 'A', 60, tags=['venue:1', 'artist:1'])
+    cache.set('b', 'B', 60, tags=['venue:2'])
+
+    cache.invalidate('artist:1')
+
+    assert (cache.get('a'), cache.get('b')) == (None, 'B')
+    assert cache.tagged == {'venue:2': {'b'}}
+
+
+def test_cache_tag_renders_the_body_once(app):
+    template = flask_app.jinja_env.from_string(
+        "{% cache ['greeting', name], tags=['test'] %}"
+        "{{ calls.append(1) or name }}{% endcache %}")
+    calls = []
+
+    with app.test_request_context():
+        rendered = [template.render(name=name, calls=calls)
+                    for name in ('Hop', 'Hop', 'Pianos')]
+        fragment_cache.invalidate('test')
+        rendered.append(template.render(name='Hop', calls=calls))
+
+    assert rendered == ['Hop', 'Hop', 'Pianos', 'Hop']
+    assert len(calls) == 3
+
+
+def test_detail_pages_are_served_from_the_cache(client, booked):
+    venue, _, _ = booked
+    client.get(f'/venues/{venue.id}')
+    # the cached fragment hides writes the page would otherwise show
+    UpcomingShow.query.update({'artist_name': 'Renamed Band'})
+    db.session.commit()
+
+    assert b'Renamed Band' not in client.get(f'/venues/{venue.id}').data
+
+
+def test_show_writes_invalidate_their_pages(client, booked, make_venue,
+                                            make_show):
+    venue, artist, _ = booked
+    client.get(f'/venues/{venue.id}')
+    client.get(f'/artists/{artist.id}')
+
+    make_show(make_venue(name='Park Square Live'), artist, days=3)
+
+    # the new show isn't the artist's next one, so only invalidation
+    # brings it in
+    assert b'3 Upcoming Shows' in client.get(f'/artists/{artist.id}').data
+    # the booked venue's fragments, which the show doesn't touch, stay
+    # cached
+    assert any(key.startswith(f"['venue_upcoming_shows', {venue.id},")
+               for key in fragment_cache.entries)
+
+
+def test_artist_and_venue_edits_clear_the_cache(client, booked):
+    venue, artist, _ = booked
+    client.get(f'/venues/{venue.id}')
+    assert fragment_cache.entries
+
+    artist.name = 'GNP'
+    db.session.commit()
+
+    assert fragment_cache.entries == {}
+    assert b'GNP' in client.get(f'/venues/{venue.id}').data
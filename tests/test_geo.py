@@ -0,0 +1,131 @@
+import math
+import random
+
+import pytest
+
+import geo
+from app import db
+from geo import KDTree, chord_to_km, km_to_chord, to_unit_vector
+
+
+def brute_force(points, target):
+    return sorted((math.dist(vector, target), item)
+                  for vector, item in points)
+
+
+@pytest.fixture
+def points():
+    # scattered places with a few exact duplicates
+    places = random.Random(7)
+    coordinates = [(places.uniform(-90, 90), places.uniform(-180, 180))
+                   for _ in range(300)]
+    coordinates += coordinates[:5]
+    return [(to_unit_vector(lat, lon), item)
+            for item, (lat, lon) in enumerate(coordinates)]
+
+
+@pytest.mark.parametrize('k', [1, 5, 50, 400])
+def test_nearest_matches_brute_force(points, k):
+    tree = KDTree(points)
+    target = to_unit_vector(37.77, -122.42)
+
+    found = tree.nearest(target, k)
+
+    expected = brute_force(points, target)[:k]
+    assert [item for _, item in found] == [item for _, item in expected]
+    assert [distance for distance, _ in found] == \
+        pytest.approx([distance for distance, _ in expected])
+
+
+@pytest.mark.parametrize('km', [0, 500, 3000, 30000])
+def test_within_matches_brute_force(points, km):
+    tree = KDTree(points)
+    target = to_unit_vector(40.71, -74.01)
+
+    found = tree.within(target, km_to_chord(km))
+
+    expected = [(distance, item) for distance, item
+                in brute_force(points, target)
+                if distance <= km_to_chord(km)]
+    assert [item for _, item in found] == [item for _, item in expected]
+    assert [distance for distance, _ in found] == \
+        pytest.approx([distance for distance, _ in expected])
+
+
+def test_empty_tree_finds_nothing():
+    tree = KDTree([])
+
+    assert tree.nearest(to_unit_vector(0, 0), 5) == []
+    assert tree.within(to_unit_vector(0, 0), 1.0) == []
+
+
+def test_chord_distances_are_great_circle_distances():
+    san_francisco = to_unit_vector(37.7749, -122.4194)
+    new_york = to_unit_vector(40.7128, -74.0060)
+
+    km = chord_to_km(math.dist(san_francisco, new_york))
+
+    assert km == pytest.approx(4129, abs=5)
+    assert km_to_chord(km) == pytest.approx(math.dist(san_francisco,
+                                                      new_york))
+
+
+def test_geocode_ignores_case_and_spacing():
+    assert geo.geocode('  san   FRANCISCO ', 'ca') == (37.7749, -122.4194)
+    assert geo.geocode('Atlantis', 'CA') is None
+
+
+def test_venue_writes_rebuild_the_index(make_venue):
+    venue = make_venue(latitude=37.77, longitude=-122.42)
+    assert geo.venue_index.get().size == 1
+
+    venue.latitude = venue.longitude = None
+    db.session.commit()
+
+    assert geo.venue_index.get().size == 0
+
+
+def test_nearby_venues_closest_first(client, make_venue):
+    make_venue(name='Park Square Live', city='New York', state='NY',
+               latitude=40.71, longitude=-74.01)
+    make_venue(latitude=37.77, longitude=-122.42)
+    make_venue(name='Unlocated')
+
+    response = client.get('/venues/near?lat=37.8&lon=-122.3')
+    assert [(venue['name'], round(venue['distance_km'])) for venue
+            in response.json['data']] == [('The Musical Hop', 11),
+                                          ('Park Square Live', 4118)]
+
+    response = client.get('/venues/near?lat=37.8&lon=-122.3&radius=100')
+    assert [venue['name'] for venue in response.json['data']] == \
+        ['The Musical Hop']
+
+
+@pytest.mark.parametrize('query', [
+    'lat=north&lon=0',
+    'lat=0',
+    'lat=nan&lon=0',
+    'lat=0&lon=inf',
+    'lat=91&lon=0',
+    'lat=0&lon=-180.5',
+    'lat=0&lon=0&radius=-5',
+    'lat=0&lon=0&radius=nan',
+    'lat=0&lon=0&radius=inf',
+])
+def test_nearby_venues_need_a_valid_location(client, query):
+    assert client.get(f'/venues/near?{query}').status_code == 400
+
+
+def test_nearby_venue_limits_are_clamped(client, make_venue):
+    for _ in range(3):
+        make_venue(latitude=37.77, longitude=-122.42)
+
+    for limit, count in (('-2', 1), ('0', 1), ('2', 2), ('500', 3)):
+        for radius in ('', '&radius=100'):
+            response = client.get(
+                f'/venues/near?lat=37.8&lon=-122.3&limit={limit}{radius}')
+            assert response.json['count'] == count
+
+
+def test_negative_radius_finds_nothing(points):
+    assert KDTree(points).within(to_unit_vector(0, 0), -0.5) == []
@@ -0,0 +1,189 @@
+import http.server
+import io
+import socket
+import threading
+
+import pytest
+from PIL import Image
+
+import images
+from images import FetchError, HTTPFetcher, UnsafeSource
+
+# a global address standing in for a public image host; connections to it
+# are sent to the local test server
+PUBLIC = '93.184.216.34'
+
+
+def png(width=800, height=400):
+    output = io.BytesIO()
+    Image.new('RGB', (width, height), 'red').save(output, 'PNG')
+    return output.getvalue()
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    routes = {}
+
+    def do_GET(self):
+        status, headers, body = self.routes.get(self.path, (404, {}, b''))
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server(monkeypatch):
+    # an image host on localhost, reachable as public.example. Lookups of
+    # *.internal resolve to a private address.
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    port = httpd.server_address[1]
+    threading.Thread(target=httpd.serve_forever, args=(0.05,),
+                     daemon=True).start()
+    lookups, connections = [], []
+    getaddrinfo = socket.getaddrinfo
+    create_connection = socket.create_connection
+
+    def resolve(host, *args, **kwargs):
+        lookups.append(host)
+        if host == 'public.example':
+            return [(socket.AF_INET, socket.SOCK_STREAM, 6, '',
+                     (PUBLIC, args[0]))]
+        if host.endswith('.internal'):
+            return [(socket.AF_INET, socket.SOCK_STREAM, 6, '',
+                     ('10.0.0.1', args[0]))]
+        return getaddrinfo(host, *args, **kwargs)
+
+    def connect(address, *args, **kwargs):
+        connections.append(address[0])
+        if address[0] == PUBLIC:
+            address = ('127.0.0.1', address[1])
+        return create_connection(address, *args, **kwargs)
+
+    monkeypatch.setattr(socket, 'getaddrinfo', resolve)
+    monkeypatch.setattr(socket, 'create_connection', connect)
+    monkeypatch.setattr(Handler, 'routes', {})
+    httpd.base = f'http://public.example:{port}'
+    httpd.port = port
+    httpd.lookups = lookups
+    httpd.connections = connections
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_fetches_from_public_hosts(server):
+    Handler.routes['/a.png'] = (200, {}, b'image')
+
+    assert HTTPFetcher()(f'{server.base}/a.png') == b'image'
+
+
+@pytest.mark.parametrize('url', [
+    'http://127.0.0.1/a.png',
+    'http://169.254.169.254/latest/meta-data/',
+    'http://metadata.internal/a.png',
+    'file:///etc/passwd',
+])
+def test_refuses_private_addresses(server, url):
+    with pytest.raises(UnsafeSource):
+        HTTPFetcher()(url)
+
+
+@pytest.mark.parametrize('location', [
+    'http://127.0.0.1:{port}/secret',
+    'http://169.254.169.254/latest/meta-data/',
+    'http://metadata.internal/secret',
+])
+def test_refuses_redirects_to_private_addresses(server, location):
+    Handler.routes['/a.png'] = (
+        302, {'Location': location.format(port=server.port)}, b'')
+    Handler.routes['/secret'] = (200, {}, b'secret')
+
+    with pytest.raises(UnsafeSource):
+        HTTPFetcher()(f'{server.base}/a.png')
+
+
+def test_follows_redirects_between_public_hosts(server):
+    Handler.routes['/a.png'] = (301, {'Location': '/b.png'}, b'')
+    Handler.routes['/b.png'] = (200, {}, b'image')
+
+    assert HTTPFetcher()(f'{server.base}/a.png') == b'image'
+    # each hop is resolved once, and connected to as resolved
+    assert server.lookups.count('public.example') == 2
+    assert server.connections == [PUBLIC, PUBLIC]
+
+
+def test_redirect_loops_give_up(server):
+    Handler.routes['/a.png'] = (302, {'Location': '/a.png'}, b'')
+
+    with pytest.raises(FetchError):
+        HTTPFetcher(max_redirects=2)(f'{server.base}/a.png')
+
+
+def test_refuses_oversized_images(server):
+    Handler.routes['/a.png'] = (200, {}, b'x' * 11)
+
+    with pytest.raises(FetchError):
+        HTTPFetcher(max_bytes=10)(f'{server.base}/a.png')
+
+
+def test_proxy_serves_and_caches_thumbnails(app, client, monkeypatch):
+    fetched = []
+
+    def fetch(url):
+        fetched.append(url)
+        return png()
+
+    monkeypatch.setattr(images.thumbnails, 'fetcher', fetch)
+    url = 'https://example.com/band.png'
+    with app.test_request_context():
+        link = images.thumb(url, 320)
+
+    for _ in range(2):
+        response = client.get(link)
+        assert response.mimetype == 'image/webp'
+        assert Image.open(io.BytesIO(response.data)).size == (320, 160)
+    assert fetched == [url]
+
+
+def test_proxy_refuses_unsigned_and_private_links(app, client,
+                                                  monkeypatch):
+    monkeypatch.setattr(images.thumbnails, 'fetcher', HTTPFetcher())
+    url = 'http://127.0.0.1/admin.png'
+    with app.test_request_context():
+        link = images.thumb(url, 320)
+
+    assert client.get(link).status_code == 404
+    assert client.get(link.replace('sig=', 'sig=0')).status_code == 404
+
+
+def test_failed_fetches_are_remembered_for_a_while(app, client, tmp_path,
+                                                    monkeypatch):
+    monkeypatch.setattr(images.thumbnails, 'directory', str(tmp_path))
+    fetched = []
+
+    def fetch(url):
+        fetched.append(url)
+        if 'private' in url:
+            raise UnsafeSource(url)
+        raise FetchError(url)
+
+    monkeypatch.setattr(images.thumbnails, 'fetcher', fetch)
+    with app.test_request_context():
+        dead = images.thumb('https://example.com/dead.png', 320)
+        private = images.thumb('https://private.example/a.png', 320)
+
+    for _ in range(2):
+        response = client.get(dead)
+        assert response.status_code == 302
+        assert response.headers['Location'] == 'https://example.com/dead.png'
+        assert client.get(private).status_code == 404
+    assert len(fetched) == 2
+
+    later = images.time.time() + app.config['IMAGE_FAILURE_TTL'] + 1
+    monkeypatch.setattr(images.time, 'time', lambda: later)
+    client.get(dead)
+    assert len(fetched) == 3
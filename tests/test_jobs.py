@@ -0,0 +1,136 @@
+import datetime
+
+import pytest
+
+import clock
+import jobs
+from app import db
+from jobs import Job, claim, enqueue, requeue_stale, run_job
+
+
+def now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+@pytest.fixture
+def failing(monkeypatch):
+    def fail():
+        raise RuntimeError('boom')
+
+    monkeypatch.setitem(jobs.tasks, 'fail', fail)
+    return 'fail'
+
+
+def start(job, minutes_ago=0):
+    job.status = jobs.RUNNING
+    job.attempts += 1
+    job.started_at = now() - datetime.timedelta(minutes=minutes_ago)
+    db.session.commit()
+
+
+def test_enqueue_keeps_one_queued_job_per_key():
+    job = enqueue('sync_upcoming_shows', {'artist_id': 1}, key='artist:1')
+
+    assert enqueue('sync_upcoming_shows', {'artist_id': 1},
+                   key='artist:1').id == job.id
+    assert Job.query.count() == 1
+
+
+def test_enqueue_while_running_queues_the_work_again():
+    # the running job may have read the rows before the write that
+    # enqueues it again
+    running = enqueue('sync_upcoming_shows', {'artist_id': 1},
+                      key='artist:1')
+    start(running)
+
+    job = enqueue('sync_upcoming_shows', {'artist_id': 1}, key='artist:1')
+
+    assert job.id != running.id
+    assert job.status == jobs.QUEUED
+
+
+def test_claim_takes_due_jobs_once():
+    due = enqueue('refresh_upcoming_shows')
+    enqueue('refresh_upcoming_shows',
+            run_at=now() + datetime.timedelta(hours=1))
+
+    assert claim(5) == [due.id]
+    assert claim(5) == []
+    db.session.refresh(due)
+    assert (due.status, due.attempts) == (jobs.RUNNING, 1)
+
+
+def test_failed_jobs_are_retried_with_backoff(app, failing):
+    job = enqueue(failing, max_attempts=2)
+    job_id = job.id
+
+    claim(1)
+    run_job(job_id)
+    job = db.session.get(Job, job_id)
+    assert job.status == jobs.QUEUED
+    assert 'boom' in job.last_error
+    assert job.run_at > now()
+
+    job.run_at = now()
+    db.session.commit()
+    claim(1)
+    run_job(job_id)
+    assert db.session.get(Job, job_id).status == jobs.DEAD
+
+
+def test_failed_jobs_leave_retrying_to_a_queued_job_with_their_key(failing):
+    job = enqueue(failing, key='fail')
+    job_id = job.id
+    claim(1)
+    queued_id = enqueue(failing, key='fail').id
+
+    run_job(job_id)
+
+    assert db.session.get(Job, job_id).status == jobs.DONE
+    assert db.session.get(Job, queued_id).status == jobs.QUEUED
+
+
+@pytest.mark.parametrize('attempts,low,high', [
+    (1, 1, 2), (3, 4, 8), (20, 150, 300),
+])
+def test_backoff_doubles_up_to_the_max(attempts, low, high):
+    delay = jobs.backoff(attempts).total_seconds()
+
+    assert low <= delay <= high
+
+
+def test_stale_jobs_are_requeued():
+    stale = enqueue('refresh_upcoming_shows', key='refresh')
+    start(stale, minutes_ago=60)
+    superseded = enqueue('sync_upcoming_shows', key='artist:1')
+    start(superseded, minutes_ago=60)
+    enqueue('sync_upcoming_shows', key='artist:1')
+    fresh = enqueue('sync_upcoming_shows', key='artist:2')
+    start(fresh)
+
+    requeue_stale()
+
+    assert db.session.get(Job, stale.id).status == jobs.QUEUED
+    assert db.session.get(Job, superseded.id).status == jobs.DONE
+    assert db.session.get(Job, fresh.id).status == jobs.RUNNING
+
+
+def test_show_refresh_runs_when_the_show_starts(app, client, make_venue,
+                                                make_artist, monkeypatch):
+    # TIMEZONE hours away from the server's zone
+    monkeypatch.setitem(app.config, 'TIMEZONE', 'Pacific/Kiritimati')
+    venue_id, artist_id = make_venue().id, make_artist().id
+    start_time = now() + datetime.timedelta(minutes=30)
+
+    client.post('/shows/create', data={
+        'venue_id': venue_id,
+        'artist_id': artist_id,
+        'start_time': f'{clock.local(start_time):%Y-%m-%d %H:%M:%S}',
+    })
+
+    job = Job.query.filter_by(name='refresh_upcoming_shows').one()
+    assert abs(job.run_at - start_time) < datetime.timedelta(seconds=1)
+    assert claim(1) == []
+    monkeypatch.setattr(jobs, '_now',
+                        lambda: start_time + datetime.timedelta(minutes=1))
+    assert claim(1) == [job.id]
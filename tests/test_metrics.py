@@ -0,0 +1,119 @@
+import json
+import os
+import subprocess
+
+import pytest
+import sqlalchemy as sa
+
+import metrics
+from metrics import Registry
+
+
+def samples(text):
+    # {'name{labels}': value} from the Prometheus text format
+    return {line.rsplit(' ', 1)[0]: float(line.rsplit(' ', 1)[1])
+            for line in text.splitlines() if not line.startswith('#')}
+
+
+def query_count():
+    # every bucket but the trailing sum
+    return sum(sum(value[:-1])
+               for value in metrics.db_query_duration.values.values())
+
+
+def test_metrics_are_served_in_the_prometheus_text_format(client, booked):
+    venue, _, _ = booked
+    client.get(f'/venues/{venue.id}')
+
+    response = client.get('/metrics')
+
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+    text = response.get_data(as_text=True)
+    assert '# TYPE fyyur_requests_total counter' in text
+    assert '# TYPE fyyur_request_duration_seconds histogram' in text
+    values = samples(text)
+    assert values['fyyur_requests_total{endpoint="show_venue",method="GET",'
+                  'status="200"}'] >= 1
+    # histogram buckets are cumulative and end with the count
+    labels = 'endpoint="show_venue",method="GET"'
+    buckets = [value for name, value in values.items() if name.startswith(
+        f'fyyur_request_duration_seconds_bucket{{{labels},')]
+    assert buckets == sorted(buckets)
+    assert values[f'fyyur_request_duration_seconds_bucket{{{labels},'
+                  f'le="+Inf"}}'] == \
+        values[f'fyyur_request_duration_seconds_count{{{labels}}}']
+    assert values['fyyur_db_pool_connections{engine="primary",'
+                  'state="size"}'] >= 0
+
+
+def test_label_values_are_escaped():
+    registry = Registry()
+    counter = registry.counter('test_total', 'Test.', ('path',))
+    counter.inc('a "quoted"\\path\n')
+
+    assert 'test_total{path="a \\"quoted\\"\\\\path\\n"} 1.0' in \
+        registry.render()
+
+
+@pytest.fixture
+def shard_engine(tmp_path):
+    engine = sa.create_engine(f'sqlite:///{tmp_path}/shard.db')
+    metrics.instrument('shard', engine)
+    yield engine
+    del metrics.engines['shard']
+    metrics.db_pool.values.clear()
+    engine.dispose()
+
+
+def test_queries_are_timed_on_every_engine(shard_engine):
+    before = query_count()
+
+    with shard_engine.connect() as connection:
+        connection.execute(sa.text('SELECT 1'))
+
+    assert query_count() == before + 1
+    metrics.collect_pool_stats()
+    assert ('shard', 'checked_in') in metrics.db_pool.values
+
+
+def test_failed_queries_are_timed(shard_engine):
+    before = query_count()
+
+    with shard_engine.connect() as connection:
+        with pytest.raises(sa.exc.OperationalError):
+            connection.execute(sa.text('SELECT * FROM no_such_table'))
+        connection.rollback()
+        connection.execute(sa.text('SELECT 1'))
+
+    assert query_count() == before + 2
+
+
+def test_processes_are_merged_from_the_metrics_dir(app, tmp_path,
+                                                   monkeypatch):
+    monkeypatch.setitem(app.config, 'METRICS_DIR', str(tmp_path))
+    registry = Registry()
+    counter = registry.counter('test_total', 'Test.')
+    gauge = registry.gauge('test_in_flight', 'Test.')
+    histogram = registry.histogram('test_seconds', 'Test.', buckets=(1,))
+    counter.inc(amount=1)
+    gauge.inc(amount=1)
+    histogram.observe(0.5)
+    # another worker still running, and one that has exited
+    exited = subprocess.Popen(['true'])
+    exited.wait()
+    for pid in (os.getppid(), exited.pid):
+        with open(tmp_path / f'{pid}.json', 'w') as f:
+            json.dump({'test_total': [[[], 2]],
+                       'test_in_flight': [[[], 3]],
+                       'test_seconds': [[[], [0, 1, 2.0]]]}, f)
+
+    values = samples(registry.render())
+
+    # counters and histograms from every process, gauges from live ones
+    assert values['test_total'] == 5
+    assert values['test_in_flight'] == 4
+    assert values['test_seconds_bucket{le="1"}'] == 1
+    assert values['test_seconds_bucket{le="+Inf"}'] == 3
+    assert values['test_seconds_sum'] == 4.5
+    assert os.path.exists(tmp_path / f'{os.getpid()}.json')
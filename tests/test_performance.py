@@ -0,0 +1,61 @@
+import pytest
+
+from recommendations import recommendations
+
+# (url, queries) for pages rendered with warm in-process caches
+PAGES = [
+    ('/', 0),
+    ('/venues', 2),
+    ('/artists', 1),
+    ('/shows', 2),
+    ('/venues/{venue_id}', 3),
+    ('/artists/{artist_id}', 3),
+    ('/venues/{venue_id}/edit', 1),
+    ('/artists/{artist_id}/edit', 1),
+    ('/shows/calendar', 1),
+    ('/changes', 1),
+]
+
+# milliseconds a warm page may take
+PAGE_BUDGET = 50
+
+
+@pytest.fixture
+def urls(booked):
+    venue, artist, _ = booked
+    recommendations.get()
+    return {'venue_id': venue.id, 'artist_id': artist.id}
+
+
+@pytest.mark.parametrize('url, queries', PAGES)
+def test_page_queries_and_time(client, urls, assert_queries,
+                               assert_faster_than, url, queries):
+    url = url.format(**urls)
+    assert client.get(url).status_code == 200
+
+    with assert_queries(queries), assert_faster_than(PAGE_BUDGET):
+        assert client.get(url).status_code == 200
+
+
+def test_detail_page_loads_each_show_list_in_one_query(client, urls,
+                                                       assert_queries):
+    # with the fragment cache empty the upcoming shows come from the read
+    # model and the past shows from one join
+    with assert_queries(5):
+        client.get('/venues/{venue_id}'.format(**urls))
+    with assert_queries(5):
+        client.get('/artists/{artist_id}'.format(**urls))
+
+
+def test_query_count_does_not_grow_with_shows(client, booked, make_show,
+                                              assert_queries):
+    venue, artist, _ = booked
+    for days in range(2, 12):
+        make_show(venue, artist, days)
+    url = f'/venues/{venue.id}'
+    recommendations.get()
+
+    with assert_queries(5):
+        client.get(url)
+    with assert_queries(2):
+        client.get('/shows')
@@ -0,0 +1,116 @@
+import os
+
+import pytest
+
+import jobs
+from jobs import Job, claim, run_job
+from recommendations import RecommendationIndex, recommendations
+
+
+@pytest.fixture
+def index_file(app, tmp_path, monkeypatch):
+    path = str(tmp_path / 'recommendations.npz')
+    monkeypatch.setitem(app.config, 'RECOMMENDATIONS_FILE', path)
+    return path
+
+
+def test_missing_index_is_built_by_a_worker(booked, index_file):
+    venue, artist, _ = booked
+    venue_id, artist_id = venue.id, artist.id
+
+    # requests serve no recommendations rather than building the index
+    assert recommendations.venues_for_artist(artist_id) == []
+    assert recommendations.artists_for_venue(venue_id) == []
+    job = Job.query.filter_by(name='build_recommendations').one()
+    assert job.status == jobs.QUEUED
+    assert not os.path.exists(index_file)
+
+    assert claim(1) == [job.id]
+    run_job(job.id)
+
+    assert os.path.exists(index_file)
+    index = recommendations.get()
+    assert index.artist_ids == [artist_id]
+    assert index.venue_ids == [venue_id]
+    assert Job.query.filter_by(name='build_recommendations').count() == 1
+
+
+@pytest.fixture
+def bookings(make_venue, make_artist, make_show):
+    # two rock artists sharing a venue, one of whom also played a second
+    # venue; a third, unbooked venue is a rock venue
+    shared, second = make_venue(), make_venue(name='Park Square Live')
+    rock = make_venue(name='The Dueling Pianos Bar', genres=['Rock n Roll'])
+    veteran, newcomer = make_artist(), make_artist(name='The Wild Sax Band')
+    make_show(shared, veteran)
+    make_show(second, veteran)
+    make_show(shared, newcomer)
+    return shared.id, second.id, rock.id, veteran.id, newcomer.id
+
+
+def test_artists_are_recommended_what_similar_artists_booked(bookings):
+    shared, second, rock, veteran, newcomer = bookings
+
+    index = RecommendationIndex.build(5, 0.5)
+
+    # booked venues are never recommended back
+    assert [venue_id for venue_id, _ in
+            index.venues_for_artist[newcomer]] == [second, rock]
+    assert [venue_id for venue_id, _ in
+            index.venues_for_artist[veteran]] == [rock]
+    assert [artist_id for artist_id, _ in
+            index.artists_for_venue[second]] == [newcomer]
+    # without genre similarity only co-bookings count
+    assert [venue_id for venue_id, _ in RecommendationIndex.build(
+        5, 0.0).venues_for_artist[newcomer]] == [second]
+
+
+def test_recommendations_are_cut_at_top_k(bookings):
+    _, second, _, _, newcomer = bookings
+
+    index = RecommendationIndex.build(1, 0.5)
+
+    assert [venue_id for venue_id, _ in
+            index.venues_for_artist[newcomer]] == [second]
+
+
+def test_new_shows_rerank_the_artist_and_venue(bookings, make_artist):
+    shared, second, rock, veteran, newcomer = bookings
+    index = RecommendationIndex.build(5, 0.0)
+
+    index.add_show(veteran, rock)
+
+    assert index.venues_for_artist[veteran] == []
+    assert [artist_id for artist_id, _ in
+            index.artists_for_venue[rock]] == [newcomer]
+
+    # artists and venues new since the build are added
+    late = make_artist(name='The Late Band').id
+    index.add_show(late, second)
+    assert [venue_id for venue_id, _ in
+            index.venues_for_artist[late]] == [shared, rock]
+
+
+def test_saved_index_loads_the_same(bookings, tmp_path):
+    index = RecommendationIndex.build(5, 0.5)
+    path = str(tmp_path / 'recommendations.npz')
+
+    index.save(path)
+    loaded = RecommendationIndex.load(path)
+
+    assert (loaded.artist_ids, loaded.venue_ids, loaded.genres) == \
+        (index.artist_ids, index.venue_ids, index.genres)
+    assert (loaded.top_k, loaded.genre_weight) == (5, 0.5)
+    assert (loaded.bookings != index.bookings).nnz == 0
+    assert loaded.venues_for_artist == pytest.approx(index.venues_for_artist)
+    assert loaded.artists_for_venue == pytest.approx(index.artists_for_venue)
+
+
+def test_rebuilt_index_file_is_reloaded(booked, index_file):
+    RecommendationIndex.empty(5, 0.5).save(index_file)
+    assert recommendations.get().artist_ids == []
+    os.utime(index_file, (0, 0))
+
+    RecommendationIndex.build(5, 0.5).save(index_file)
+
+    assert recommendations.get().artist_ids == [booked[1].id]
@@ -0,0 +1,101 @@
+import os
+import time
+
+import pytest
+from flask import session
+from flask.sessions import SecureCookieSessionInterface
+from flask_wtf.csrf import generate_csrf, validate_csrf
+
+import sessions
+from sessions import ServerSessionInterface, SqliteSessionStore
+
+
+@pytest.fixture
+def worker(app, monkeypatch):
+    # switches the app to a session interface with a store connection of
+    # its own, as another worker process would have
+    def switch():
+        store = SqliteSessionStore(app.config['SESSION_DB'])
+        monkeypatch.setattr(app, 'session_interface',
+                            ServerSessionInterface(store))
+        return store
+    return switch
+
+
+def test_secret_key_is_generated_once(tmp_path):
+    path = os.path.join(tmp_path, 'instance', 'secret_key')
+
+    key = sessions.load_secret_key(path)
+
+    assert len(key) == 32
+    assert sessions.load_secret_key(path) == key
+    assert os.stat(path).st_mode & 0o777 == 0o600
+    assert os.listdir(os.path.dirname(path)) == ['secret_key']
+
+
+@pytest.mark.parametrize('backend', ['sqlite', 'cookie'])
+def test_flash_survives_the_redirect_in_another_worker(
+        app, client, make_venue, worker, monkeypatch, backend):
+    if backend == 'cookie':
+        monkeypatch.setattr(app, 'session_interface',
+                            SecureCookieSessionInterface())
+    venue = make_venue()
+
+    response = client.delete(f'/venues/{venue.id}')
+    assert response.status_code == 302
+    if backend == 'sqlite':
+        worker()
+
+    assert b'Venue successfully deleted!' in client.get('/').data
+    # flashed messages are shown once
+    assert b'Venue successfully deleted!' not in client.get('/').data
+
+
+def test_csrf_token_is_valid_in_another_worker(app, worker):
+    with app.test_request_context():
+        token = generate_csrf()
+        response = app.response_class()
+        app.session_interface.save_session(app, session, response)
+    cookie = response.headers['Set-Cookie'].split(';')[0]
+
+    worker()
+    with app.test_request_context(headers={'Cookie': cookie}):
+        validate_csrf(token)
+
+
+def test_only_the_session_id_is_sent(app, client):
+    with client.session_transaction() as data:
+        data['csrf_token'] = 'secret'
+
+    cookie = client.get_cookie(app.config['SESSION_COOKIE_NAME'])
+    assert 'secret' not in cookie.value
+    # a cookie that wasn't signed with the key opens an empty session
+    client.set_cookie(cookie.key, 'x' + cookie.value)
+    with client.session_transaction() as data:
+        assert 'csrf_token' not in data
+
+
+def test_requests_that_leave_the_session_alone_do_not_write_it(
+        app, client, worker):
+    store = worker()
+    with client.session_transaction() as data:
+        data['csrf_token'] = 'secret'
+    # nothing is written back, so the pruned session stays gone
+    store.prune(time.time() + 365 * 24 * 3600)
+
+    response = client.get('/')
+
+    assert 'Set-Cookie' not in response.headers
+    assert store.prune(time.time() + 365 * 24 * 3600) == 0
+
+
+def test_prune_removes_expired_sessions(app):
+    store = SqliteSessionStore(app.config['SESSION_DB'])
+    now = time.time()
+    store.save('old', '{}', now - 1)
+    store.save('new', '{}', now + 60)
+
+    assert store.prune(now) == 1
+    assert store.load('old', now - 2) is None
+    assert store.load('new', now) == '{}'
+    store.delete('new')
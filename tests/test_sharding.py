@@ -0,0 +1,154 @@
+import datetime
+
+import pytest
+import sqlalchemy as sa
+
+import clock
+import geo
+from app import db
+from changefeed import ChangeLog
+from models import Artist, Venue
+from recommendations import RecommendationIndex
+from sharding import PRIMARY_TABLES, shards
+
+
+@pytest.fixture
+def sharded(app, tmp_path, monkeypatch):
+    # two SQLite shards, 'east' for NY venues and 'west' for CA venues,
+    # set up the way shards.init_app does once SHARDS is configured
+    names = ['east', 'west']
+    engines = {name: sa.create_engine(f'sqlite:///{tmp_path}/{name}.db')
+               for name in names}
+    tables = [table for table in db.metadata.sorted_tables
+              if table.name not in PRIMARY_TABLES]
+    for engine in engines.values():
+        db.metadata.create_all(engine, tables=tables)
+
+    monkeypatch.setattr(shards, 'names', names)
+    monkeypatch.setattr(shards, 'engines', engines)
+    monkeypatch.setattr(shards, 'engine_names',
+                        {engine: name for name, engine in engines.items()})
+    monkeypatch.setattr(shards, 'regions', {'NY': 'east', 'CA': 'west'})
+    monkeypatch.setattr(shards, 'default', 'east')
+    monkeypatch.setitem(app.before_request_funcs, None, [
+        *app.before_request_funcs.get(None, []), shards._route_request])
+    monkeypatch.setitem(app.teardown_request_funcs, None, [
+        shards._unroute_request,
+        *app.teardown_request_funcs.get(None, [])])
+    for model in (Venue, Artist):
+        sa.event.listen(model, 'before_insert', shards._allocate_id)
+    db.session.remove()
+    try:
+        yield engines
+    finally:
+        db.session.remove()
+        for model in (Venue, Artist):
+            sa.event.remove(model, 'before_insert', shards._allocate_id)
+        for engine in engines.values():
+            engine.dispose()
+
+
+def rows(engine, model):
+    with engine.connect() as connection:
+        return connection.execute(sa.select(model.__table__.c.id)).scalars() \
+            .all()
+
+
+@pytest.fixture
+def coasts(sharded, make_venue, make_artist, make_show):
+    # a venue on each shard, both booking one artist that every shard holds.
+    # Rows are read back on their own shard.
+    with shards.use('east'):
+        east_id = make_venue(name='Park Square Live', city='New York',
+                             state='NY', latitude=40.71,
+                             longitude=-74.01).id
+    with shards.use('west'):
+        west_id = make_venue(latitude=37.77, longitude=-122.42).id
+    with shards.use('east'):
+        artist_id = make_artist(genres=['Jazz']).id
+    shards.replicate_artist(artist_id)
+    for venue_id in (east_id, west_id):
+        with shards.use_venue(venue_id):
+            make_show(db.session.get(Venue, venue_id),
+                      db.session.get(Artist, artist_id), days=2)
+    return east_id, west_id, artist_id
+
+
+def test_ids_point_at_the_home_shard(sharded, coasts):
+    east_id, west_id, artist_id = coasts
+
+    assert shards.shard_for_id(east_id) == 'east'
+    assert shards.shard_for_id(west_id) == 'west'
+    assert rows(sharded['east'], Venue) == [east_id]
+    assert rows(sharded['west'], Venue) == [west_id]
+    # artists are copied to every shard
+    assert rows(sharded['west'], Artist) == [artist_id]
+
+
+def test_venue_pages_find_their_shard(client, coasts):
+    east_id, west_id, _ = coasts
+
+    assert b'Park Square Live' in client.get(f'/venues/{east_id}').data
+    assert b'The Musical Hop' in client.get(f'/venues/{west_id}').data
+
+
+def test_listings_gather_every_shard(client, coasts):
+    page = client.get('/venues').get_data(as_text=True)
+    assert 'Park Square Live' in page and 'The Musical Hop' in page
+
+    page = client.get('/shows').get_data(as_text=True)
+    assert 'Park Square Live' in page and 'The Musical Hop' in page
+
+
+def test_nearby_venues_gather_every_shard(client, coasts):
+    response = client.get('/venues/near?lat=39&lon=-100&limit=5')
+
+    assert sorted(venue['name'] for venue in response.json['data']) == \
+        ['Park Square Live', 'The Musical Hop']
+
+
+def test_calendar_gathers_every_shard(client, coasts):
+    day = clock.today() + datetime.timedelta(days=2)
+    query = f'start={clock.today()}&end={day + datetime.timedelta(days=1)}'
+
+    response = client.get(f'/shows/calendar?{query}&include=shows')
+    counts = {bucket['start']: bucket for bucket in response.json['buckets']}
+    assert counts[day.isoformat()]['count'] == 2
+    assert len(counts[day.isoformat()]['shows']) == 2
+
+    feed = client.get(f'/shows/feed.json?{query}').json
+    assert sorted(show['venue_name'] for show in feed) == \
+        ['Park Square Live', 'The Musical Hop']
+    assert client.get(f'/shows/feed.ics?{query}').get_data(
+        as_text=True).count('BEGIN:VEVENT') == 2
+
+
+def test_indexes_are_built_from_every_shard(coasts):
+    east_id, west_id, artist_id = coasts
+
+    tree = geo.VenueIndex().build()
+    assert tree.size == 2
+
+    index = RecommendationIndex.build(5, 0.5)
+    assert index.venue_ids == sorted([east_id, west_id])
+    assert index.artist_ids == [artist_id]
+    assert index.bookings.sum() == 2
+
+
+def test_artist_copies_are_logged_on_their_shard(sharded, coasts):
+    _, _, artist_id = coasts
+    with shards.use('east'):
+        artist = db.session.get(Artist, artist_id)
+        artist.name = 'GNP'
+        db.session.commit()
+    shards.replicate_artist(artist_id)
+    # copying an unchanged row writes nothing
+    shards.replicate_artist(artist_id)
+
+    with shards.use('west'):
+        changes = ChangeLog.query.filter_by(entity='artist').order_by(
+            ChangeLog.seq).all()
+    assert [(change.entity_id, change.op) for change in changes] == \
+        [(artist_id, 'insert'), (artist_id, 'update')]
+    assert changes[1].changed == ['name', 'version']
+    assert changes[1].data['name'] == 'GNP'
@@ -0,0 +1,116 @@
+import datetime
+import time
+
+import clock
+import show_calendar
+from models import Show, UpcomingShow
+
+
+def test_shows_are_listed_by_start_time(client, make_venue, make_artist,
+                                        make_show):
+    venue = make_venue()
+    make_show(venue, make_artist(name='Later Band'), days=2)
+    make_show(venue, make_artist(name='Sooner Band'), days=1)
+
+    page = client.get('/shows').get_data(as_text=True)
+
+    assert page.index('Sooner Band') < page.index('Later Band')
+
+
+def test_create_show(client, make_venue, make_artist):
+    venue = make_venue()
+    artist = make_artist()
+    start_time = clock.local(clock.now()).replace(
+        tzinfo=None, second=0, microsecond=0) + datetime.timedelta(days=3)
+
+    response = client.post('/shows/create', data={
+        'venue_id': venue.id,
+        'artist_id': artist.id,
+        'start_time': f'{start_time:%Y-%m-%d %H:%M:%S}',
+    })
+
+    assert b'The show was successfully listed!' in response.data
+    show = Show.query.one()
+    assert clock.local(show.start_time).replace(tzinfo=None) == start_time
+    # upcoming shows are copied to the read model as they are created
+    assert UpcomingShow.query.get(show.id) is not None
+
+
+def test_writes_cannot_be_made_as_of_another_time(client, make_venue,
+                                                  make_artist):
+    venue_id, artist_id = make_venue().id, make_artist().id
+
+    response = client.post('/shows/create?as_of=2030-01-01T00:00', data={
+        'venue_id': venue_id,
+        'artist_id': artist_id,
+        'start_time': '2030-01-01 20:00:00',
+    })
+
+    assert response.status_code == 400
+    assert Show.query.count() == 0
+    assert client.get('/shows?as_of=2030-01-01T00:00').status_code == 200
+
+
+def test_read_model_follows_the_real_time(make_venue, make_artist,
+                                          make_show):
+    # a show written while the clock is fixed later still counts as
+    # upcoming by the real time
+    with clock.use(datetime.datetime(2030, 1, 1,
+                                     tzinfo=datetime.timezone.utc)):
+        show = make_show(make_venue(), make_artist(), days=3)
+
+        assert UpcomingShow.query.get(show.id) is not None
+
+
+def test_create_show_for_missing_venue(client, make_artist):
+    artist = make_artist()
+
+    response = client.post('/shows/create', data={
+        'venue_id': 404,
+        'artist_id': artist.id,
+        'start_time': '2030-01-01 20:00:00',
+    })
+
+    assert b'could not be listed' in response.data
+    assert Show.query.count() == 0
+
+
+def test_calendar_counts_shows_per_day(client, booked):
+    today = clock.today()
+
+    response = client.get(f'/shows/calendar?start={today}'
+                          f'&end={today + datetime.timedelta(days=8)}')
+
+    counts = {day['start']: day['count'] for day in response.json['buckets']}
+    assert sum(counts.values()) == 2
+    assert counts[(today + datetime.timedelta(days=7)).isoformat()] == 1
+
+
+def test_calendar_rejects_bad_ranges(client):
+    assert client.get('/shows/calendar?start=2030-01-02&end=2030-01-01') \
+        .status_code == 400
+    assert client.get('/shows/calendar?start=soon').status_code == 400
+
+
+def test_ical_feed_times_are_utc(client, make_venue, make_artist,
+                                 make_show):
+    show = make_show(make_venue(), make_artist(), days=2)
+    start_time = show.start_time.astimezone(datetime.timezone.utc)
+
+    response = client.get(f'/shows/feed.ics?start={clock.today()}')
+
+    assert f'DTSTART:{start_time:%Y%m%dT%H%M%S}Z\r\n' in \
+        response.get_data(as_text=True)
+
+
+def test_cached_days_expire(monkeypatch):
+    # other processes don't see this one's invalidations
+    cache = show_calendar.DayCache()
+    now = time.monotonic()
+    cache.set('key', ['show'])
+    assert cache.get('key') == ['show']
+
+    monkeypatch.setattr(time, 'monotonic', lambda: now + 3600)
+
+    assert cache.get('key') is None
+    assert cache.entries == {}
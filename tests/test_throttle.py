@@ -0,0 +1,120 @@
+import threading
+import time
+
+import pytest
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+import throttle
+from app import db
+from throttle import DatabaseBuckets, MemoryBuckets, SingleFlight
+
+
+@pytest.fixture
+def limited(app, monkeypatch):
+    # one listing request a second with a burst of two
+    monkeypatch.setitem(app.config, 'RATE_LIMITS', {'listing': (1, 2)})
+
+
+@pytest.mark.parametrize('buckets', [MemoryBuckets, DatabaseBuckets])
+def test_buckets_refill_at_the_rate(request, engine, monkeypatch, buckets):
+    # database buckets commit on connections of their own, outside the
+    # test's transaction
+    monkeypatch.setitem(db.engines, None, engine)
+    bucket = buckets()
+    request.addfinalizer(lambda: DatabaseBuckets().prune(float('inf')))
+
+    assert bucket.take('key', 2, 2, 100.0) == (True, 0.0)
+    assert bucket.take('key', 2, 2, 100.0) == (True, 0.0)
+    assert bucket.take('key', 2, 2, 100.0) == (False, 0.5)
+    assert bucket.take('other', 2, 2, 100.0)[0]
+    assert bucket.take('key', 2, 2, 100.5)[0]
+
+
+def test_limited_clients_are_told_when_to_retry(client, limited):
+    assert client.get('/artists').status_code == 200
+    assert client.get('/artists').status_code == 200
+
+    response = client.get('/artists')
+
+    assert response.status_code == 429
+    assert response.headers['Retry-After'] == '1'
+
+
+def test_each_client_has_its_own_bucket(app, client, limited):
+    for _ in range(2):
+        client.get('/artists', environ_base={'REMOTE_ADDR': '10.0.0.1'})
+
+    assert client.get('/artists', environ_base={
+        'REMOTE_ADDR': '10.0.0.1'}).status_code == 429
+    assert client.get('/artists', environ_base={
+        'REMOTE_ADDR': '10.0.0.2'}).status_code == 200
+
+
+def test_clients_behind_a_proxy_are_told_apart(app, client, limited,
+                                               monkeypatch):
+    monkeypatch.setattr(app, 'wsgi_app', ProxyFix(app.wsgi_app, x_for=1))
+
+    def get(address):
+        return client.get('/artists', headers={'X-Forwarded-For': address},
+                          environ_base={'REMOTE_ADDR': '10.0.0.1'})
+
+    for _ in range(2):
+        get('203.0.113.1')
+
+    assert get('203.0.113.1').status_code == 429
+    assert get('203.0.113.2').status_code == 200
+
+
+def test_single_flight_shares_one_call():
+    flight = SingleFlight()
+    started, release = threading.Event(), threading.Event()
+    calls, results = [], []
+
+    def compute():
+        calls.append(1)
+        started.set()
+        release.wait()
+        return 'result'
+
+    leader = threading.Thread(
+        target=lambda: results.append(flight.do(('key',), compute)))
+    leader.start()
+    started.wait()
+    follower = threading.Thread(
+        target=lambda: results.append(flight.do(('key',), compute)))
+    follower.start()
+    # give the follower time to find the leader's call
+    time.sleep(0.05)
+    release.set()
+    leader.join()
+    follower.join()
+
+    assert results == ['result', 'result']
+    assert len(calls) == 1
+    # the call is forgotten once done, so later calls compute again
+    assert flight.do(('key',), lambda: 'again') == 'again'
+
+
+def test_single_flight_shares_errors():
+    flight = SingleFlight()
+
+    with pytest.raises(ValueError):
+        flight.do(('key',), lambda: int('x'))
+    assert flight.calls == {}
+
+
+def test_as_of_renders_are_not_shared_with_live_requests(app, client,
+                                                         monkeypatch):
+    keys = []
+    do = throttle.single_flight.do
+
+    def record(key, fn):
+        keys.append(key)
+        return do(key, fn)
+
+    monkeypatch.setattr(throttle.single_flight, 'do', record)
+
+    client.get('/venues')
+    client.get('/venues?as_of=2030-01-01T00:00')
+
+    assert keys[0] != keys[1]
@@ -0,0 +1,122 @@
+from app import db
+from models import UpcomingShow, Venue
+
+
+def venue_form(venue, **fields):
+    data = {
+        'name': venue.name,
+        'city': venue.city,
+        'state': venue.state,
+        'address': venue.address,
+        'phone': venue.phone,
+        'genres': venue.genres,
+        'image_link': venue.image_link or '',
+        'facebook_link': venue.facebook_link or '',
+        'website': venue.website or '',
+        'seeking_description': venue.seeking_description or '',
+        'version': venue.version,
+    }
+    if venue.is_seeking_talent:
+        data['is_seeking_talent'] = 'y'
+    data.update(fields)
+    return data
+
+
+def test_show_venue_splits_upcoming_and_past_shows(client, booked):
+    venue, artist, _ = booked
+
+    response = client.get(f'/venues/{venue.id}')
+
+    assert response.status_code == 200
+    assert b'2 Upcoming Shows' in response.data
+    assert b'1 Past Show<' in response.data
+    assert artist.name.encode() in response.data
+
+
+def test_show_venue_reads_upcoming_shows_from_the_read_model(client,
+                                                             booked):
+    venue, _, _ = booked
+    # the read model lags artist renames until sync_upcoming_shows runs
+    UpcomingShow.query.update({'artist_name': 'Renamed Band'})
+    db.session.commit()
+
+    response = client.get(f'/venues/{venue.id}')
+
+    assert response.data.count(b'Renamed Band') == 2
+
+
+def test_show_venue_not_found(client):
+    assert client.get('/venues/404').status_code == 404
+
+
+def test_venues_are_grouped_by_city(client, make_venue):
+    make_venue(name='Park Square Live', city='New York', state='NY')
+    make_venue(name='The Dueling Pianos Bar', city='New York', state='NY')
+    make_venue(name='The Musical Hop')
+
+    response = client.get('/venues')
+
+    assert response.status_code == 200
+    page = response.get_data(as_text=True)
+    assert page.index('New York') < page.index('Park Square Live') < \
+        page.index('The Dueling Pianos Bar')
+    assert 'The Musical Hop' in page
+
+
+def test_search_venues_ignores_case(client, make_venue):
+    make_venue(name='The Musical Hop')
+    make_venue(name='Park Square Live')
+
+    response = client.post('/venues/search', data={'search_term': 'MUSIC'})
+
+    assert b'The Musical Hop' in response.data
+    assert b'Park Square Live' not in response.data
+
+
+def test_create_venue(client):
+    response = client.post('/venues/create', data={
+        'name': 'The Dueling Pianos Bar',
+        'city': 'New York',
+        'state': 'NY',
+        'address': '335 Delancey Street',
+        'genres': ['Classical', 'R&B'],
+        'facebook_link': 'https://www.facebook.com/theduelingpianos',
+        'website': 'https://www.theduelingpianos.com',
+    })
+
+    assert b'was successfully listed' in response.data
+    venue = Venue.query.filter_by(name='The Dueling Pianos Bar').one()
+    assert venue.genres == ['Classical', 'R&B']
+
+
+def test_edit_venue(client, make_venue):
+    venue = make_venue()
+    venue_id = venue.id
+
+    response = client.post(f'/venues/{venue_id}/edit',
+                           data=venue_form(venue, name='The Musical Hip'))
+
+    assert response.status_code == 302
+    venue = db.session.get(Venue, venue_id)
+    assert venue.name == 'The Musical Hip'
+    assert venue.version == 2
+
+
+def test_edit_venue_with_stale_version_is_a_conflict(client, make_venue):
+    venue = make_venue()
+    venue_id = venue.id
+
+    response = client.post(f'/venues/{venue_id}/edit', data=venue_form(
+        venue, name='The Musical Hip', version=venue.version - 1))
+
+    assert response.status_code == 409
+    assert db.session.get(Venue, venue_id).name == 'The Musical Hop'
+
+
+def test_delete_venue(client, make_venue):
+    venue_id = make_venue().id
+
+    response = client.delete(f'/venues/{venue_id}')
+
+    assert response.status_code == 302
+    assert db.session.get(Venue, venue_id) is None
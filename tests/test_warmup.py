@@ -0,0 +1,135 @@
+import datetime
+
+import pytest
+
+import fragment_cache
+import warmup
+from warmup import popular_from_bookings, popular_from_log, report, warm, \
+    warmup_urls
+
+LOG = '''\
+10.0.0.1 - - [19/Oct/2026:10:00:00 +0000] "GET /venues/1 HTTP/1.1" 200 512
+10.0.0.1 - - [19/Oct/2026:10:00:01 +0000] "GET /venues/1?page=2 HTTP/1.1" 200 5
+10.0.0.2 - - [19/Oct/2026:10:00:02 +0000] "GET /artists/2 HTTP/1.1" 200 512
+10.0.0.2 - - [19/Oct/2026:10:00:03 +0000] "GET /artists/3 HTTP/1.1" 404 512
+10.0.0.2 - - [19/Oct/2026:10:00:04 +0000] "POST /venues/1/edit HTTP/1.1" 302 0
+10.0.0.3 - - [19/Oct/2026:10:00:05 +0000] "GET /static/main.css HTTP/1.1" 200 9
+10.0.0.3 - - [19/Oct/2026:10:00:06 +0000] "GET /metrics HTTP/1.1" 200 9
+10.0.0.3 - - [19/Oct/2026:10:00:07 +0000] "GET /nowhere HTTP/1.1" 200 9
+not a log line
+'''
+
+
+@pytest.fixture
+def access_log(tmp_path):
+    path = tmp_path / 'access.log'
+    path.write_text(LOG)
+    return str(path)
+
+
+def test_popular_pages_are_read_from_the_access_log(app, access_log):
+    # successful GETs of warmable pages, most requested first
+    assert popular_from_log(access_log, 10) == ['/venues/1', '/artists/2']
+    assert popular_from_log(access_log, 1) == ['/venues/1']
+
+
+def test_popular_pages_fall_back_to_bookings(booked, make_venue, make_show):
+    venue, artist, _ = booked
+    other = make_venue(name='Park Square Live')
+    make_show(other, artist, days=3)
+
+    # the artist has three upcoming shows, the venue two and other one
+    assert popular_from_bookings(10) == [
+        f'/artists/{artist.id}', f'/venues/{venue.id}',
+        f'/venues/{other.id}']
+    assert popular_from_bookings(1) == [f'/artists/{artist.id}']
+
+
+def test_configured_pages_come_first(app, access_log, monkeypatch):
+    monkeypatch.setitem(app.config, 'WARMUP_URLS', ['/', '/venues/1'])
+
+    assert warmup_urls(access_log=access_log) == \
+        ['/', '/venues/1', '/artists/2']
+
+
+def test_warming_fills_the_fragment_cache(app, booked):
+    venue, _, _ = booked
+    url = f'/venues/{venue.id}'
+
+    # one at a time, as the test's requests share its connection
+    results, _ = warm([url, '/venues/404'], concurrency=1)
+
+    assert [(result.url, result.status) for result in results] == \
+        [(url, 200), ('/venues/404', 404)]
+    assert fragment_cache.fragment_cache.entries
+
+
+def test_warming_as_of_renders_with_that_clock(app):
+    as_of = datetime.datetime(2030, 1, 1, tzinfo=datetime.timezone.utc)
+    seen = []
+
+    def render(url, as_of):
+        seen.append((url, as_of))
+        return 200
+
+    warm(['/'], as_of=as_of, render=render)
+
+    assert seen == [('/', as_of)]
+
+
+def test_failed_renders_are_reported(app):
+    def render(url, as_of):
+        if url == '/broken':
+            raise RuntimeError('boom')
+        return 200
+
+    results, elapsed = warm(['/', '/broken'], render=render)
+
+    assert [result.status for result in results] == [200, None]
+    assert report(results, elapsed).splitlines()[1].startswith('error')
+    assert report(results, elapsed).splitlines()[-1].startswith(
+        'Warmed 1/2 pages (50%)')
+
+
+def test_warmup_requests_skip_rate_limits(app, booked, monkeypatch):
+    monkeypatch.setitem(app.config, 'RATE_LIMITS', {'listing': (1, 1)})
+
+    results, _ = warm(['/venues'] * 3, concurrency=1)
+
+    assert [result.status for result in results] == [200, 200, 200]
+
+
+def test_scheduler_logs_failures_instead_of_raising(app, monkeypatch):
+    def fail():
+        raise RuntimeError('boom')
+
+    monkeypatch.setattr(warmup, 'warmup_urls', fail)
+
+    warmup.WarmupScheduler().warm()
+
+
+def test_warmup_command_needs_a_server(app, monkeypatch):
+    monkeypatch.delenv('WARMUP_BASE_URL', raising=False)
+
+    result = app.test_cli_runner().invoke(args=['warmup', 'run'])
+
+    assert result.exit_code != 0
+    assert '--base-url' in result.output
+
+
+def test_warmup_command_warms_the_server(app, monkeypatch):
+    monkeypatch.setitem(app.config, 'WARMUP_URLS', ['/venues/1'])
+    monkeypatch.setattr(warmup, 'popular_from_bookings', lambda top: [])
+    requested = []
+
+    def render_remote(base_url):
+        return lambda url, as_of: requested.append(base_url + url) or 200
+
+    monkeypatch.setattr(warmup, '_render_remote', render_remote)
+
+    result = app.test_cli_runner().invoke(
+        args=['warmup', 'run', '--base-url', 'http://localhost:8000'])
+
+    assert result.exit_code == 0
+    assert requested == ['http://localhost:8000/venues/1']
+    assert 'Warmed 1/1 pages' in result.output
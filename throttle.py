@@ -0,0 +1,216 @@
+import functools
+import math
+import threading
+import time
+
+import click
+import sqlalchemy as sa
+from flask import request
+from flask.cli import AppGroup
+from sqlalchemy.exc import IntegrityError
+from app import app, db
+from metrics import registry
+
+requests_shed = registry.counter(
+    'fyyur_requests_shed_total', 'Requests rejected by the rate limiter.',
+    ('limit', 'endpoint'))
+requests_coalesced = registry.counter(
+    'fyyur_requests_coalesced_total',
+    'Requests answered by another request\'s in-flight computation.',
+    ('name',))
+
+
+# ----------------------------------------------------------------------------#
+# Models.
+# ----------------------------------------------------------------------------#
+
+class RateLimitBucket(db.Model):
+    # token buckets shared by every process when RATE_LIMIT_BACKEND is
+    # 'database'
+    __tablename__ = 'rate_limit_bucket'
+
+    key = db.Column(db.String(255), primary_key=True)
+    tokens = db.Column(db.Float, nullable=False)
+    # unix time of the last refill
+    updated_at = db.Column(db.Float, nullable=False)
+
+    def __repr__(self):
+        return f'<Rate Limit Bucket: {self.key}, Tokens: {self.tokens}>'
+
+
+# ----------------------------------------------------------------------------#
+# Token buckets.
+# ----------------------------------------------------------------------------#
+
+# Each bucket holds up to burst tokens and refills at rate tokens a second;
+# a request takes one token or is turned away. take() returns
+# (allowed, seconds until a token is available).
+
+class MemoryBuckets:
+    # buckets for this process only, so each process under gunicorn allows
+    # the full rate
+
+    def __init__(self):
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.swept_at = time.time()
+
+    def take(self, key, rate, burst, now):
+        with self.lock:
+            tokens, updated_at, _ = self.buckets.get(key, (burst, now, now))
+            tokens = min(burst, tokens + (now - updated_at) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self.buckets[key] = (tokens, now, now + (burst - tokens) / rate)
+            if now - self.swept_at > 60:
+                self._sweep(now)
+        return allowed, 0.0 if allowed else (1 - tokens) / rate
+
+    def _sweep(self, now):
+        # full buckets hold no state worth keeping
+        self.swept_at = now
+        for key in [key for key, (_, _, full_at) in self.buckets.items()
+                    if full_at <= now]:
+            del self.buckets[key]
+
+
+class DatabaseBuckets:
+    # buckets in the app database, taken with a conditional UPDATE so
+    # concurrent processes can't spend the same token
+
+    def take(self, key, rate, burst, now):
+        table = RateLimitBucket.__table__
+        refilled = table.c.tokens + (now - table.c.updated_at) * rate
+        refilled = sa.case((refilled > burst, burst), else_=refilled)
+
+        # a connection of its own keeps the bucket out of the request's
+        # transaction
+        with db.engine.begin() as connection:
+            if connection.execute(table.update().where(
+                    table.c.key == key, refilled >= 1).values(
+                    tokens=refilled - 1, updated_at=now)).rowcount:
+                return True, 0.0
+            row = connection.execute(sa.select(
+                table.c.tokens, table.c.updated_at).where(
+                table.c.key == key)).first()
+
+        if row is None:
+            try:
+                with db.engine.begin() as connection:
+                    connection.execute(table.insert().values(
+                        key=key, tokens=burst - 1, updated_at=now))
+            except IntegrityError:
+                # another process created the bucket first; let this one
+                # through rather than retrying
+                pass
+            return True, 0.0
+
+        tokens = min(burst, row.tokens + (now - row.updated_at) * rate)
+        return False, (1 - tokens) / rate
+
+    def prune(self, older_than):
+        table = RateLimitBucket.__table__
+        with db.engine.begin() as connection:
+            return connection.execute(table.delete().where(
+                table.c.updated_at < older_than)).rowcount
+
+
+backends = {
+    'memory': MemoryBuckets(),
+    'database': DatabaseBuckets(),
+}
+
+
+def rate_limit(name):
+    # rejects a client's requests to the decorated view with 429 once they
+    # exceed RATE_LIMITS[name] = (requests per second, burst). Each client
+    # gets a bucket per endpoint.
+    def decorator(view):
+        @functools.wraps(view)
+        def limited(*args, **kwargs):
+            limit = app.config['RATE_LIMITS'].get(name)
+            # warmup renders come from inside the process, not a client
+            if limit is None or request.environ.get('fyyur.warmup'):
+                return view(*args, **kwargs)
+
+            rate, burst = limit
+            backend = backends[app.config['RATE_LIMIT_BACKEND']]
+            allowed, retry_after = backend.take(
+                f'{request.endpoint}:{request.remote_addr}', rate, burst,
+                time.time())
+            if not allowed:
+                requests_shed.inc(name, request.endpoint)
+                return 'Too many requests, slow down.', 429, {
+                    'Retry-After': str(math.ceil(retry_after))}
+            return view(*args, **kwargs)
+
+        return limited
+
+    return decorator
+
+
+# ----------------------------------------------------------------------------#
+# Request coalescing.
+# ----------------------------------------------------------------------------#
+
+class _Call:
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    # concurrent calls with the same key share one computation: the first
+    # caller runs fn and the rest wait for its result, or its exception.
+    # Results are shared between requests, so they must be plain data that
+    # callers don't modify. Only calls within one process are coalesced.
+
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def do(self, key, fn):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            requests_coalesced.inc(key[0])
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+        return call.result
+
+
+single_flight = SingleFlight()
+
+
+# ----------------------------------------------------------------------------#
+# CLI commands.
+# ----------------------------------------------------------------------------#
+
+rate_limits_cli = AppGroup('rate-limits', help='Manage rate limit buckets.')
+
+
+@rate_limits_cli.command('prune')
+@click.option('--older-than', type=int, default=3600,
+              help='Seconds since a bucket was last used.')
+def prune_command(older_than):
+    pruned = backends['database'].prune(time.time() - older_than)
+    click.echo(f'{pruned} rate limit buckets pruned.')
@@ -0,0 +1,233 @@
+import collections
+import datetime
+import re
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+from flask.cli import AppGroup
+from werkzeug.exceptions import HTTPException
+from app import app, db
+from models import UpcomingShow
+from sharding import shards
+import clock
+
+# request line and status of a common or combined format access log entry
+ACCESS_LOG_ENTRY = re.compile(r'"GET (\S+) HTTP/[\d.]+" (\d{3}) ')
+
+# endpoints never worth warming
+SKIPPED_ENDPOINTS = {'static', 'metrics'}
+
+
+# ----------------------------------------------------------------------------#
+# URL sources.
+# ----------------------------------------------------------------------------#
+
+def _warmable(path):
+    try:
+        endpoint, _ = app.url_map.bind('localhost').match(path, 'GET')
+    except HTTPException:
+        return False
+    return endpoint not in SKIPPED_ENDPOINTS
+
+
+def popular_from_log(path, top):
+    # the top most requested pages in an access log, counting successful
+    # GETs by path without their query string
+    hits = collections.Counter()
+    with open(path, errors='replace') as f:
+        for line in f:
+            match = ACCESS_LOG_ENTRY.search(line)
+            if match is not None and match.group(2) == '200':
+                hits[urllib.parse.urlsplit(match.group(1)).path] += 1
+    return [url for url, _ in hits.most_common() if _warmable(url)][:top]
+
+
+def popular_from_bookings(top):
+    # without a log, venues and artists with the most upcoming shows stand
+    # in for the most visited detail pages
+    def counts():
+        return [
+            UpcomingShow.counts_by_venue(),
+            dict(db.session.query(
+                UpcomingShow.artist_id, db.func.count()).filter(
+                UpcomingShow.start_time >= clock.now()).group_by(
+                UpcomingShow.artist_id).all())
+        ]
+
+    by_venue = collections.Counter()
+    by_artist = collections.Counter()
+    for venues, artists in shards.each(counts):
+        by_venue.update(venues)
+        by_artist.update(artists)
+    urls = [(count, f'/venues/{venue_id}')
+            for venue_id, count in by_venue.most_common(top)]
+    urls += [(count, f'/artists/{artist_id}')
+             for artist_id, count in by_artist.most_common(top)]
+    return [url for _, url in sorted(urls, key=lambda item: -item[0])][:top]
+
+
+def warmup_urls(top=None, access_log=None):
+    # WARMUP_URLS followed by the top pages from the access log, or from
+    # bookings when there is no log
+    top = app.config['WARMUP_TOP'] if top is None else top
+    access_log = access_log or app.config['WARMUP_ACCESS_LOG']
+    if access_log:
+        popular = popular_from_log(access_log, top)
+    else:
+        popular = popular_from_bookings(top)
+    return list(dict.fromkeys(app.config['WARMUP_URLS'] + popular))
+
+
+# ----------------------------------------------------------------------------#
+# Rendering.
+# ----------------------------------------------------------------------------#
+
+Result = collections.namedtuple('Result', 'url status seconds')
+
+
+def _render_local(url, as_of):
+    # renders through the app in this process, which fills this process's
+    # caches; warmup requests skip rate limiting
+    query = {'as_of': as_of.isoformat()} if as_of is not None else None
+    with app.test_client() as client:
+        response = client.get(url, query_string=query,
+                              environ_base={'fyyur.warmup': True})
+        response.close()
+        return response.status_code
+
+
+def _render_remote(base_url):
+    # requests the page from a running server; each request warms
+    # whichever worker process answers it
+    def render(url, as_of):
+        if as_of is not None:
+            url += '?' + urllib.parse.urlencode({'as_of': as_of.isoformat()})
+        try:
+            with urllib.request.urlopen(base_url.rstrip('/') + url,
+                                        timeout=60) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as error:
+            return error.code
+
+    return render
+
+
+def warm(urls, concurrency=None, as_of=None, render=_render_local):
+    # renders urls concurrently; returns a Result per url and the wall
+    # clock time taken
+    concurrency = concurrency or app.config['WARMUP_CONCURRENCY']
+    started = time.perf_counter()
+
+    def run(url):
+        url_started = time.perf_counter()
+        try:
+            status = render(url, as_of)
+        except Exception:
+            app.logger.exception('warming %s failed', url)
+            status = None
+        return Result(url, status, time.perf_counter() - url_started)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(run, urls))
+    return results, time.perf_counter() - started
+
+
+def report(results, elapsed):
+    warmed = [result for result in results if result.status == 200]
+    lines = [f'{result.status or "error"} {result.seconds * 1000:8.1f} ms  '
+             f'{result.url}' for result in results]
+    coverage = len(warmed) / len(results) if results else 1.0
+    lines.append(f'Warmed {len(warmed)}/{len(results)} pages '
+                 f'({coverage:.0%}) in {elapsed:.2f}s.')
+    return '\n'.join(lines)
+
+
+# ----------------------------------------------------------------------------#
+# Scheduler.
+# ----------------------------------------------------------------------------#
+
+class WarmupScheduler:
+    # warms this process's caches in the background once it starts serving,
+    # then re-renders the warm set WARMUP_LEAD seconds before each local
+    # midnight as of midnight, so the fragments keyed on the shows that
+    # roll over are ready when the day changes
+
+    def __init__(self):
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self.run, daemon=True,
+                                           name='warmup')
+            self.thread.start()
+
+    def run(self):
+        self.warm()
+        while True:
+            midnight = datetime.datetime.combine(
+                clock.today() + datetime.timedelta(days=1), datetime.time(),
+                tzinfo=clock.timezone())
+            wake_at = midnight - datetime.timedelta(
+                seconds=app.config['WARMUP_LEAD'])
+            time.sleep(max(0.0, (wake_at - clock.now()).total_seconds()))
+            self.warm(as_of=midnight)
+            time.sleep(max(0.0, (midnight - clock.now()).total_seconds()))
+
+    def warm(self, as_of=None):
+        try:
+            with app.app_context():
+                urls = warmup_urls()
+            results, elapsed = warm(urls, as_of=as_of)
+        except Exception:
+            app.logger.exception('cache warmup failed')
+            return
+        app.logger.info(report(results, elapsed).splitlines()[-1])
+
+
+scheduler = WarmupScheduler()
+
+
+@app.before_request
+def start_warmup_scheduler():
+    if app.config['WARMUP_ON_START'] and scheduler.thread is None:
+        scheduler.start()
+
+
+# ----------------------------------------------------------------------------#
+# CLI commands.
+# ----------------------------------------------------------------------------#
+
+warmup_cli = AppGroup('warmup', help='Pre-render pages to warm caches.')
+
+
+@warmup_cli.command('run')
+@click.option('--top', type=int, default=None,
+              help='Number of popular pages to add to WARMUP_URLS.')
+@click.option('--access-log', type=click.Path(exists=True, dir_okay=False),
+              default=None, help='Access log to rank pages by.')
+@click.option('--concurrency', type=int, default=None)
+@click.option('--as-of', 'as_of', default=None,
+              help='Render pages as of this ISO datetime.')
+@click.option('--base-url', required=True, envvar='WARMUP_BASE_URL',
+              help='Server to warm, e.g. http://localhost:8000. The caches '
+                   'belong to the serving processes, so a short-lived CLI '
+                   'process has nothing worth warming.')
+def run_command(top, access_log, concurrency, as_of, base_url):
+    try:
+        as_of = clock.aware(datetime.datetime.fromisoformat(as_of)) \
+            if as_of else None
+    except ValueError:
+        raise click.BadParameter('not an ISO datetime', param_hint='--as-of')
+    urls = warmup_urls(top, access_log)
+    results, elapsed = warm(urls, concurrency, as_of,
+                            _render_remote(base_url))
+    click.echo(report(results, elapsed))